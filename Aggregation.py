@@ -0,0 +1,141 @@
+import json
+import threading
+import time
+import uuid
+from TaskScheduler import RESULT_ENV, DEFAULT_TIMEOUT, DEFAULT_RETRIES
+
+STRAGGLER_FACTOR = 2.0  # Shards slower than this multiple of the median count as stragglers
+
+# Prepended to the map script of every shard. The script reads SHARD_ID and SHARD_INPUT and
+# calls emit(value) with a JSON-serialisable result.
+SHARD_PRELUDE = """import json as _json, os as _os
+SHARD_ID = {shard_id!r}
+SHARD_INPUT = _json.loads({shard_input!r})
+def emit(value):
+    with open(_os.environ[{result_env!r}], 'w') as _result:
+        _json.dump(value, _result)
+"""
+
+def shard_payload(script, shard_id, shard_input):
+    prelude = SHARD_PRELUDE.format(shard_id=shard_id, shard_input=json.dumps(shard_input), result_env=RESULT_ENV)
+    return prelude.encode('utf-8') + b"\n" + script
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+class Job:
+    """One map-reduce job: a map script run once per shard and a reduce folded over the results.
+
+    reduce(accumulator, shard_id, value) is applied as each shard finishes, in completion order,
+    so results are never buffered. The reduce step runs under the job's lock and should be quick.
+    """
+    def __init__(self, name, shard_ids, reduce, initial):
+        self.job_id = uuid.uuid4().hex
+        self.name = name
+        self.shard_ids = list(shard_ids)
+        self.reduce = reduce
+        self.accumulator = initial
+        self.tasks = {}  # {shard_id: Task}
+        self.completed = set()
+        self.failed = {}  # {shard_id: error}
+        self.started_at = time.time()
+        self.finished_at = None
+        self.lock = threading.Lock()
+        self.done = threading.Event()
+
+    def shard_done(self, shard_id, task):
+        with self.lock:
+            self.tasks[shard_id] = task
+            if shard_id in self.completed or shard_id in self.failed:
+                return
+            if task.status == 'done':
+                try:
+                    self.accumulator = self.reduce(self.accumulator, shard_id, task.value)
+                    self.completed.add(shard_id)
+                except Exception as e:
+                    self.failed[shard_id] = f"Reduce failed: {e}"
+            else:
+                self.failed[shard_id] = task.error or f"Exit status {task.returncode}"
+            # The output is folded into the accumulator, no need to keep it around
+            task.value = None
+            finished = len(self.completed) + len(self.failed) == len(self.shard_ids)
+            if finished:
+                self.finished_at = time.time()
+        if finished:
+            self.done.set()
+
+    def wait(self, timeout=None):
+        """Block until every shard is in, returns the reduced result"""
+        if not self.done.wait(timeout):
+            raise TimeoutError(f"Job {self.name} still has {self.remaining()} shard(s) outstanding")
+        return self.accumulator
+
+    def remaining(self):
+        with self.lock:
+            return len(self.shard_ids) - len(self.completed) - len(self.failed)
+
+    def stats(self):
+        """Progress, throughput and the shards holding the job back"""
+        now = time.time()
+        with self.lock:
+            elapsed = (self.finished_at or now) - self.started_at
+            durations = {s: self.tasks[s].finished_at - self.tasks[s].submitted_at for s in self.completed}
+            median = percentile(list(durations.values()), 0.5)
+            stragglers = []
+            if median:
+                # Finished shards that took far longer than the median, and running ones already past it
+                for shard_id, duration in durations.items():
+                    if duration > STRAGGLER_FACTOR * median:
+                        stragglers.append({'shard_id': shard_id, 'seconds': duration, 'worker': self.tasks[shard_id].worker})
+                for shard_id, task in self.tasks.items():
+                    if shard_id in self.completed or shard_id in self.failed:
+                        continue
+                    if now - task.submitted_at > STRAGGLER_FACTOR * median:
+                        stragglers.append({'shard_id': shard_id, 'seconds': now - task.submitted_at,
+                                           'worker': task.worker, 'running': True})
+            return {
+                'job_id': self.job_id,
+                'name': self.name,
+                'shards': len(self.shard_ids),
+                'completed': len(self.completed),
+                'failed': dict(self.failed),
+                'elapsed': elapsed,
+                'shards_per_second': len(self.completed) / elapsed if elapsed > 0 else None,
+                'median_shard_seconds': median,
+                'p95_shard_seconds': percentile(list(durations.values()), 0.95),
+                'retried_shards': sum(1 for t in self.tasks.values() if t.attempts > 1),
+                'stragglers': sorted(stragglers, key=lambda s: -s['seconds'])
+            }
+
+class Aggregator:
+    """Splits jobs into shard tasks on a TaskManager and reduces their results as they arrive"""
+    def __init__(self, tasks):
+        self.tasks = tasks
+        self.jobs = {}
+
+    def map_reduce(self, script, shards, reduce, initial=None, name=None, requirements=None,
+                   timeout=DEFAULT_TIMEOUT, max_retries=DEFAULT_RETRIES):
+        """Run script once per shard, shards maps shard ids to JSON-serialisable inputs"""
+        if isinstance(script, str):
+            script = script.encode('utf-8')
+        job = Job(name or uuid.uuid4().hex[:8], shards, reduce, initial)
+        self.jobs[job.job_id] = job
+        if not job.shard_ids:
+            job.finished_at = time.time()
+            job.done.set()
+            return job
+        for shard_id, shard_input in shards.items():
+            task = self.tasks.submit(
+                shard_payload(script, shard_id, shard_input),
+                requirements,
+                name=f"{job.name}[{shard_id}]",
+                timeout=timeout,
+                max_retries=max_retries,
+                on_done=lambda task, shard_id=shard_id: job.shard_done(shard_id, task)
+            )
+            with job.lock:
+                job.tasks[shard_id] = task
+        return job
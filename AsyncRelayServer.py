@@ -0,0 +1,205 @@
+import asyncio
+import logging
+import socket
+from collections import deque
+from Framing import FrameBuffer, FramingError, encode_frame
+from TrafficControl import FairQueue
+from Compression import CompressionStats, compress_payload, decompress_payload, is_compressed
+from Serialization import JSON, decode_message, is_routed
+from RelayServer import LIVENESS_TICK, RelayRegistry
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger('async_relay_server')
+
+class RelayProtocol(asyncio.Protocol):
+    """One client connection, parsed and dispatched inline on the event loop"""
+    def __init__(self, server):
+        self.server = server
+        self.transport = None
+        self.address = None
+        self.peer_id = None
+        self.read_buffer = FrameBuffer()
+        self.received = deque()  # Frames read but not handled yet, they wait out a throttle
+        self.codec = None  # Negotiated at register, see RelayRegistry._cmd_register
+        self.compression = CompressionStats()
+        self.serializer = JSON
+        self.outbox = FairQueue()  # Relayed frames waiting while the transport's buffer is full
+        self.write_paused = False
+        self.throttle_timer = None  # Ends a throttle, frames are not handled while it runs
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.address = transport.get_extra_info('peername')
+        sock = transport.get_extra_info('socket')
+        if sock is not None:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        logger.debug(f"New connection from {self.address}")
+
+    def data_received(self, data):
+        try:
+            frames = self.read_buffer.feed(data)
+        except FramingError as e:
+            logger.warning(f"Framing error from {self.address}: {e}")
+            self.transport.close()
+            return
+        self.received.extend(frames)
+        self._handle_received()
+
+    def _handle_received(self):
+        while self.received and self.throttle_timer is None:
+            frame = self.received.popleft()
+            if is_compressed(frame):
+                try:
+                    frame = decompress_payload(frame, self.compression)
+                except Exception as e:
+                    logger.warning(f"Bad compressed frame from {self.address}: {e}")
+                    continue
+            try:
+                if is_routed(frame):
+                    self.server._handle_routed(frame, self, self.peer_id)
+                    continue
+                message = decode_message(frame)
+            except ValueError:
+                logger.warning(f"Invalid message from {self.address}")
+                self.send_json({'status': 'error', 'message': 'Invalid message'})
+                continue
+            try:
+                self.peer_id, keep_open = self.server._handle_command(message, self, self.peer_id)
+            except Exception as e:
+                logger.error(f"Error handling client {self.address}: {e}")
+                keep_open = False
+            if not keep_open:
+                self.received.clear()
+                self.transport.close()
+                return
+
+    def connection_lost(self, exc):
+        if self.throttle_timer is not None:
+            self.throttle_timer.cancel()
+        self.server._connection_lost(self.peer_id, self)
+
+    def pause_writing(self):
+        self.write_paused = True
+
+    def resume_writing(self):
+        self.write_paused = False
+        self._write_relayed()
+
+    def send_relayed(self, sender_id, frame):
+        if self.transport.is_closing():
+            raise ConnectionError("Connection closed")
+        if not self.outbox.put(sender_id, frame):
+            return False
+        self._write_relayed()
+        return True
+
+    def _write_relayed(self):
+        # Hand frames to the transport only while it keeps up, the rest wait their turn in the outbox
+        while not self.write_paused and not self.transport.is_closing():
+            frame = self.outbox.get()
+            if frame is None:
+                return
+            self.transport.write(frame)
+
+    def throttle(self, seconds):
+        if self.throttle_timer is not None:
+            self.throttle_timer.cancel()
+        else:
+            self.transport.pause_reading()
+        self.throttle_timer = asyncio.get_running_loop().call_later(seconds, self._end_throttle)
+
+    def _end_throttle(self):
+        self.throttle_timer = None
+        if not self.transport.is_closing():
+            self.transport.resume_reading()
+            self._handle_received()
+
+    def send_json(self, obj):
+        payload = self.serializer.dumps(obj)
+        self.send_encoded(encode_frame(compress_payload(payload, self.codec, self.compression)))
+
+    def send_encoded(self, frame):
+        if self.transport.is_closing():
+            raise ConnectionError("Connection closed")
+        self.transport.write(frame)
+
+    def close(self):
+        self.transport.close()
+
+class RelayDatagramProtocol(asyncio.DatagramProtocol):
+    """Hole punching endpoint discovery, answered on the event loop like everything else"""
+    def __init__(self, server):
+        self.server = server
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, address):
+        reply = self.server._handle_datagram(data, address)
+        if reply:
+            self.transport.sendto(reply, address)
+
+class AsyncRelayServer(RelayRegistry):
+    """Relay front end multiplexing every client on a single asyncio event loop"""
+    def __init__(self, host='0.0.0.0', port=12345, backlog=4096, reuse_port=False):
+        super().__init__()
+        self.host = host
+        self.port = port
+        self.backlog = backlog
+        self.reuse_port = reuse_port
+        self.loop = None
+        self.server = None
+
+    async def serve(self):
+        """Accept clients until shutdown() is called"""
+        self.loop = asyncio.get_running_loop()
+        self.server = await self.loop.create_server(
+            lambda: RelayProtocol(self),
+            self.host,
+            self.port,
+            backlog=self.backlog,
+            reuse_address=True,
+            reuse_port=self.reuse_port
+        )
+        udp_transport, _ = await self.loop.create_datagram_endpoint(
+            lambda: RelayDatagramProtocol(self),
+            local_addr=(self.host, self.port),
+            reuse_port=self.reuse_port
+        )
+        logger.info(f"Async relay server started on {self.host}:{self.port}")
+        cleanup_task = asyncio.ensure_future(self._cleanup_inactive_peers())
+        try:
+            async with self.server:
+                await self.server.serve_forever()
+        except asyncio.CancelledError:
+            pass
+        finally:
+            cleanup_task.cancel()
+            udp_transport.close()
+            self.running = False
+            for peer_id in list(self.connections.keys()):
+                self._remove_peer(peer_id)
+            logger.info("Async relay server shut down")
+
+    def start(self):
+        """Run the event loop in the calling thread"""
+        try:
+            asyncio.run(self.serve())
+        except KeyboardInterrupt:
+            logger.info("Server shutdown initiated")
+
+    def shutdown(self):
+        """Stop serving, safe to call from any thread"""
+        self.running = False
+        if self.loop is not None and self.server is not None:
+            self.loop.call_soon_threadsafe(self.server.close)
+
+    async def _cleanup_inactive_peers(self):
+        while self.running:
+            await asyncio.sleep(LIVENESS_TICK)
+            self._expire_inactive_peers()
+
+if __name__ == "__main__":
+    server = AsyncRelayServer(port=12345)
+    server.start()
@@ -0,0 +1,129 @@
+import bisect
+import heapq
+import math
+import os
+import shutil
+import threading
+from itertools import islice
+
+# Runtimes a peer reports as installed when the executable is on its PATH
+RUNTIMES = ('python3', 'node', 'java', 'go', 'gcc', 'docker', 'nvidia-smi')
+
+def free_memory_mb():
+    """Memory available for new work, from /proc/meminfo where there is one"""
+    try:
+        with open('/proc/meminfo') as meminfo:
+            for line in meminfo:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) // 1024
+    except OSError:
+        pass
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_AVPHYS_PAGES') // (1024 * 1024)
+    except (ValueError, OSError, AttributeError):
+        return None
+
+def local_capabilities():
+    """What this machine offers: cores, free RAM, load per core and installed runtimes"""
+    cores = os.cpu_count() or 1
+    try:
+        load = os.getloadavg()[0] / cores
+    except (OSError, AttributeError):
+        load = 0.0
+    capabilities = {
+        'cores': cores,
+        'load': round(load, 3),
+        'runtimes': [runtime for runtime in RUNTIMES if shutil.which(runtime)]
+    }
+    memory = free_memory_mb()
+    if memory is not None:
+        capabilities['memory_mb'] = memory
+    return capabilities
+
+def parse_capabilities(capabilities):
+    """Cores and load from what a peer advertised, ValueError if any field is unusable"""
+    if not isinstance(capabilities, dict):
+        raise ValueError("capabilities must be a mapping")
+    try:
+        cores = int(capabilities.get('cores') or 1)
+        load = float(capabilities.get('load') or 0.0)
+        memory = float(capabilities.get('memory_mb') or 0)
+    except (TypeError, ValueError):
+        raise ValueError("cores, load and memory_mb must be numbers")
+    if cores < 1 or not math.isfinite(load) or not math.isfinite(memory):
+        raise ValueError("cores must be positive, load and memory_mb finite")
+    runtimes = capabilities.get('runtimes', [])
+    if not isinstance(runtimes, list) or not all(isinstance(runtime, str) for runtime in runtimes):
+        raise ValueError("runtimes must be a list of names")
+    return cores, load
+
+class CapabilityIndex:
+    """Peers bucketed by core count, each bucket kept sorted by load.
+
+    A query for the N least-loaded peers with at least X cores merges the heads of the
+    qualifying buckets, so it touches about N entries per bucket instead of every peer.
+    Core counts come in few distinct values, so there are only a handful of buckets.
+    """
+    def __init__(self):
+        self.core_counts = []  # Sorted distinct core counts that have a bucket
+        self.buckets = {}  # {cores: sorted [(load, peer_id)]}
+        self.entries = {}  # {peer_id: (cores, load, capabilities)}
+        self.lock = threading.Lock()  # The threaded relay updates it from every client thread
+
+    def __len__(self):
+        return len(self.entries)
+
+    def update(self, peer_id, capabilities):
+        """Add a peer or move it to where its new capabilities put it, ValueError if they are unusable"""
+        cores, load = parse_capabilities(capabilities)
+        with self.lock:
+            self._remove(peer_id)
+            self._insert(peer_id, cores, load, capabilities)
+
+    def _insert(self, peer_id, cores, load, capabilities):
+        bucket = self.buckets.get(cores)
+        if bucket is None:
+            bucket = self.buckets[cores] = []
+            bisect.insort(self.core_counts, cores)
+        bisect.insort(bucket, (load, peer_id))
+        self.entries[peer_id] = (cores, load, capabilities)
+
+    def remove(self, peer_id):
+        with self.lock:
+            self._remove(peer_id)
+
+    def _remove(self, peer_id):
+        entry = self.entries.pop(peer_id, None)
+        if entry is None:
+            return
+        cores, load, _ = entry
+        bucket = self.buckets[cores]
+        position = bisect.bisect_left(bucket, (load, peer_id))
+        if position < len(bucket) and bucket[position] == (load, peer_id):
+            del bucket[position]
+        if not bucket:
+            del self.buckets[cores]
+            self.core_counts.remove(cores)
+
+    def capabilities(self, peer_id):
+        entry = self.entries.get(peer_id)
+        return entry[2] if entry else None
+
+    def least_loaded(self, count, min_cores=1, min_memory_mb=None, runtime=None, exclude=None):
+        """Up to count (peer_id, capabilities) pairs, least loaded first"""
+        with self.lock:
+            start = bisect.bisect_left(self.core_counts, min_cores)
+            merged = heapq.merge(*(self.buckets[cores] for cores in self.core_counts[start:]))
+            matches = (
+                (peer_id, self.entries[peer_id][2])
+                for _, peer_id in merged
+                if peer_id != exclude and self._qualifies(self.entries[peer_id][2], min_memory_mb, runtime)
+            )
+            return list(islice(matches, count))
+
+    def _qualifies(self, capabilities, min_memory_mb, runtime):
+        if min_memory_mb and (capabilities.get('memory_mb') or 0) < min_memory_mb:
+            return False
+        if runtime and runtime not in capabilities.get('runtimes', []):
+            return False
+        return True
@@ -0,0 +1,166 @@
+import hashlib
+import json
+import os
+import re
+import threading
+import uuid
+
+CHUNK_SIZE = 256 * 1024
+DIGEST_PATTERN = re.compile(r'[0-9a-f]{64}')
+
+def chunk_digest(data):
+    return hashlib.sha256(data).hexdigest()
+
+def is_digest(digest):
+    """Whether digest is a sha256 in the form the store names its files by, peers send these"""
+    return isinstance(digest, str) and DIGEST_PATTERN.fullmatch(digest) is not None
+
+def manifest_id(manifest):
+    """Content address of a whole artifact, same bytes and chunking give the same id on every peer"""
+    canonical = json.dumps({
+        'size': manifest['size'],
+        'chunk_size': manifest['chunk_size'],
+        'chunks': manifest['chunks']
+    }, sort_keys=True)
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+class ChunkStore:
+    """On-disk store of chunks addressed by their sha256.
+
+    Chunks received from peers are kept as files under root. Local files being sent are
+    indexed in place instead of copied, so offering a large dataset costs one hashing pass.
+    """
+    def __init__(self, root='chunks'):
+        self.root = root
+        self.sources = {}  # Chunks readable from local files {digest: (path, offset, length)}
+        self.indexed = {}  # Manifest cache {path: (mtime, size, chunk_size, manifest)}
+        self.lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+
+    def _chunk_path(self, digest):
+        # Anything but a plain hex digest could name a path outside the store
+        if not is_digest(digest):
+            raise ValueError(f"Not a chunk digest: {digest!r}")
+        return os.path.join(self.root, digest[:2], digest)
+
+    def has(self, digest):
+        if not is_digest(digest):
+            return False
+        with self.lock:
+            if digest in self.sources:
+                return True
+        return os.path.exists(self._chunk_path(digest))
+
+    def missing(self, manifest):
+        """Indexes of the manifest's chunks this store does not hold"""
+        return [i for i, digest in enumerate(manifest['chunks']) if not self.has(digest)]
+
+    def put(self, digest, data):
+        """Store a chunk, returns False if the data does not hash to digest"""
+        if not is_digest(digest) or chunk_digest(data) != digest:
+            return False
+        path = self._chunk_path(digest)
+        if os.path.exists(path):
+            return True
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(temp_path, 'wb') as out:
+            out.write(data)
+        os.replace(temp_path, path)
+        return True
+
+    def read(self, digest):
+        """Return a chunk's bytes, KeyError if it is gone or its source file changed"""
+        if not is_digest(digest):
+            raise KeyError(digest)
+        with self.lock:
+            source = self.sources.get(digest)
+        if source is not None:
+            path, offset, length = source
+            try:
+                with open(path, 'rb') as f:
+                    f.seek(offset)
+                    data = f.read(length)
+            except OSError:
+                data = None
+            if data is not None and chunk_digest(data) == digest:
+                return data
+            with self.lock:
+                self.sources.pop(digest, None)
+        try:
+            with open(self._chunk_path(digest), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            raise KeyError(digest)
+
+    def locate(self, digest):
+        """(path, offset, length) of a chunk on disk for sendfile, None when it has to go through read()
+
+        A local source only counts while its file is unchanged since it was hashed, anything
+        else takes read(), which checks the digest and falls back to a stored copy.
+        """
+        if not is_digest(digest):
+            return None
+        with self.lock:
+            source = self.sources.get(digest)
+            indexed = self.indexed.get(source[0]) if source else None
+        if source is not None:
+            try:
+                stat = os.stat(source[0])
+            except OSError:
+                return None
+            if indexed and indexed[:2] == (stat.st_mtime, stat.st_size):
+                return source
+            return None
+        path = self._chunk_path(digest)
+        try:
+            return path, 0, os.path.getsize(path)
+        except OSError:
+            return None
+
+    def add_file(self, path, chunk_size=CHUNK_SIZE):
+        """Hash a local file into a manifest, indexing its chunks without copying them"""
+        stat = os.stat(path)
+        with self.lock:
+            cached = self.indexed.get(path)
+        if cached and cached[:3] == (stat.st_mtime, stat.st_size, chunk_size):
+            return cached[3]
+
+        chunks = []
+        sources = {}
+        offset = 0
+        with open(path, 'rb') as f:
+            while True:
+                data = f.read(chunk_size)
+                if not data and chunks:
+                    break
+                digest = chunk_digest(data)
+                chunks.append(digest)
+                sources[digest] = (path, offset, len(data))
+                offset += len(data)
+                if len(data) < chunk_size:
+                    break
+        manifest = {
+            'filename': os.path.basename(path),
+            'size': offset,
+            'chunk_size': chunk_size,
+            'chunks': chunks
+        }
+        manifest['manifest_id'] = manifest_id(manifest)
+        with self.lock:
+            self.sources.update(sources)
+            self.indexed[path] = (stat.st_mtime, stat.st_size, chunk_size, manifest)
+        return manifest
+
+    def assemble(self, manifest, dest_path):
+        """Write the artifact described by manifest to dest_path, one chunk at a time"""
+        temp_path = f"{dest_path}.{uuid.uuid4().hex}.tmp"
+        try:
+            with open(temp_path, 'wb') as out:
+                for digest in manifest['chunks']:
+                    out.write(self.read(digest))
+        except Exception:
+            os.remove(temp_path)
+            raise
+        os.replace(temp_path, dest_path)
+        return dest_path
@@ -12,7 +12,13 @@ class CloudInterface(Interface):
             "/cloud": self.cloud_status,
             "/discover": self.discover_peers,
             "/connect_cloud": self.connect_cloud_peer,
-            "/relay": self.relay_message
+            "/relay": self.relay_message,
+            "/find": self.find_peers,
+            "/submit": self.submit_task,
+            "/work": self.start_worker,
+            "/tasks": self.task_status,
+            "/compression": self.compression_status,
+            "/queues": self.queue_status
         }
     
     def run(self):
@@ -34,11 +40,17 @@ class CloudInterface(Interface):
         print("  /cloud - Display cloud connection status")
         print("  /discover - Find peers through cloud relay")
         print("  /connect_cloud <peer_id> - Connect to a peer by ID")
-        print("  /relay <peer_id> <message> - Send message through relay\n")
+        print("  /relay <peer_id> <message> - Send message through relay")
+        print("  /find <count> [min_cores] - Find the least-loaded peers with enough cores")
+        print("  /submit <file> [cores] - Queue a script as a task")
+        print("  /work <peer_id> - Run tasks queued by a peer")
+        print("  /tasks - Show queued tasks and their timings")
+        print("  /compression - Show compression ratio and CPU time per connection")
+        print("  /queues - Show send queue depth and drops per connection\n")
             
         command = None
         while command != "/exit":
-            command = input("Please type your message, or enter a command, '/connect', '/approve', '/name', '/addPort', '/exit', '/cloud', '/discover', '/connect_cloud', '/relay', '/sendCode', '/receiveCode' then hit enter:  \n")
+            command = input("Please type your message, or enter a command, '/connect', '/approve', '/name', '/addPort', '/exit', '/cloud', '/discover', '/connect_cloud', '/relay', '/find', '/submit', '/work', '/tasks', '/compression', '/queues', '/sendCode', '/shareCode', '/receiveCode' then hit enter:  \n")
             
             # Check for cloud commands first
             if command.split(' ')[0] in self.cloud_commands:
@@ -56,6 +68,8 @@ class CloudInterface(Interface):
                 self.addPort()
             elif command == "/sendCode":
                 self.parseAndSend()
+            elif command == "/shareCode":
+                self.parseAndShare()
             elif command == "/receiveCode":
                 self.receivingCode = True
             else:
@@ -140,27 +154,111 @@ class CloudInterface(Interface):
             return
             
         success = self.network.send_via_relay(peer_id, message)
-        if success:
-            print(f"Message sent via relay to {self.network.relay_peers[peer_id]}")
-        else:
+        if not success:
             print("Failed to send message via relay")
+        elif not self.network.cloud_connected:
+            print(f"Relay unreachable, message to {self.network.relay_peers[peer_id]} queued until it reconnects")
+        else:
+            print(f"Message sent via relay to {self.network.relay_peers[peer_id]}")
+    
+    def find_peers(self, args):
+        """List the least-loaded peers with at least the given core count"""
+        parts = args.split()
+        if not parts or not all(part.isdigit() for part in parts):
+            print("Usage: /find <count> [min_cores]")
+            return
+            
+        if not isinstance(self.network, CloudNetwork) or not self.network.cloud_connected:
+            print("Not connected to cloud relay")
+            return
+            
+        count = int(parts[0])
+        min_cores = int(parts[1]) if len(parts) > 1 else 1
+        peers = self.network.find_peers(count, min_cores)
+        if not peers:
+            print("No matching peers")
+            return
+            
+        for peer in peers:
+            caps = peer.capabilities
+            print(f"  {peer.peer_id}: {caps.get('cores')} cores, load {caps.get('load')}, "
+                  f"{caps.get('memory_mb')} MB free, runtimes {', '.join(caps.get('runtimes', []))}")
+    
+    def submit_task(self, args):
+        """Queue a script as a task, workers pull it and report the output back"""
+        parts = args.split()
+        if not parts:
+            print("Usage: /submit <file> [cores]")
+            return
+            
+        try:
+            with open(parts[0], 'rb') as f:
+                payload = f.read()
+            requirements = {'cores': int(parts[1])} if len(parts) > 1 else {}
+        except Exception as e:
+            print(f"Error reading task: {e}")
+            return
+            
+        task = self.network.tasks.submit(payload, requirements, name=os.path.basename(parts[0]))
+        print(f"Queued task {task.name} ({task.task_id})")
+    
+    def start_worker(self, args):
+        """Offer this machine's cores to a peer's task queue"""
+        if not args:
+            print("Usage: /work <peer_id>")
+            return
+            
+        coordinator = args.strip()
+        if isinstance(self.network, CloudNetwork) and coordinator in self.network.relay_peers:
+            # Working for a peer means running its tasks, so it counts as approved
+            peer = self.network.relay_peers[coordinator]
+            self.network.approve(peer)
+            coordinator = self.network._transfer_key(peer)
+        self.network.tasks.start_worker(coordinator)
+        print(f"Working for {coordinator} with {self.network.tasks.slots} slot(s)")
+    
+    def task_status(self, args=""):
+        """Show submitted tasks and their timings"""
+        stats = self.network.tasks.stats()
+        print(f"Workers: {stats['workers']}, tasks: {stats['counts']}")
+        if stats['mean_queue_wait'] is not None:
+            print(f"Mean queue wait: {stats['mean_queue_wait']:.2f}s")
+        if stats['mean_run_time'] is not None:
+            print(f"Mean run time: {stats['mean_run_time']:.2f}s")
+        for job in list(self.network.aggregator.jobs.values()):
+            job_stats = job.stats()
+            print(f"  Job {job_stats['name']}: {job_stats['completed']}/{job_stats['shards']} shards, "
+                  f"{len(job_stats['failed'])} failed, {len(job_stats['stragglers'])} straggler(s)")
+        for task in list(self.network.tasks.tasks.values()):
+            metrics = task.metrics()
+            print(f"  {metrics['name']}: {metrics['status']}, attempts {metrics['attempts']}, worker {metrics['worker']}")
+            if task.output:
+                print(task.output.decode('utf-8', errors='replace'))
+    
+    def compression_status(self, args=""):
+        """Show how much compression saves on each connection"""
+        ratio = lambda value: f"{value:.2f}x" if value else "-"
+        for name, stats in self.network.compression_stats().items():
+            print(f"  {name}: codec {stats['codec'] or 'none'}, sent {ratio(stats['sent_ratio'])}, "
+                  f"received {ratio(stats['received_ratio'])}, {stats['bytes_saved']} bytes saved, "
+                  f"cpu {stats['compress_time']:.3f}s compressing / {stats['decompress_time']:.3f}s decompressing")
+    
+    def queue_status(self, args=""):
+        """Show how far behind each connection's send queue is"""
+        for name, stats in self.network.send_queue_stats().items():
+            print(f"  {name}: {stats['depth']} frames / {stats['bytes']} bytes queued (peak {stats['high_water']}), "
+                  f"{stats['sent']} sent, {stats['dropped']} dropped, blocked {stats['blocked']} times "
+                  f"for {stats['blocked_time']:.2f}s, policy {stats['policy']}")
     
     def parseAndSend(self):
-        """Override parseAndSend to handle cloud file transfers"""
+        """Override parseAndSend to stream the file to direct and relay-only peers"""
         fileName = input("Please enter the filename to send: ")
         
         try:
-            with open(fileName, 'r') as openFile:
-                file_content = openFile.read()
-                
-            # For standard network connections
-            self.network.sender("<code> " + file_content)
-            
-            # For relay-only peers in cloud network
-            if isinstance(self.network, CloudNetwork):
-                for peer_id, peer in self.network.relay_peers.items():
-                    if peer.relay_only and peer in self.network.peerList:
-                        self.network.send_file_via_relay(peer_id, file_content.encode('utf-8'), os.path.basename(fileName))
+            if not os.path.isfile(fileName):
+                raise FileNotFoundError(fileName)
+            transfers = self.network.send_file(fileName)
+            print(f"Sending {os.path.basename(fileName)} to {len(transfers)} peer(s)")
                         
         except Exception as e:
             print(f"Error reading or sending file: {e}")
\ No newline at end of file
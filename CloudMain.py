@@ -6,6 +6,7 @@ import sys
 import logging
 from CloudInterface import CloudInterface
 from CloudP2PPlatform import CloudNetwork
+from SendQueue import BLOCK, POLICIES
 
 #Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -18,6 +19,8 @@ def parse_arguments():
     parser.add_argument('--relay-port', type=int, default=12345, help='Relay server port (default: 12345)')
     parser.add_argument('--ip', type=str, help='Local IP address (auto-detect if not specified)')
     parser.add_argument('--port', type=int, help='Local port (prompt if not specified)')
+    parser.add_argument('--send-policy', choices=POLICIES, default=BLOCK,
+                        help='What to do with messages for a peer that falls behind (default: block)')
     parser.add_argument('--debug', action='store_true', help='Enable debug logging')
     
     return parser.parse_args()
@@ -79,7 +82,7 @@ def main():
     tagDict = {}
     try:
         logger.info(f"Connecting to relay server at {args.relay}:{args.relay_port}")
-        myNetwork = CloudNetwork(myIP, myPort, args.relay, args.relay_port)
+        myNetwork = CloudNetwork(myIP, myPort, args.relay, args.relay_port, send_policy=args.send_policy)
         myInterface = CloudInterface(tagDict, myNetwork, args.relay)
         myInterface.run()
     except KeyboardInterrupt:
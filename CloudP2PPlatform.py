@@ -6,12 +6,45 @@ import logging
 import random
 import uuid
 import base64
+from collections import deque
+from concurrent.futures import Future
 from P2PPlatform import Network, Peer, Message
+from Framing import FramedConnection, FrameBuffer, encode_frame
+from ConnectionPool import ConnectionPool
+from CapabilityIndex import local_capabilities
+from RelayClient import RelayClient
+from HolePunch import PunchTransport
+from Compression import available_codecs, negotiate
+from Serialization import available_serializers, negotiate_serializer
+from SendQueue import BLOCK
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger('cloud_p2p')
 
+# First frame on a direct connection we open, tells the other side which cloud peer we are.
+# The other side believes it once we echo the nonce it then sends us through the relay.
+HELLO_TAG = b"<hello>"
+HELLO_PROOF_TAG = b"<hello-proof>"
+HELLO_PROOF_TIMEOUT = 10  # How long a connection's frames are held back waiting for its proof
+HELLO_HELD_FRAMES = 256  # Frames held back at most, the connection is left unproven past this
+
+# Heartbeats only go out when nothing else reached the relay for heartbeat_interval, which
+# grows while the relay link stays healthy and starts over from the minimum after a reconnect
+MIN_HEARTBEAT_INTERVAL = 15
+MAX_HEARTBEAT_INTERVAL = 60  # Well inside the relay's longest peer timeout
+HEARTBEAT_GROWTH = 1.5
+HEARTBEAT_CHECK = 1  # How often the heartbeat loop looks at the relay link
+MAINTENANCE_INTERVAL = 30  # UDP endpoint refresh, capability check and stalled resyncs
+PEER_REFRESH_INTERVAL = 150  # Non-subscribers catch up on membership this often
+LOAD_CHANGE = 0.1  # Load per core moving this much is worth a heartbeat of its own
+
+# Reconnect attempts back off exponentially with jitter, starting over after every success
+RECONNECT_DELAY = 0.5
+MAX_RECONNECT_DELAY = 15
+WRONG_WORKER_RETRIES = 8  # Fresh connections tried per attempt to land on the worker owning our id
+RELAY_BACKLOG = 1000  # Relay sends held while disconnected, the oldest are dropped past this
+
 class CloudPeer(Peer):
     """Extended Peer class with cloud identity information"""
     def __init__(self, ip, port=None, connection=None, peer_id=None):
@@ -19,24 +52,50 @@ class CloudPeer(Peer):
         self.peer_id = peer_id or str(uuid.uuid4())
         self.relay_only = False  # Flag if we can only communicate via relay
         self.last_heartbeat = time.time()
+        self.capabilities = {}  # Cores, memory_mb, load and runtimes as advertised to the relay
     
     def __str__(self):
         if self.name:
             return f"{self.name} ({self.ip}:{self.port})"
         return f"{self.ip}:{self.port} [{self.peer_id[:8]}]"
 
+class HelloChallenge:
+    """An inbound connection whose hello named a cloud peer, until that peer proves it opened it"""
+    def __init__(self, peer_id):
+        self.peer_id = peer_id
+        self.nonce = uuid.uuid4().hex  # Sent to peer_id through the relay, which only it receives
+        self.deadline = time.time() + HELLO_PROOF_TIMEOUT
+        self.held = []  # Frames that arrived before the proof
+
 class CloudNetwork(Network):
     """Extended Network class with cloud functionality"""
-    def __init__(self, ip, port, relay_server_ip, relay_server_port=12345):
-        super().__init__(ip, port)
+    def __init__(self, ip, port, relay_server_ip, relay_server_port=12345, subscribe=True, udp_socket=None,
+                 send_policy=BLOCK):
+        super().__init__(ip, port, send_policy)
         
         # Cloud specific attributes
         self.relay_server_ip = relay_server_ip
         self.relay_server_port = relay_server_port
         self.relay_connection = None
+        self.relay_client = None  # Owns reads on relay_connection once registered
+        self.relay_fast_path = False  # Whether the relay forwards routed frames
+        self.heartbeat_interval = MIN_HEARTBEAT_INTERVAL  # Longest we let the relay link go quiet
+        self.sent_capabilities = None  # What the relay's capability index has for us
         self.peer_id = None
+        self.resume_token = None  # Lets us reclaim peer_id and what the relay held for us after a drop
+        self.relay_backlog = deque(maxlen=RELAY_BACKLOG)  # Sends waiting for the relay to come back
+        self.relay_backlog_lock = threading.Lock()
         self.cloud_connected = False
         self.relay_peers = {}  # Peers known through relay {peer_id: CloudPeer}
+        self.subscribe = subscribe  # Have the relay push membership changes instead of polling
+        self.peers_epoch = None  # Relay membership version our relay_peers reflects
+        self.peers_version = None
+        self.peers_resync_pending = False
+        self.pool = ConnectionPool(self)  # Direct connections to cloud peers, one per peer_id
+        self.udp_token = None  # Proves our UDP endpoint registrations to the relay
+        self.udp = PunchTransport(udp_socket)  # Punched paths to peers no TCP connection reaches
+        self.hello_challenges = {}  # Inbound connections proving who their hello says they are {Peer: HelloChallenge}
+        self.adopted = {}  # Connections a cloud peer took over part way through a read {Peer: CloudPeer}
         
         # Start cloud connection
         self._connect_to_relay()
@@ -54,27 +113,65 @@ class CloudNetwork(Network):
     def _connect_to_relay(self):
         """Connect to relay server and register this peer"""
         try:
-            # Create a socket connection to the relay server
-            self.relay_connection = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.relay_connection.connect((self.relay_server_ip, self.relay_server_port))
-            
             # Register with relay server
+            capabilities = local_capabilities()
             registration = {
                 'command': 'register',
                 'ip': self.ip,
-                'port': self.port
+                'port': self.port,
+                'interval': MIN_HEARTBEAT_INTERVAL,
+                'capabilities': capabilities,
+                'codecs': available_codecs(),
+                'serializers': available_serializers()
             }
-            self.relay_connection.sendall(json.dumps(registration).encode('utf-8'))
+            if self.peer_id and self.resume_token:
+                registration['resume'] = {'peer_id': self.peer_id, 'token': self.resume_token}
             
-            # Get response
-            response = json.loads(self.relay_connection.recv(4096).decode('utf-8'))
+            for _ in range(WRONG_WORKER_RETRIES):
+                # Create a socket connection to the relay server
+                relay_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                relay_socket.connect((self.relay_server_ip, self.relay_server_port))
+                connection = FramedConnection(relay_socket)
+                connection.send_json(registration)
+                
+                # Get response, nothing else reads the connection until the relay client takes it over
+                response = connection.read_json()
+                if response is None:
+                    connection.close()
+                    raise ConnectionError("Relay server closed the connection")
+                if not response.get('retry'):
+                    break
+                # A sharded relay can only resume us on the worker owning our id, which the
+                # kernel picks per connection, so try again until we land there
+                connection.close()
             if response.get('status') == 'success':
+                previous_id = self.peer_id
                 self.peer_id = response.get('peer_id')
+                self.resume_token = response.get('resume_token')
+                self.udp_token = response.get('udp_token')
+                connection.codec = negotiate([response.get('codec')])
+                connection.serializer = negotiate_serializer([response.get('serializer')])
+                self.relay_fast_path = 'serializer' in response  # Older relays only know JSON commands
+                self.heartbeat_interval = MIN_HEARTBEAT_INTERVAL
+                self.sent_capabilities = capabilities
+                self.relay_connection = connection
+                self.relay_client = RelayClient(connection, self._handle_relay_message, self._routed_received)
                 self.cloud_connected = True
-                logger.info(f"Connected to relay server. Assigned ID: {self.peer_id}")
+                if self.subscribe:
+                    # The snapshot seeds the deltas pushed from here on
+                    self.relay_client.request_async({'command': 'subscribe', 'peer_id': self.peer_id})
+                    self._request_relay_peers()
+                threading.Thread(target=self._register_udp, daemon=True).start()
+                if previous_id == self.peer_id:
+                    logger.info(f"Resumed relay session as {self.peer_id}")
+                elif previous_id:
+                    logger.warning(f"Relay session expired, registered again as {self.peer_id}")
+                else:
+                    logger.info(f"Connected to relay server. Assigned ID: {self.peer_id}")
                 self._alert(Message(f"Connected to cloud relay at {self.relay_server_ip}:{self.relay_server_port}"))
                 return True
             else:
+                connection.close()
                 logger.error(f"Failed to register with relay server: {response.get('message')}")
                 self._alert(Message(f"Failed to connect to cloud relay: {response.get('message')}"))
                 return False
@@ -83,499 +180,676 @@ class CloudNetwork(Network):
             logger.error(f"Error connecting to relay server: {e}")
             self._alert(Message(f"Failed to connect to cloud relay: {e}"))
             self.relay_connection = None
+            self.relay_client = None
             return False
     
     def _heartbeat_loop(self):
-        """Send regular heartbeats to the relay server"""
-        while self.running and self.cloud_connected:
+        """Keep the relay sure we are alive, with a heartbeat only when the link has been quiet"""
+        last_maintenance = last_refresh = time.time()
+        while self.running:
+            client = None
             try:
-                if self.relay_connection and self.peer_id:
-                    heartbeat = {
-                        'command': 'heartbeat',
-                        'peer_id': self.peer_id
-                    }
-                    self.relay_connection.sendall(json.dumps(heartbeat).encode('utf-8'))
-                    
-                    # Update peer list every 5 heartbeats
-                    if random.random() < 0.2:  # 20% chance per heartbeat
-                        self._get_relay_peers()
+                time.sleep(HEARTBEAT_CHECK)
+                client = self.relay_client
+                if not (self.cloud_connected and client and self.peer_id):
+                    continue  # The relay receiver is reconnecting
+                now = time.time()
+                capabilities = None
+                if now - last_maintenance >= MAINTENANCE_INTERVAL:
+                    last_maintenance = now
+                    self._register_udp()  # Keeps our NAT's UDP mapping from expiring
+                    current = local_capabilities()
+                    if self._capabilities_changed(current):
+                        capabilities = current  # Load and free memory move, keep the relay's index current
+                    if self.subscribe and self.peers_resync_pending:
+                        self._request_relay_peers()  # The last resync answer never came
                 
-                time.sleep(30)  # Heartbeat every 30 seconds
+                # Any frame we sent the relay since counts as a heartbeat
+                if capabilities is not None or now - client.last_sent >= self.heartbeat_interval:
+                    self._heartbeat(client, capabilities)
+                
+                # Subscribers are pushed changes, others poll for them
+                if not self.subscribe and now - last_refresh >= PEER_REFRESH_INTERVAL:
+                    last_refresh = now
+                    self._get_relay_peers()
                 
             except Exception as e:
                 logger.warning(f"Heartbeat failed: {e}")
-                # Try to reconnect
-                self.cloud_connected = False
-                time.sleep(5)
-                self._connect_to_relay()
+                # Reconnecting is the relay receiver's job, closing the link wakes it up
+                if client is not None:
+                    client.close()
+    
+    def _heartbeat(self, client, capabilities=None):
+        """Tell the relay we are alive and how long we may go quiet before the next sign of life"""
+        interval = min(self.heartbeat_interval * HEARTBEAT_GROWTH, MAX_HEARTBEAT_INTERVAL)
+        heartbeat = {'command': 'heartbeat', 'peer_id': self.peer_id, 'interval': interval}
+        if capabilities is not None:
+            heartbeat['capabilities'] = capabilities
+        response = client.request(heartbeat)
+        if response.get('status') != 'success':
+            raise ConnectionError(response.get('message'))
+        self.heartbeat_interval = interval
+        if capabilities is not None:
+            self.sent_capabilities = capabilities
+    
+    def _capabilities_changed(self, capabilities):
+        """Whether capabilities differ enough from what the relay has to be worth sending"""
+        sent = self.sent_capabilities
+        if sent is None:
+            return True
+        if capabilities.get('cores') != sent.get('cores') or capabilities.get('runtimes') != sent.get('runtimes'):
+            return True
+        if abs(capabilities.get('load', 0.0) - sent.get('load', 0.0)) >= LOAD_CHANGE:
+            return True
+        memory, sent_memory = capabilities.get('memory_mb'), sent.get('memory_mb')
+        if memory is None or sent_memory is None:
+            return memory != sent_memory
+        return abs(memory - sent_memory) >= sent_memory * 0.1
+    
+    def _register_udp(self):
+        """Let the relay see our public UDP endpoint, peers punch through to it"""
+        if not self.udp_token:
+            return
+        endpoint = self.udp.register((self.relay_server_ip, self.relay_server_port), self.peer_id, self.udp_token)
+        if endpoint is None:
+            logger.info("Relay did not answer UDP endpoint registration, hole punching unavailable")
     
     def _relay_receiver(self):
-        """Handle messages from the relay server"""
+        """Run the relay client's reader, and be the one place that reconnects when it drops"""
+        delay = RECONNECT_DELAY
         while self.running:
-            if not self.cloud_connected or not self.relay_connection:
-                time.sleep(1)
-                continue
-                
-            try:
-                self.relay_connection.settimeout(1.0)
-                data = self.relay_connection.recv(4096)
-                if not data:
-                    logger.warning("Lost connection to relay server")
-                    self.cloud_connected = False
-                    time.sleep(5)
-                    self._connect_to_relay()
-                    continue
-                
-                message = json.loads(data.decode('utf-8'))
-                
-                # Handle relayed message
-                if message.get('type') == 'relayed':
-                    sender_id = message.get('sender_id')
-                    content = message.get('content')
-                    sender_ip = message.get('sender_ip')
-                    sender_port = message.get('sender_port')
-                    
-                    # Create/update peer info
-                    if sender_id not in self.relay_peers:
-                        # Create new peer
-                        peer = CloudPeer(sender_ip, sender_port, None, sender_id)
-                        peer.relay_only = True
-                        self.relay_peers[sender_id] = peer
-                    
-                    # Alert about the message
-                    relay_peer = self.relay_peers[sender_id]
-                    relay_peer.last_heartbeat = time.time()
-                    
-                    # Handle special messages
-                    if isinstance(content, dict) and content.get('type') == 'file_transfer':
-                        # Handle file transfer
-                        file_content = base64.b64decode(content.get('data'))
-                        file_name = content.get('filename')
-                        self._alert(Message(f"Received file {file_name} via relay"))
-                        # Assuming the Interface will handle this
-                        self._alert(Message(file_content), str(relay_peer))
-                    else:
-                        # Regular message
-                        self._alert(Message(content), str(relay_peer))
-                
-            except socket.timeout:
-                # This is expected, just continue
-                pass
-            except Exception as e:
-                logger.error(f"Error receiving from relay: {e}")
-                time.sleep(1)
+            client = self.relay_client
+            if self.cloud_connected and client:
+                threading.Thread(target=self._flush_relay_backlog, daemon=True).start()
+                client.run()
+                if not self.running:
+                    break
+                logger.warning("Lost connection to relay server")
+                self.cloud_connected = False
+                delay = RECONNECT_DELAY
+            # Jitter keeps peers dropped together by a relay restart from reconnecting in lockstep
+            time.sleep(delay * random.uniform(0.5, 1.0))
+            if self.running and self._connect_to_relay():
+                delay = RECONNECT_DELAY
+            else:
+                delay = min(delay * 2, MAX_RECONNECT_DELAY)
+    
+    def _send_or_queue(self, send):
+        """Run send() on the relay link, or hold it until the link is back. Returns True once either happened"""
+        with self.relay_backlog_lock:
+            if self.cloud_connected and not self.relay_backlog:
+                try:
+                    send()
+                    return True
+                except OSError as e:
+                    logger.warning(f"Relay send failed, queueing until reconnected: {e}")
+            if len(self.relay_backlog) == self.relay_backlog.maxlen:
+                logger.warning("Relay backlog full, dropping the oldest queued message")
+            self.relay_backlog.append(send)
+            return True
+    
+    def _flush_relay_backlog(self):
+        """Send what queued up while the relay was unreachable, in order"""
+        with self.relay_backlog_lock:
+            if self.relay_backlog:
+                logger.info(f"Sending {len(self.relay_backlog)} messages queued while disconnected")
+            while self.relay_backlog and self.cloud_connected:
+                try:
+                    self.relay_backlog[0]()
+                except OSError as e:
+                    logger.warning(f"Relay dropped again while sending the backlog: {e}")
+                    return  # The rest goes after the next reconnect
+                except Exception as e:
+                    logger.error(f"Error sending queued relay message: {e}")
+                self.relay_backlog.popleft()
+    
+    def _handle_relay_message(self, message):
+        """Handle a message the relay sent on its own rather than in reply to a request"""
+        if message.get('type') == 'membership':
+            self._apply_membership_push(message)
+            return
+        if message.get('type') == 'punch':
+            # Probing takes a while, keep the relay reader free
+            threading.Thread(target=self._answer_punch, args=(message,), daemon=True).start()
+            return
+        
+        # Handle relayed message
+        if message.get('type') == 'relayed':
+            sender_id = message.get('sender_id')
+            content = message.get('content')
+            sender_ip = message.get('sender_ip')
+            sender_port = message.get('sender_port')
+            
+            # Create/update peer info
+            if sender_id not in self.relay_peers:
+                # Create new peer
+                peer = CloudPeer(sender_ip, sender_port, None, sender_id)
+                peer.relay_only = True
+                self.relay_peers[sender_id] = peer
+            
+            # Alert about the message
+            relay_peer = self.relay_peers[sender_id]
+            relay_peer.last_heartbeat = time.time()
+            
+            # Handle special messages
+            if isinstance(content, dict) and content.get('type') == 'hello_challenge':
+                self._answer_hello_challenge(relay_peer, content.get('nonce'))
+            elif isinstance(content, dict) and content.get('type') == 'frame':
+                # Tagged transfer/swarm frame tunnelled through the relay
+                frame = base64.b64decode(content.get('frame'))
+                self._handle_tagged_frame(frame, sender_id, str(relay_peer), relay_peer in self.peerList)
+            else:
+                # Regular message
+                self._alert(Message(content), str(relay_peer))
+    
+    def _routed_received(self, sender_id, payload):
+        """A frame relayed through the fast path, handled like one arriving on a direct connection"""
+        relay_peer = self.relay_peers.get(sender_id)
+        if relay_peer is None:
+            # Routed frames carry no address, membership tells us who this is
+            if not self.peers_resync_pending:
+                self._request_relay_peers()
+            name = sender_id
+        else:
+            relay_peer.last_heartbeat = time.time()
+            name = str(relay_peer)
+        frame = bytes(payload)
+        if not self._handle_tagged_frame(frame, sender_id, name, relay_peer in self.peerList):
+            self._alert(Message(frame.decode('utf-8', errors='replace')), name)
     
     def _get_relay_peers(self):
-        """Get list of peers from relay server"""
+        """Bring relay_peers up to date, asking only for changes since the last known version"""
         if not self.cloud_connected:
             return
             
         try:
-            # Request peer list
-            peer_request = {
-                'command': 'get_peers',
-                'peer_id': self.peer_id
-            }
-            self.relay_connection.sendall(json.dumps(peer_request).encode('utf-8'))
+            self._request_relay_peers().result(5.0)
+        except Exception as e:
+            logger.error(f"Error getting peers from relay: {e}")
+    
+    def _request_relay_peers(self):
+        """Ask for the changes since our version, the reply is applied whenever it arrives"""
+        peer_request = {
+            'command': 'get_peers',
+            'peer_id': self.peer_id,
+            'epoch': self.peers_epoch,
+            'since': self.peers_version
+        }
+        self.peers_resync_pending = True
+        applied = Future()  # Resolves once relay_peers reflects the reply
+        
+        def received(reply):
+            try:
+                response = reply.result()
+                if response.get('status') == 'success':
+                    self._apply_peer_list(response)
+                applied.set_result(response)
+            except Exception as e:
+                logger.warning(f"Peer list request failed: {e}")
+                applied.set_exception(e)
+        
+        self.relay_client.request_async(peer_request).add_done_callback(received)
+        return applied
+    
+    def _apply_peer_list(self, response):
+        """Apply a get_peers answer, either a full snapshot or the changes since our version"""
+        if response.get('full', True):
+            peers = response.get('peers', [])
+            current = set(peer_info.get('peer_id') for peer_info in peers)
+            removed = [peer_id for peer_id in self.relay_peers if peer_id not in current]
+            self._apply_membership(peers, removed)
+        else:
+            self._apply_membership(response.get('added', []), response.get('removed', []))
+        self.peers_epoch = response.get('epoch')
+        self.peers_version = response.get('version')
+        self.peers_resync_pending = False
+    
+    def _apply_membership_push(self, update):
+        """Apply one pushed change, or resync when it does not follow on from our version"""
+        if update.get('epoch') != self.peers_epoch or update.get('base') != self.peers_version:
+            # Missed a change or the relay restarted, a delta or full snapshot catches us up
+            if not self.peers_resync_pending:
+                self._request_relay_peers()
+            return
+        self._apply_membership(update.get('added', []), update.get('removed', []))
+        self.peers_version = update.get('version')
+    
+    def _apply_membership(self, added, removed):
+        for peer_info in added:
+            peer_id = peer_info.get('peer_id')
+            if peer_id == self.peer_id or peer_id in self.relay_peers:
+                continue
+            peer = CloudPeer(peer_info.get('ip'), peer_info.get('port'), None, peer_id)
+            peer.relay_only = True  # Start with relay only until direct connection verified
+            self.relay_peers[peer_id] = peer
+            logger.info(f"Discovered new peer via relay: {peer}")
+        for peer_id in removed:
+            peer = self.relay_peers.get(peer_id)
+            if peer is None or peer.connection:
+                # Direct connections outlive the peer's relay registration
+                continue
+            del self.relay_peers[peer_id]
+            if peer in self.unconfirmedList:
+                self.unconfirmedList.remove(peer)
+            if peer in self.peerList:
+                self.peerList.remove(peer)
+                self.swarm.peer_lost(peer_id)
+                self.tasks.peer_lost(peer_id)
+            logger.info(f"Peer left the relay: {peer}")
+    
+    def find_peers(self, count, min_cores=1, min_memory_mb=None, runtime=None):
+        """Ask the relay for the least-loaded peers with at least min_cores, returns CloudPeers"""
+        if not self.cloud_connected:
+            return []
             
-            # Get response (with short timeout)
-            self.relay_connection.settimeout(5.0)
-            response = json.loads(self.relay_connection.recv(4096).decode('utf-8'))
-            self.relay_connection.settimeout(None)
+        try:
+            request = {
+                'command': 'find_peers',
+                'peer_id': self.peer_id,
+                'count': count,
+                'min_cores': min_cores,
+                'min_memory_mb': min_memory_mb,
+                'runtime': runtime
+            }
+            response = self.relay_client.request(request, timeout=5.0)
             
-            if response.get('status') == 'success':
-                peers = response.get('peers', [])
-                for peer_info in peers:
+            found = []
+            if response and response.get('status') == 'success':
+                for peer_info in response.get('peers', []):
                     peer_id = peer_info.get('peer_id')
-                    ip = peer_info.get('ip')
-                    port = peer_info.get('port')
-                    
-                    # Add to relay peers if new
                     if peer_id not in self.relay_peers:
-                        peer = CloudPeer(ip, port, None, peer_id)
-                        peer.relay_only = True  # Start with relay only until direct connection verified
+                        peer = CloudPeer(peer_info.get('ip'), peer_info.get('port'), None, peer_id)
+                        peer.relay_only = True
                         self.relay_peers[peer_id] = peer
-                        logger.info(f"Discovered new peer via relay: {peer}")
+                    self.relay_peers[peer_id].capabilities = peer_info.get('capabilities', {})
+                    found.append(self.relay_peers[peer_id])
+            return found
                 
         except Exception as e:
-            logger.error(f"Error getting peers from relay: {e}")
+            logger.error(f"Error finding peers through relay: {e}")
+            return []
     
     def connect_to_cloud_peer(self, peer_id):
-        """Connect to a peer known through the relay"""
+        """Connect to a peer known through the relay, reusing a direct connection that is already up"""
         if peer_id not in self.relay_peers:
             self._alert(Message(f"Unknown peer ID: {peer_id}"))
             return False
             
         peer = self.relay_peers[peer_id]
-        
-        # Try direct connection first
-        try:
-            # Create a socket and connect to the peer
-            client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            client_socket.settimeout(5.0)  # Short timeout for connection attempt
-            client_socket.connect((peer.ip, peer.port))
-            client_socket.settimeout(None)
-            
-            # Update peer connection
-            peer.connection = client_socket
-            peer.relay_only = False
-            
-            # Move from relay_peers to peerList if not already there
-            if peer not in self.peerList:
-                self.peerList.append(peer)
-                
-            self._alert(Message(f"Connected directly to {peer}"))
+        if peer not in self.peerList:
+            self.peerList.append(peer)
+        if self.pool.connect(peer):
             return True
             
-        except Exception as e:
-            logger.warning(f"Direct connection to {peer} failed: {e}")
-            self._alert(Message(f"Direct connection to {peer} failed, will use relay"))
-            
-            # Add to peer list anyway, we'll use relay
-            if peer not in self.peerList:
-                self.peerList.append(peer)
-                
-            return False
+        # Use the relay for now, the pool keeps retrying the direct path with backoff
+        self._alert(Message(f"Direct connection to {peer} failed, will use relay"))
+        peer.relay_only = True
+        self.resume_transfers(peer)
+        return False
     
-    def send_via_relay(self, peer_id, content):
-        """Send a message through the relay server"""
-        if not self.cloud_connected:
-            logger.warning("Cannot send via relay: not connected")
+    def punch(self, peer):
+        """Open a direct UDP path to a peer behind NAT, with the relay introducing us"""
+        if not self.cloud_connected or self.udp.endpoint is None:
             return False
-            
         try:
-            relay_message = {
-                'command': 'relay_message',
-                'peer_id': self.peer_id,
-                'target_id': peer_id,
-                'content': content
-            }
-            self.relay_connection.sendall(json.dumps(relay_message).encode('utf-8'))
-            return True
-            
+            request = {'command': 'punch', 'peer_id': self.peer_id, 'target_id': peer.peer_id}
+            response = self.relay_client.request(request, timeout=5.0)
         except Exception as e:
-            logger.error(f"Error sending via relay: {e}")
+            logger.warning(f"Punch request for {peer} failed: {e}")
             return False
+        if response.get('status') != 'success':
+            logger.info(f"Cannot punch through to {peer}: {response.get('message')}")
+            return False
+        stream = self.udp.punch(response['endpoint'], response['token'])
+        if stream is None:
+            logger.info(f"Hole punching to {peer} timed out")
+            return False
+        self._attach_punched(peer, stream)
+        return True
     
-    def send_file_via_relay(self, peer_id, file_content, filename):
-        """Send a file through the relay server"""
-        # Encode the file content to base64
-        encoded_content = base64.b64encode(file_content).decode('utf-8')
-        
-        # Create a file transfer message
-        file_message = {
-            'type': 'file_transfer',
-            'filename': filename,
-            'data': encoded_content
-        }
-        
-        return self.send_via_relay(peer_id, file_message)
-    
-    def sender(self, message):
-        """Override sender to handle relay-only peers"""
-        if not message:
+    def _answer_punch(self, message):
+        """Probe back at a peer the relay says is punching through to us"""
+        peer_id = message.get('peer_id')
+        stream = self.udp.punch(message.get('endpoint'), message.get('token'))
+        if stream is None:
+            logger.info(f"Hole punching from {peer_id} timed out")
             return
-            
-        # Handle standard peers with direct connection
-        super().sender(message)
-        
-        # Additionally, send to relay-only peers
-        for peer_id, peer in self.relay_peers.items():
-            if peer.relay_only and peer in self.peerList:
-                self.send_via_relay(peer_id, message)
-    
-    def list_cloud_peers(self):
-        """Return a list of discovered cloud peers"""
-        return list(self.relay_peers.values())
+        peer = self.relay_peers.get(peer_id)
+        if peer is None:
+            peer = CloudPeer(message.get('ip'), message.get('port'), None, peer_id)
+            self.relay_peers[peer_id] = peer
+        self._attach_punched(peer, stream)
     
-    def shutdown(self):
-        """Override shutdown to handle cloud resources"""
-        if self.cloud_connected:
+    def _attach_punched(self, peer, stream):
+        """Move a cloud peer off the relay onto a punched UDP path"""
+        if peer.connection and peer.connection is not stream:
+            self._unregister_peer(peer)
+            self._close_outbox(peer.connection)
             try:
-                # Notify relay we're disconnecting
-                disconnect_msg = {
-                    'command': 'disconnect',
-                    'peer_id': self.peer_id
-                }
-                self.relay_connection.sendall(json.dumps(disconnect_msg).encode('utf-8'))
-                self.relay_connection.close()
+                peer.connection.close()
             except:
                 pass
-            
-        self.cloud_connected = False
-        super().shutdown()# CloudP2PPlatform.py
-import socket
-import threading
-import time
-import json
-import logging
-import random
-import uuid
-import base64
-from P2PPlatform import Network, Peer, Message
-
-# Configure logging
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
-logger = logging.getLogger('cloud_p2p')
-
-class CloudPeer(Peer):
-    """Extended Peer class with cloud identity information"""
-    def __init__(self, ip, port=None, connection=None, peer_id=None):
-        super().__init__(ip, port, connection)
-        self.peer_id = peer_id or str(uuid.uuid4())
-        self.relay_only = False  # Flag if we can only communicate via relay
-        self.last_heartbeat = time.time()
+        peer.connection = stream
+        peer.read_buffer = FrameBuffer()
+        peer.relay_only = False
+        peer.last_seen = time.time()
+        peer.codec = None
+        stream.start(lambda data: self._stream_received(peer, stream, data),
+                     lambda reason: self._stream_closed(peer, stream, reason))
+        self._offer_codecs(peer)
+        if peer not in self.peerList and peer not in self.unconfirmedList:
+            # Like an inbound connection, a peer that punched through to us waits for approval
+            self.unconfirmedList.append(peer)
+        self.pool.forget(peer.peer_id)
+        self._alert(Message(f"Connected to {peer} through a punched UDP path"))
+        self.resume_transfers(peer)
     
-    def __str__(self):
-        if self.name:
-            return f"{self.name} ({self.ip}:{self.port})"
-        return f"{self.ip}:{self.port} [{self.peer_id[:8]}]"
-
-class CloudNetwork(Network):
-    """Extended Network class with cloud functionality"""
-    def __init__(self, ip, port, relay_server_ip, relay_server_port=12345):
-        super().__init__(ip, port)
-        
-        # Cloud specific attributes
-        self.relay_server_ip = relay_server_ip
-        self.relay_server_port = relay_server_port
-        self.relay_connection = None
-        self.peer_id = None
-        self.cloud_connected = False
-        self.relay_peers = {}  # Peers known through relay {peer_id: CloudPeer}
-        
-        # Start cloud connection
-        self._connect_to_relay()
-        
-        # Start heartbeat thread
-        self.heartbeat_thread = threading.Thread(target=self._heartbeat_loop)
-        self.heartbeat_thread.daemon = True
-        self.heartbeat_thread.start()
-        
-        # Start relay receiver thread
-        self.relay_receiver_thread = threading.Thread(target=self._relay_receiver)
-        self.relay_receiver_thread.daemon = True
-        self.relay_receiver_thread.start()
-    
-    def _connect_to_relay(self):
-        """Connect to relay server and register this peer"""
+    def _stream_received(self, peer, stream, data):
+        if peer.connection is not stream:
+            return
         try:
-            # Create a socket connection to the relay server
-            self.relay_connection = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.relay_connection.connect((self.relay_server_ip, self.relay_server_port))
-            
-            # Register with relay server
-            registration = {
-                'command': 'register',
-                'ip': self.ip,
-                'port': self.port
-            }
-            self.relay_connection.sendall(json.dumps(registration).encode('utf-8'))
-            
-            # Get response
-            response = json.loads(self.relay_connection.recv(4096).decode('utf-8'))
-            if response.get('status') == 'success':
-                self.peer_id = response.get('peer_id')
-                self.cloud_connected = True
-                logger.info(f"Connected to relay server. Assigned ID: {self.peer_id}")
-                self._alert(Message(f"Connected to cloud relay at {self.relay_server_ip}:{self.relay_server_port}"))
-                return True
-            else:
-                logger.error(f"Failed to register with relay server: {response.get('message')}")
-                self._alert(Message(f"Failed to connect to cloud relay: {response.get('message')}"))
-                return False
-                
+            frames = peer.read_buffer.feed(data)
         except Exception as e:
-            logger.error(f"Error connecting to relay server: {e}")
-            self._alert(Message(f"Failed to connect to cloud relay: {e}"))
-            self.relay_connection = None
-            return False
+            self._drop_peer(peer, f"Lost connection with {peer}: {e}")
+            return
+        self._handle_frames(peer, frames)
     
-    def _heartbeat_loop(self):
-        """Send regular heartbeats to the relay server"""
-        while self.running and self.cloud_connected:
-            try:
-                if self.relay_connection and self.peer_id:
-                    heartbeat = {
-                        'command': 'heartbeat',
-                        'peer_id': self.peer_id
-                    }
-                    self.relay_connection.sendall(json.dumps(heartbeat).encode('utf-8'))
-                    
-                    # Update peer list every 5 heartbeats
-                    if random.random() < 0.2:  # 20% chance per heartbeat
-                        self._get_relay_peers()
-                
-                time.sleep(30)  # Heartbeat every 30 seconds
-                
-            except Exception as e:
-                logger.warning(f"Heartbeat failed: {e}")
-                # Try to reconnect
-                self.cloud_connected = False
-                time.sleep(5)
-                self._connect_to_relay()
+    def _stream_closed(self, peer, stream, reason):
+        if peer.connection is stream:
+            self._drop_peer(peer, f"Punched path to {peer} closed: {reason}")
     
-    def _relay_receiver(self):
-        """Handle messages from the relay server"""
-        while self.running:
-            if not self.cloud_connected or not self.relay_connection:
-                time.sleep(1)
-                continue
-                
+    def _attach_direct(self, peer, sock, initiator=False):
+        """Move a cloud peer off the relay onto a direct socket"""
+        if peer.connection and peer.connection is not sock:
+            self._unregister_peer(peer)
+            self._close_outbox(peer.connection)
             try:
-                self.relay_connection.settimeout(1.0)
-                data = self.relay_connection.recv(4096)
-                if not data:
-                    logger.warning("Lost connection to relay server")
-                    self.cloud_connected = False
-                    time.sleep(5)
-                    self._connect_to_relay()
-                    continue
-                
-                message = json.loads(data.decode('utf-8'))
-                
-                # Handle relayed message
-                if message.get('type') == 'relayed':
-                    sender_id = message.get('sender_id')
-                    content = message.get('content')
-                    sender_ip = message.get('sender_ip')
-                    sender_port = message.get('sender_port')
-                    
-                    # Create/update peer info
-                    if sender_id not in self.relay_peers:
-                        # Create new peer
-                        peer = CloudPeer(sender_ip, sender_port, None, sender_id)
-                        peer.relay_only = True
-                        self.relay_peers[sender_id] = peer
-                    
-                    # Alert about the message
-                    relay_peer = self.relay_peers[sender_id]
-                    relay_peer.last_heartbeat = time.time()
-                    
-                    # Handle special messages
-                    if isinstance(content, dict) and content.get('type') == 'file_transfer':
-                        # Handle file transfer
-                        file_content = base64.b64decode(content.get('data'))
-                        file_name = content.get('filename')
-                        self._alert(Message(f"Received file {file_name} via relay"))
-                        # Assuming the Interface will handle this
-                        self._alert(Message(file_content), str(relay_peer))
-                    else:
-                        # Regular message
-                        self._alert(Message(content), str(relay_peer))
-                
-            except socket.timeout:
-                # This is expected, just continue
+                peer.connection.close()
+            except:
                 pass
+        peer.connection = sock
+        peer.read_buffer = FrameBuffer()
+        peer.relay_only = False
+        peer.last_seen = time.time()
+        peer.codec = None  # Until the other end's codec offer arrives on this connection
+        if peer not in self.peerList:
+            self.peerList.append(peer)
+        if initiator:
+            # The hello doubles as our codec offer, the other side may move it onto another peer object
+            hello = HELLO_TAG + json.dumps({'peer_id': self.peer_id, 'codecs': available_codecs()}).encode('utf-8')
+            self._send_to_peer(peer, encode_frame(hello))
+        self._register_peer(peer)
+        self._alert(Message(f"Connected directly to {peer}"))
+        self.resume_transfers(peer)
+    
+    def _handle_control_frame(self, frame, peer):
+        """Override _handle_control_frame to recognise cloud peers connecting to us directly"""
+        if frame.startswith(HELLO_TAG):
+            try:
+                hello = json.loads(bytes(frame[len(HELLO_TAG):]).decode('utf-8'))
+                peer.codec = negotiate(hello.get('codecs'))
+                self._challenge_hello(peer, hello.get('peer_id'))
             except Exception as e:
-                logger.error(f"Error receiving from relay: {e}")
-                time.sleep(1)
+                logger.warning(f"Bad hello from {peer}: {e}")
+            return True
+        if frame.startswith(HELLO_PROOF_TAG):
+            try:
+                proof = json.loads(bytes(frame[len(HELLO_PROOF_TAG):]).decode('utf-8'))
+                self._check_hello_proof(peer, proof.get('nonce'))
+            except Exception as e:
+                logger.warning(f"Bad hello proof from {peer}: {e}")
+            return True
+        return super()._handle_control_frame(frame, peer)
     
-    def _get_relay_peers(self):
-        """Get list of peers from relay server"""
-        if not self.cloud_connected:
+    def _handle_frames(self, peer, frames):
+        """Override _handle_frames to forget adopted connections once their read is handled"""
+        super()._handle_frames(peer, frames)
+        if self.adopted:
+            self.adopted.pop(peer, None)
+    
+    def _handle_frame(self, peer, frame):
+        """Override _handle_frame to hold back what a connection sends until its hello is proven"""
+        peer = self.adopted.get(peer, peer)
+        challenge = self.hello_challenges.get(peer)
+        if challenge is None:
+            return super()._handle_frame(peer, frame)
+        if self._handle_control_frame(frame, peer):
             return
-            
-        try:
-            # Request peer list
-            peer_request = {
-                'command': 'get_peers',
-                'peer_id': self.peer_id
-            }
-            self.relay_connection.sendall(json.dumps(peer_request).encode('utf-8'))
-            
-            # Get response (with short timeout)
-            self.relay_connection.settimeout(5.0)
-            response = json.loads(self.relay_connection.recv(4096).decode('utf-8'))
-            self.relay_connection.settimeout(None)
-            
-            if response.get('status') == 'success':
-                peers = response.get('peers', [])
-                for peer_info in peers:
-                    peer_id = peer_info.get('peer_id')
-                    ip = peer_info.get('ip')
-                    port = peer_info.get('port')
-                    
-                    # Add to relay peers if new
-                    if peer_id not in self.relay_peers:
-                        peer = CloudPeer(ip, port, None, peer_id)
-                        peer.relay_only = True  # Start with relay only until direct connection verified
-                        self.relay_peers[peer_id] = peer
-                        logger.info(f"Discovered new peer via relay: {peer}")
-                
-        except Exception as e:
-            logger.error(f"Error getting peers from relay: {e}")
+        if len(challenge.held) < HELLO_HELD_FRAMES and time.time() < challenge.deadline:
+            challenge.held.append(frame)
+            return
+        # Whatever it is, it stays an unconfirmed connection
+        logger.warning(f"{peer} never proved it is {challenge.peer_id}")
+        del self.hello_challenges[peer]
+        for held in challenge.held + [frame]:
+            super()._handle_frame(peer, held)
     
-    def connect_to_cloud_peer(self, peer_id):
-        """Connect to a peer known through the relay"""
-        if peer_id not in self.relay_peers:
-            self._alert(Message(f"Unknown peer ID: {peer_id}"))
-            return False
-            
-        peer = self.relay_peers[peer_id]
-        
-        # Try direct connection first
+    def _challenge_hello(self, peer, peer_id):
+        """Have the cloud peer a hello names prove, through the relay, that it opened this connection.
+
+        Anyone can connect and claim an id, only the peer holding it hears our nonce from the
+        relay and can echo it back over the connection.
+        """
+        if (not isinstance(peer_id, str) or peer_id == self.peer_id or isinstance(peer, CloudPeer)
+                or getattr(peer, 'peer_id', None) or peer in self.hello_challenges):
+            return
+        challenge = self.hello_challenges[peer] = HelloChallenge(peer_id)
+        if not self.send_via_relay(peer_id, {'type': 'hello_challenge', 'nonce': challenge.nonce}, ack=False):
+            self.hello_challenges.pop(peer, None)
+    
+    def _answer_hello_challenge(self, peer, nonce):
+        """Echo a nonce over our direct connection to peer, proving the hello on it came from us"""
+        if not peer.connection or peer.relay_only or not isinstance(nonce, str):
+            return
+        proof = HELLO_PROOF_TAG + json.dumps({'nonce': nonce}).encode('utf-8')
         try:
-            # Create a socket and connect to the peer
-            client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            client_socket.settimeout(5.0)  # Short timeout for connection attempt
-            client_socket.connect((peer.ip, peer.port))
-            client_socket.settimeout(None)
-            
-            # Update peer connection
-            peer.connection = client_socket
-            peer.relay_only = False
-            
-            # Move from relay_peers to peerList if not already there
-            if peer not in self.peerList:
-                self.peerList.append(peer)
-                
-            self._alert(Message(f"Connected directly to {peer}"))
-            return True
-            
+            self._send_to_peer(peer, encode_frame(proof))
         except Exception as e:
-            logger.warning(f"Direct connection to {peer} failed: {e}")
-            self._alert(Message(f"Direct connection to {peer} failed, will use relay"))
-            
-            # Add to peer list anyway, we'll use relay
-            if peer not in self.peerList:
-                self.peerList.append(peer)
-                
-            return False
+            logger.warning(f"Error answering hello challenge from {peer}: {e}")
     
-    def send_via_relay(self, peer_id, content):
-        """Send a message through the relay server"""
-        if not self.cloud_connected:
-            logger.warning("Cannot send via relay: not connected")
-            return False
-            
+    def _check_hello_proof(self, peer, nonce):
+        challenge = self.hello_challenges.get(peer)
+        if challenge is None or nonce != challenge.nonce:
+            logger.warning(f"Unexpected hello proof from {peer}")
+            return
+        del self.hello_challenges[peer]
+        cloud_peer = self._adopt_connection(peer, challenge.peer_id)
+        if cloud_peer is not None:
+            self.adopted[peer] = cloud_peer
+        for frame in challenge.held:
+            self._handle_frame(cloud_peer or peer, frame)
+    
+    def _refuse_frame(self, frame, peer_key, peer):
+        """Override _refuse_frame to let relay senders be approved like inbound connections"""
+        relay_peer = self.relay_peers.get(peer_key)
+        if (relay_peer is not None and relay_peer not in self.peerList
+                and not any(self._transfer_key(p) == peer_key for p in self.unconfirmedList)):
+            self.unconfirmedList.append(relay_peer)
+        super()._refuse_frame(frame, peer_key, peer)
+    
+    def approve(self, peer):
+        """Override approve to also accept relay peers that never sent us anything"""
+        if peer not in self.unconfirmedList and peer not in self.peerList and peer in self.relay_peers.values():
+            self.unconfirmedList.append(peer)
+        super().approve(peer)
+    
+    def _adopt_connection(self, peer, peer_id):
+        """Hand a connection proven to come from peer_id to its cloud peer, returns that peer or None"""
+        # Frames already read from this socket are keyed by the cloud identity from here on
+        peer.peer_id = peer_id
+        cloud_peer = self.relay_peers.get(peer_id)
+        if cloud_peer is None or cloud_peer is peer or cloud_peer.connection or cloud_peer not in self.peerList:
+            return None
+        # A peer we only reached through the relay connected to us, talk to it over this socket
+        for peers in (self.unconfirmedList, self.peerList):
+            if peer in peers:
+                peers.remove(peer)
+        cloud_peer.connection = peer.connection
+        cloud_peer.read_buffer = peer.read_buffer
+        cloud_peer.codec = peer.codec
+        cloud_peer.relay_only = False
+        cloud_peer.last_seen = time.time()
+        peer.connection = None
+        self._register_peer(cloud_peer)
+        self.pool.forget(peer_id)
+        self._alert(Message(f"{cloud_peer} connected directly"))
+        return cloud_peer
+    
+    def _drop_peer(self, peer, reason):
+        """Override _drop_peer to fall back to the relay instead of forgetting a cloud peer"""
+        self.hello_challenges.pop(peer, None)
+        if not isinstance(peer, CloudPeer) or not self.cloud_connected or peer.peer_id not in self.relay_peers:
+            return super()._drop_peer(peer, reason)
+        self._unregister_peer(peer)
         try:
+            if peer.connection:
+                self._close_outbox(peer.connection)
+                peer.connection.close()
+        except:
+            pass
+        peer.connection = None
+        if not peer.relay_only:
+            peer.relay_only = True
+            self.pool.schedule_retry(peer.peer_id)
+            self._alert(Message(f"{reason}, using relay"))
+    
+    def send_via_relay(self, peer_id, content, ack=True):
+        """Send a message through the relay server, ack=False skips the relay's reply.
+
+        While the relay is unreachable the message is queued and goes out after reconnecting.
+        """
+        def send():
+            if self.relay_fast_path and isinstance(content, str):
+                return self._route_via_relay([peer_id], content.encode('utf-8'), peer_id if ack else None)
             relay_message = {
                 'command': 'relay_message',
                 'peer_id': self.peer_id,
                 'target_id': peer_id,
                 'content': content
             }
-            self.relay_connection.sendall(json.dumps(relay_message).encode('utf-8'))
-            return True
-            
+            if ack:
+                # Don't wait for the ack, relayed traffic keeps flowing while it is in flight
+                self._relay_request(relay_message, peer_id)
+            else:
+                relay_message['ack'] = False
+                self.relay_client.send(relay_message)
+        
+        try:
+            return self._send_or_queue(send)
         except Exception as e:
             logger.error(f"Error sending via relay: {e}")
             return False
     
-    def send_file_via_relay(self, peer_id, file_content, filename):
-        """Send a file through the relay server"""
-        # Encode the file content to base64
-        encoded_content = base64.b64encode(file_content).decode('utf-8')
+    def multicast_via_relay(self, peer_ids, content, ack=True):
+        """Send one message to many peers, uploaded to the relay once"""
+        if not peer_ids:
+            return True
+        peer_ids = list(peer_ids)
         
-        # Create a file transfer message
-        file_message = {
-            'type': 'file_transfer',
-            'filename': filename,
-            'data': encoded_content
-        }
+        def send():
+            if self.relay_fast_path and isinstance(content, str):
+                target = f"{len(peer_ids)} peers" if ack else None
+                return self._route_via_relay(peer_ids, content.encode('utf-8'), target)
+            multicast = {
+                'command': 'multicast',
+                'peer_id': self.peer_id,
+                'target_ids': peer_ids,
+                'content': content
+            }
+            if ack:
+                # A single ack lists whichever targets could not be reached
+                self._relay_request(multicast, f"{len(peer_ids)} peers")
+            else:
+                multicast['ack'] = False
+                self.relay_client.send(multicast)
         
-        return self.send_via_relay(peer_id, file_message)
+        try:
+            return self._send_or_queue(send)
+        except Exception as e:
+            logger.error(f"Error multicasting via relay: {e}")
+            return False
+    
+    def _route_via_relay(self, peer_ids, payload, acked_target=None):
+        """Send through the relay's fast path, ack reports go to _relay_acked under acked_target"""
+        if acked_target is None:
+            self.relay_client.route(peer_ids, payload)
+        else:
+            self._relay_acked_later(self.relay_client.route_async(peer_ids, payload), acked_target)
+        return True
+    
+    def _relay_request(self, message, target):
+        self._relay_acked_later(self.relay_client.request_async(message), target)
+    
+    def _relay_acked_later(self, reply, target):
+        # A request that could not even be written fails right away, raise so it gets queued
+        if reply.done() and isinstance(reply.exception(), OSError):
+            raise reply.exception()
+        reply.add_done_callback(lambda done: self._relay_acked(target, done))
+    
+    def _relay_acked(self, target, reply):
+        try:
+            response = reply.result()
+        except Exception as e:
+            logger.warning(f"No ack for message relayed to {target}: {e}")
+            return
+        if response.get('status') != 'success':
+            logger.warning(f"Relay to {target} failed: {response.get('message')}")
+        elif response.get('failed'):
+            logger.warning(f"Relay could not reach {', '.join(response['failed'])}")
+    
+    def send_file_via_relay(self, peer_id, path):
+        """Stream a file through the relay server one chunk at a time"""
+        send = lambda data: self._send_frame_via_relay(peer_id, data)
+        return self.transfers.send_file(path, send, str(self.relay_peers.get(peer_id, peer_id)), peer_id)
+    
+    def resume_transfers(self, peer):
+        """Override resume_transfers to pick the direct or relay path for the peer"""
+        if not isinstance(peer, CloudPeer) or not peer.relay_only:
+            return super().resume_transfers(peer)
+        send = lambda data: self._send_frame_via_relay(peer.peer_id, data)
+        return self.transfers.resume(peer.peer_id, send, str(peer))
+    
+    def _send_frame_via_relay(self, peer_id, data):
+        # Tagged protocols acknowledge end to end, the relay's own ack would be redundant.
+        # They also resume on their own, so frames fail while disconnected rather than queue.
+        if not self.cloud_connected:
+            raise ConnectionError("Not connected to the relay")
+        if self.relay_fast_path:
+            try:
+                self.relay_client.route([peer_id], data)
+                return
+            except Exception as e:
+                raise ConnectionError(f"Relay send failed: {e}")
+        # Older relays only take JSON content, so each tagged frame travels base64 encoded
+        frame_message = {
+            'type': 'frame',
+            'frame': base64.b64encode(data).decode('ascii')
+        }
+        if not self.send_via_relay(peer_id, frame_message, ack=False):
+            raise ConnectionError("Relay send failed")
+    
+    def _reachable_keys(self):
+        """Override _reachable_keys to include relay-only peers"""
+        keys = super()._reachable_keys()
+        for peer_id, peer in list(self.relay_peers.items()):
+            if peer.relay_only and peer in self.peerList:
+                keys.append(peer_id)
+        return keys
+    
+    def _send_to_key(self, peer_key, frame):
+        """Override _send_to_key to reach relay-only peers through the relay"""
+        peer = self.relay_peers.get(peer_key)
+        if peer is None or not peer.relay_only:
+            return super()._send_to_key(peer_key, frame)
+        self._send_frame_via_relay(peer_key, frame)
+    
+    def send_file(self, path):
+        """Override send_file to also stream to relay-only peers"""
+        transfers = super().send_file(path)
+        for peer_id, peer in list(self.relay_peers.items()):
+            if peer.relay_only and peer in self.peerList:
+                transfers.append(self.send_file_via_relay(peer_id, path))
+        return transfers
     
     def sender(self, message):
         """Override sender to handle relay-only peers"""
@@ -585,15 +859,24 @@ class CloudNetwork(Network):
         # Handle standard peers with direct connection
         super().sender(message)
         
-        # Additionally, send to relay-only peers
-        for peer_id, peer in self.relay_peers.items():
-            if peer.relay_only and peer in self.peerList:
-                self.send_via_relay(peer_id, message)
+        # Additionally, send to relay-only peers, one upload however many there are
+        relay_only = [peer_id for peer_id, peer in list(self.relay_peers.items())
+                      if peer.relay_only and peer in self.peerList]
+        self.multicast_via_relay(relay_only, message)
     
     def list_cloud_peers(self):
         """Return a list of discovered cloud peers"""
         return list(self.relay_peers.values())
     
+    def compression_stats(self):
+        """Per-peer compression stats, plus the relay connection's"""
+        stats = super().compression_stats()
+        connection = self.relay_connection
+        if connection is not None:
+            stats['relay'] = dict(connection.compression.as_dict(),
+                                  codec=connection.codec.name if connection.codec else None)
+        return stats
+    
     def shutdown(self):
         """Override shutdown to handle cloud resources"""
         if self.cloud_connected:
@@ -603,10 +886,11 @@ class CloudNetwork(Network):
                     'command': 'disconnect',
                     'peer_id': self.peer_id
                 }
-                self.relay_connection.sendall(json.dumps(disconnect_msg).encode('utf-8'))
-                self.relay_connection.close()
+                self.relay_client.send(disconnect_msg)
+                self.relay_client.close()
             except:
                 pass
             
         self.cloud_connected = False
-        super().shutdown()
\ No newline at end of file
+        super().shutdown()
+        self.udp.close()
@@ -0,0 +1,151 @@
+import json
+import threading
+import time
+import zlib
+
+try:
+    import zstandard
+except ImportError:  # Optional, zlib is always there
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:  # Optional, zlib is always there
+    lz4 = None
+
+# A compressed frame is the tag, one codec id byte, then the codec's output.
+# Frames that merely start with the tag are sent wrapped as STORED so they never get misread.
+COMPRESSED_TAG = b"<zip>"
+OFFER_TAG = b"<codecs>"  # Control frame listing the codecs a peer can decode
+COMPRESS_THRESHOLD = 512  # Smaller payloads don't shrink enough to pay for the CPU
+STORED = 0
+MAX_DECOMPRESSED_SIZE = 64 * 1024 * 1024  # Same as the largest frame accepted uncompressed
+
+class CompressionError(Exception):
+    pass
+
+class Codec:
+    def __init__(self, name, codec_id, compress, decompress):
+        self.name = name
+        self.codec_id = codec_id
+        self.compress = compress
+        self.decompress = decompress  # decompress(data, max_size)
+
+def _zlib_decompress(data, max_size):
+    decompressor = zlib.decompressobj()
+    output = decompressor.decompress(data, max_size)
+    if decompressor.unconsumed_tail:
+        raise CompressionError(f"Decompressed frame exceeds {max_size} bytes")
+    return output
+
+def _lz4_decompress(data, max_size):
+    # Stops one byte past the limit, so a small frame can never inflate into a huge buffer
+    decompressor = lz4.frame.LZ4FrameDecompressor()
+    output = decompressor.decompress(data, max_size + 1)
+    if len(output) > max_size:
+        raise CompressionError(f"Decompressed frame exceeds {max_size} bytes")
+    if not decompressor.eof:
+        raise CompressionError("Truncated lz4 frame")
+    return output
+
+CODECS = {'zlib': Codec('zlib', 1, lambda data: zlib.compress(data, 6), _zlib_decompress)}
+if zstandard is not None:
+    CODECS['zstd'] = Codec('zstd', 2, zstandard.ZstdCompressor(level=3).compress,
+                           lambda data, max_size: zstandard.ZstdDecompressor().decompress(data, max_output_size=max_size))
+if lz4 is not None:
+    CODECS['lz4'] = Codec('lz4', 3, lz4.frame.compress, _lz4_decompress)
+CODECS_BY_ID = {codec.codec_id: codec for codec in CODECS.values()}
+PREFERENCE = ('zstd', 'lz4', 'zlib')  # Both ends pick the first one they share, so they agree
+
+def available_codecs():
+    return [name for name in PREFERENCE if name in CODECS]
+
+def negotiate(offered):
+    """The codec to use with a peer offering these names, None if there is none in common"""
+    for name in PREFERENCE:
+        if name in CODECS and name in (offered or ()):
+            return CODECS[name]
+    return None
+
+def encode_offer():
+    return OFFER_TAG + json.dumps(available_codecs()).encode('utf-8')
+
+def decode_offer(frame):
+    return negotiate(json.loads(bytes(frame[len(OFFER_TAG):]).decode('utf-8')))
+
+def is_compressed(frame):
+    return frame.startswith(COMPRESSED_TAG)
+
+class CompressionStats:
+    """What compression did on one connection: bytes before and after, and CPU time spent.
+
+    Only payloads big enough to be worth compressing are counted, whether or not they shrank.
+    """
+    def __init__(self):
+        self.raw_sent = 0
+        self.wire_sent = 0
+        self.compress_time = 0.0
+        self.raw_received = 0
+        self.wire_received = 0
+        self.decompress_time = 0.0
+        self.lock = threading.Lock()
+
+    def sent(self, raw, wire, cpu_time=0.0):
+        with self.lock:
+            self.raw_sent += raw
+            self.wire_sent += wire
+            self.compress_time += cpu_time
+
+    def received(self, raw, wire, cpu_time=0.0):
+        with self.lock:
+            self.raw_received += raw
+            self.wire_received += wire
+            self.decompress_time += cpu_time
+
+    def as_dict(self):
+        with self.lock:
+            return {
+                'sent_ratio': self.raw_sent / self.wire_sent if self.wire_sent else None,
+                'received_ratio': self.raw_received / self.wire_received if self.wire_received else None,
+                'bytes_saved': self.raw_sent - self.wire_sent,
+                'compress_time': self.compress_time,
+                'decompress_time': self.decompress_time
+            }
+
+def compress_payload(payload, codec, stats=None, threshold=COMPRESS_THRESHOLD):
+    """Compress a frame payload for a connection using codec, unchanged when that doesn't pay off"""
+    if codec is None:
+        return payload
+    if isinstance(payload, str):
+        payload = payload.encode('utf-8')
+    escaped = payload.startswith(COMPRESSED_TAG)
+    output = payload
+    if len(payload) >= threshold:
+        started = time.thread_time()
+        compressed = codec.compress(payload)
+        cpu_time = time.thread_time() - started
+        if len(compressed) + len(COMPRESSED_TAG) + 1 < len(payload):
+            output = COMPRESSED_TAG + bytes([codec.codec_id]) + compressed
+        if stats is not None:
+            stats.sent(len(payload), len(output), cpu_time)
+    if output is payload and escaped:
+        output = COMPRESSED_TAG + bytes([STORED]) + payload
+    return output
+
+def decompress_payload(frame, stats=None, max_size=MAX_DECOMPRESSED_SIZE):
+    """Undo compress_payload for a frame starting with COMPRESSED_TAG"""
+    view = memoryview(frame)
+    header = len(COMPRESSED_TAG)
+    codec_id = view[header]
+    data = view[header + 1:]
+    started = time.thread_time()
+    if codec_id == STORED:
+        payload = bytes(data)
+    else:
+        codec = CODECS_BY_ID.get(codec_id)
+        if codec is None:
+            raise CompressionError(f"Unknown codec id {codec_id}")
+        payload = codec.decompress(data, max_size)
+    if stats is not None:
+        stats.received(len(payload), len(frame), time.thread_time() - started)
+    return payload
@@ -0,0 +1,106 @@
+import logging
+import random
+import socket
+import threading
+import time
+
+logger = logging.getLogger('connection_pool')
+
+CONNECT_TIMEOUT = 5
+HEALTH_INTERVAL = 15  # Ping a direct connection after this long without hearing from the peer
+PONG_TIMEOUT = 10  # Give up on it when the ping goes unanswered this long
+KEEPALIVE_IDLE = 30
+KEEPALIVE_INTERVAL = 10
+KEEPALIVE_COUNT = 3
+UPGRADE_BACKOFF = 5  # First retry of a failed direct connection, doubled on every failure
+MAX_UPGRADE_BACKOFF = 300
+
+def configure_socket(sock):
+    """Low latency and kernel keepalive, so a dead peer is noticed even on an idle link"""
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    for option, value in (('TCP_KEEPIDLE', KEEPALIVE_IDLE), ('TCP_KEEPINTVL', KEEPALIVE_INTERVAL),
+                          ('TCP_KEEPCNT', KEEPALIVE_COUNT)):
+        if hasattr(socket, option):
+            sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, option), value)
+
+class ConnectionPool:
+    """Direct connections to cloud peers, at most one per peer_id.
+
+    connect() hands back the existing connection when there is one, and falls back to hole
+    punching when the peer cannot be reached over TCP. A maintenance thread pings idle
+    connections, falls back to the relay when one stops answering, and keeps retrying relay-only
+    peers with exponential backoff so traffic leaves the relay once a direct path works.
+    """
+    def __init__(self, network):
+        self.network = network
+        self.retry_at = {}  # Relay-only peers waiting for another attempt {peer_id: (time, backoff)}
+        self.connecting = set()
+        self.lock = threading.Lock()
+        self.maintenance_thread = threading.Thread(target=self._maintenance_loop)
+        self.maintenance_thread.daemon = True
+        self.maintenance_thread.start()
+
+    def connect(self, peer):
+        """Make sure peer has a direct connection, returns False if it has to stay on the relay"""
+        if peer.connection:
+            return True
+        with self.lock:
+            if peer.peer_id in self.connecting:
+                return False
+            self.connecting.add(peer.peer_id)
+        try:
+            try:
+                sock = socket.create_connection((peer.ip, peer.port), CONNECT_TIMEOUT)
+                sock.settimeout(None)
+                configure_socket(sock)
+            except OSError as e:
+                logger.info(f"Direct connection to {peer} failed: {e}")
+                # Behind NAT, the relay can still introduce us for a punched UDP path
+                if not self.network.punch(peer):
+                    self.schedule_retry(peer.peer_id)
+                    return False
+            else:
+                self.network._attach_direct(peer, sock, initiator=True)
+        finally:
+            with self.lock:
+                self.connecting.discard(peer.peer_id)
+        with self.lock:
+            self.retry_at.pop(peer.peer_id, None)
+        return True
+
+    def schedule_retry(self, peer_id):
+        with self.lock:
+            _, backoff = self.retry_at.get(peer_id, (None, UPGRADE_BACKOFF / 2))
+            backoff = min(backoff * 2, MAX_UPGRADE_BACKOFF)
+            # Jitter keeps peers that lost a path at the same moment from retrying in lockstep
+            self.retry_at[peer_id] = (time.time() + backoff * random.uniform(0.8, 1.2), backoff)
+
+    def forget(self, peer_id):
+        with self.lock:
+            self.retry_at.pop(peer_id, None)
+
+    def _maintenance_loop(self):
+        while self.network.running:
+            time.sleep(1)
+            now = time.time()
+            for peer in list(self.network.peerList):
+                peer_id = getattr(peer, 'peer_id', None)
+                if peer_id is None:
+                    continue
+                if peer.connection:
+                    self._check_health(peer, now)
+                elif getattr(peer, 'relay_only', False):
+                    with self.lock:
+                        due = self.retry_at.get(peer_id, (0, None))[0] <= now and peer_id not in self.connecting
+                    if due:
+                        # Attempts can take CONNECT_TIMEOUT, keep them off the maintenance thread
+                        threading.Thread(target=self.connect, args=(peer,), daemon=True).start()
+
+    def _check_health(self, peer, now):
+        idle = now - peer.last_seen
+        if idle > HEALTH_INTERVAL + PONG_TIMEOUT:
+            self.network._drop_peer(peer, f"Direct connection to {peer} stopped responding")
+        elif idle > HEALTH_INTERVAL and now - peer.last_ping > HEALTH_INTERVAL:
+            peer.last_ping = now
+            self.network.ping(peer)
@@ -0,0 +1,169 @@
+import logging
+import os
+import selectors
+import signal
+import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import resource
+except ImportError:  # Not available on Windows, limits other than wall time are skipped there
+    resource = None
+
+logger = logging.getLogger('execution_pool')
+
+READ_SIZE = 65536
+WAIT_POLL = 0.05  # Longest pause between checks on a child that closed its output but runs on
+
+class Limits:
+    """Per-process limits, None leaves a limit unset"""
+    def __init__(self, cpu_seconds=None, wall_seconds=None, memory_mb=None):
+        self.cpu_seconds = cpu_seconds
+        self.wall_seconds = wall_seconds
+        self.memory_mb = memory_mb
+
+    @classmethod
+    def from_requirements(cls, requirements, timeout=None):
+        return cls(requirements.get('cpu_seconds'), timeout, requirements.get('memory_mb'))
+
+class ExecutionResult:
+    """Exit status, collected output and resource usage of one finished process"""
+    def __init__(self, returncode, stdout, stderr, wall_time, cpu_time=None, max_rss_kb=None, error=None):
+        self.returncode = returncode
+        self.stdout = stdout
+        self.stderr = stderr
+        self.wall_time = wall_time
+        self.cpu_time = cpu_time
+        self.max_rss_kb = max_rss_kb
+        self.error = error
+
+    @property
+    def ok(self):
+        return self.returncode == 0 and self.error is None
+
+class ExecutionPool:
+    """Runs programs as concurrent child processes, one per slot.
+
+    Each process gets its own interpreter, so a 32-core host runs 32 tasks at once. Output is
+    handed to on_output(stream, data) as soon as the child writes it, where stream is 'stdout'
+    or 'stderr'; the full output is also returned in the ExecutionResult.
+    """
+    def __init__(self, workers=None, limits=None):
+        self.workers = workers or os.cpu_count() or 1
+        self.limits = limits or Limits()
+        self.executor = ThreadPoolExecutor(max_workers=self.workers)
+
+    def submit(self, args, on_output=None, limits=None, cwd=None, env=None):
+        """Queue a command, returns a Future resolving to an ExecutionResult"""
+        return self.executor.submit(self.run, args, on_output, limits, cwd, env)
+
+    def run(self, args, on_output=None, limits=None, cwd=None, env=None):
+        """Run a command on the calling thread, streaming its output until it exits"""
+        limits = limits or self.limits
+        started = time.time()
+        deadline = started + limits.wall_seconds if limits.wall_seconds is not None else None
+        process = subprocess.Popen(
+            args,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            cwd=cwd,
+            env=dict(os.environ, **env) if env else None,
+            start_new_session=True  # Own process group, so a kill also takes out its children
+        )
+        self._apply_limits(process.pid, limits)
+
+        collected = {'stdout': bytearray(), 'stderr': bytearray()}
+        error = None
+        with selectors.DefaultSelector() as selector:
+            selector.register(process.stdout, selectors.EVENT_READ, 'stdout')
+            selector.register(process.stderr, selectors.EVENT_READ, 'stderr')
+            while selector.get_map():
+                timeout = None
+                if deadline is not None:
+                    timeout = deadline - time.time()
+                    if timeout <= 0:
+                        error = f"Wall time limit of {limits.wall_seconds}s exceeded"
+                        self._kill(process)
+                        break
+                for key, _ in selector.select(timeout):
+                    data = os.read(key.fileobj.fileno(), READ_SIZE)
+                    if not data:
+                        selector.unregister(key.fileobj)
+                        continue
+                    collected[key.data] += data
+                    if on_output is not None:
+                        try:
+                            on_output(key.data, data)
+                        except Exception as e:
+                            logger.warning(f"Output callback failed: {e}")
+        process.stdout.close()
+        process.stderr.close()
+
+        # A child that closed or redirected its output is still held to the wall time limit
+        returncode, usage, timed_out = self._wait(process, deadline)
+        if timed_out and error is None:
+            error = f"Wall time limit of {limits.wall_seconds}s exceeded"
+        if error is None and resource is not None and returncode == -signal.SIGXCPU:
+            error = f"CPU time limit of {limits.cpu_seconds}s exceeded"
+        return ExecutionResult(
+            returncode,
+            bytes(collected['stdout']),
+            bytes(collected['stderr']),
+            time.time() - started,
+            usage.ru_utime + usage.ru_stime if usage else None,
+            usage.ru_maxrss if usage else None,
+            error
+        )
+
+    def _apply_limits(self, pid, limits):
+        # Set from the parent rather than in preexec_fn, which is not safe with threads around
+        if resource is None or not hasattr(resource, 'prlimit'):
+            return
+        try:
+            if limits.cpu_seconds is not None:
+                cpu = int(limits.cpu_seconds)
+                resource.prlimit(pid, resource.RLIMIT_CPU, (cpu, cpu + 1))
+            if limits.memory_mb is not None:
+                memory = int(limits.memory_mb) * 1024 * 1024
+                resource.prlimit(pid, resource.RLIMIT_AS, (memory, memory))
+        except (OSError, ValueError) as e:
+            logger.warning(f"Could not apply limits to process {pid}: {e}")
+
+    def _kill(self, process):
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except (ProcessLookupError, PermissionError, AttributeError):
+            process.kill()
+
+    def _wait(self, process, deadline=None):
+        """Reap the child, with its resource usage where the platform reports it.
+
+        Returns (returncode, usage, timed_out), the process group is killed if the child is
+        still running at deadline.
+        """
+        timed_out = False
+        if not hasattr(os, 'wait4'):
+            try:
+                return process.wait(None if deadline is None else max(deadline - time.time(), 0)), None, False
+            except subprocess.TimeoutExpired:
+                self._kill(process)
+                return process.wait(), None, True
+        delay = 0.0005
+        while True:
+            pid, status, usage = os.wait4(process.pid, 0 if deadline is None or timed_out else os.WNOHANG)
+            if pid:
+                break
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                timed_out = True
+                self._kill(process)
+                continue
+            delay = min(delay * 2, remaining, WAIT_POLL)
+            time.sleep(delay)
+        process.returncode = os.waitstatus_to_exitcode(status)
+        return process.returncode, usage, timed_out
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
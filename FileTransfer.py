@@ -0,0 +1,290 @@
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from ChunkStore import ChunkStore, CHUNK_SIZE, is_digest, manifest_id
+
+logger = logging.getLogger('file_transfer')
+
+# Transfer frames are tagged like <code> messages: tag, JSON header line, then raw chunk bytes
+TRANSFER_TAG = b"<xfer>"
+WINDOW = 8  # Chunks in flight before the sender waits for acks
+STALL_TIMEOUT = 60
+
+def encode_transfer(header, data=b"", tag=TRANSFER_TAG):
+    return tag + json.dumps(header).encode('utf-8') + b"\n" + data
+
+def decode_transfer(frame, tag=TRANSFER_TAG):
+    """Split a transfer frame into its header and a zero-copy view of the chunk bytes"""
+    view = memoryview(frame)
+    newline = frame.index(b"\n", len(tag))
+    header = json.loads(bytes(view[len(tag):newline]).decode('utf-8'))
+    return header, view[newline + 1:]
+
+def is_transfer_frame(frame):
+    return frame.startswith(TRANSFER_TAG)
+
+def unique_path(directory, filename):
+    """Path for a received file that never overwrites an earlier one"""
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, os.path.basename(filename))
+    base, ext = os.path.splitext(path)
+    counter = 1
+    while os.path.exists(path):
+        path = f"{base}.{counter}{ext}"
+        counter += 1
+    return path
+
+class TransferError(Exception):
+    pass
+
+class OutgoingTransfer:
+    """Streams one artifact to one peer, sending only the chunks the receiver reports missing.
+
+    With sendfile(prefix, path, offset, count) given, chunk bytes go from disk to the connection
+    without passing through Python; otherwise every chunk is read and sent through send(frame).
+    """
+    def __init__(self, manifest, store, send, window=WINDOW, sendfile=None):
+        self.transfer_id = uuid.uuid4().hex
+        self.manifest = manifest
+        self.store = store
+        self.send = send
+        self.sendfile = sendfile
+        self.window = window
+        self.chunks = len(manifest['chunks'])
+        self.needed = None  # Filled in by the receiver's have-list
+        self.acked = set()
+        self.resend = []
+        self.error = None
+        self.finished = False
+        self.condition = threading.Condition()
+        self.last_progress = time.time()
+
+    def offer(self):
+        offer = dict(self.manifest)
+        offer.update({'op': 'offer', 'transfer_id': self.transfer_id})
+        return offer
+
+    def run(self):
+        """Send the artifact, blocking until the receiver holds every chunk"""
+        try:
+            self.send(encode_transfer(self.offer()))
+            self._wait(lambda: self.needed is not None)
+            for sent, index in enumerate(self.needed):
+                self._wait(lambda: sent - len(self.acked) < self.window)
+                self._send_chunk(index)
+                self._send_resends()
+            while True:
+                self._wait(lambda: len(self.acked) == len(self.needed) or self.resend)
+                if len(self.acked) == len(self.needed):
+                    break
+                self._send_resends()
+            self.send(encode_transfer({'op': 'done', 'transfer_id': self.transfer_id}))
+        except Exception as e:
+            self.error = e
+            try:
+                self.send(encode_transfer({'op': 'cancel', 'transfer_id': self.transfer_id, 'reason': str(e)}))
+            except Exception:
+                pass
+            raise
+        finally:
+            self.finished = True
+
+    def _wait(self, predicate):
+        with self.condition:
+            while not predicate():
+                if self.error:
+                    raise TransferError(self.error)
+                if time.time() - self.last_progress > STALL_TIMEOUT:
+                    raise TransferError(f"No acknowledgement for {STALL_TIMEOUT}s")
+                self.condition.wait(1.0)
+
+    def _send_chunk(self, index):
+        digest = self.manifest['chunks'][index]
+        header = {
+            'op': 'chunk',
+            'transfer_id': self.transfer_id,
+            'index': index,
+            'digest': digest
+        }
+        if self.sendfile is not None:
+            source = self.store.locate(digest)
+            if source is not None:
+                self.sendfile(encode_transfer(header), *source)
+                return
+        self.send(encode_transfer(header, self.store.read(digest)))
+
+    def _send_resends(self):
+        with self.condition:
+            pending, self.resend = self.resend, []
+        for index in pending:
+            self._send_chunk(index)
+
+    def handle(self, header):
+        """Process a have-list, ack, nack or cancel coming back from the receiver"""
+        with self.condition:
+            op = header.get('op')
+            if op == 'have':
+                have = set(header.get('indexes', []))
+                self.needed = [i for i in range(self.chunks) if i not in have]
+                self.last_progress = time.time()
+            elif op == 'ack':
+                self.acked.add(header['index'])
+                self.last_progress = time.time()
+            elif op == 'nack':
+                self.resend.append(header['index'])
+                self.last_progress = time.time()
+            elif op == 'cancel':
+                self.error = header.get('reason', 'Cancelled by receiver')
+            self.condition.notify_all()
+
+class IncomingTransfer:
+    """Collects an artifact's chunks in the chunk store, then assembles the file"""
+    def __init__(self, offer, store, reply):
+        self.transfer_id = offer['transfer_id']
+        self.manifest = {key: offer[key] for key in ('filename', 'size', 'chunk_size', 'chunks')}
+        # The chunk list names files in the store, check it before anything looks them up
+        chunks = self.manifest['chunks']
+        if not isinstance(chunks, list) or not chunks or not all(is_digest(digest) for digest in chunks):
+            raise TransferError("Offer lists invalid chunk digests")
+        self.manifest_id = manifest_id(self.manifest)
+        if offer.get('manifest_id', self.manifest_id) != self.manifest_id:
+            raise TransferError("Offer's manifest id does not match its chunks")
+        self.filename = os.path.basename(offer['filename']) or self.transfer_id
+        self.store = store
+        self.reply = reply
+        self.missing = set(store.missing(self.manifest))
+
+    def have_list(self):
+        missing = self.missing
+        have = [i for i in range(len(self.manifest['chunks'])) if i not in missing]
+        return {'op': 'have', 'transfer_id': self.transfer_id, 'indexes': have}
+
+    def handle_chunk(self, header, data):
+        index = header['index']
+        if not isinstance(index, int) or not 0 <= index < len(self.manifest['chunks']):
+            logger.warning(f"Chunk index {index!r} out of range in transfer {self.transfer_id}")
+            return
+        digest = self.manifest['chunks'][index]
+        if header.get('digest') != digest or not self.store.put(digest, data):
+            logger.warning(f"Bad chunk {index} in transfer {self.transfer_id}, asking for it again")
+            self.reply(encode_transfer({'op': 'nack', 'transfer_id': self.transfer_id, 'index': index}))
+            return
+        self.missing.discard(index)
+        self.reply(encode_transfer({'op': 'ack', 'transfer_id': self.transfer_id, 'index': index}))
+
+    def complete(self):
+        return not self.missing
+
+    def assemble(self, download_dir):
+        return self.store.assemble(self.manifest, unique_path(download_dir, self.filename))
+
+class TransferManager:
+    """Routes transfer frames for one node, in both directions.
+
+    on_complete(path, peer) is called for every file fully received, on_error(message, peer)
+    for transfers that failed on either side. Chunks live in a content-addressed store, so an
+    interrupted transfer resumes with only the missing chunks and artifacts shared between
+    jobs are never sent twice.
+    """
+    def __init__(self, on_complete, on_error, download_dir='received', store=None):
+        self.on_complete = on_complete
+        self.on_error = on_error
+        self.download_dir = download_dir
+        self.store = store or ChunkStore()
+        self.outgoing = {}
+        self.incoming = {}
+        self.interrupted = {}  # Sends cut short, retried on reconnect {peer_key: set(paths)}
+        self.lock = threading.Lock()
+
+    def send_file(self, path, send, peer=None, peer_key=None, chunk_size=CHUNK_SIZE, sendfile=None):
+        """Start streaming path through send(frame) on a background thread"""
+        manifest = self.store.add_file(path, chunk_size)
+        transfer = OutgoingTransfer(manifest, self.store, send, sendfile=sendfile)
+        with self.lock:
+            self.outgoing[transfer.transfer_id] = transfer
+
+        def run():
+            try:
+                transfer.run()
+                if peer_key is not None:
+                    with self.lock:
+                        self.interrupted.get(peer_key, set()).discard(path)
+            except Exception as e:
+                if peer_key is not None:
+                    with self.lock:
+                        self.interrupted.setdefault(peer_key, set()).add(path)
+                self.on_error(f"Sending {os.path.basename(path)} failed: {e}", peer)
+            finally:
+                with self.lock:
+                    self.outgoing.pop(transfer.transfer_id, None)
+
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        return transfer
+
+    def resume(self, peer_key, send, peer=None, sendfile=None):
+        """Retry every send to peer_key that was interrupted, only missing chunks go out again"""
+        with self.lock:
+            paths = self.interrupted.pop(peer_key, set())
+        return [self.send_file(path, send, peer, peer_key, sendfile=sendfile) for path in paths if os.path.exists(path)]
+
+    def is_reply(self, frame):
+        """Whether frame answers one of our own sends, which any receiver we picked may do"""
+        header, _ = decode_transfer(frame)
+        return header.get('op') in ('have', 'ack', 'nack', 'cancel') and header.get('transfer_id') in self.outgoing
+
+    def refuse(self, frame, reply):
+        """Turn down a frame from a peer we take no files from, a sender's offer is cancelled"""
+        header, _ = decode_transfer(frame)
+        if header.get('op') == 'offer':
+            reply(encode_transfer({'op': 'cancel', 'transfer_id': header.get('transfer_id'),
+                                   'reason': 'Not approved by the receiver'}))
+
+    def handle_frame(self, frame, reply, peer=None):
+        """Dispatch one received transfer frame, reply(frame) sends back to whoever sent it"""
+        header, data = decode_transfer(frame)
+        transfer_id = header.get('transfer_id')
+        op = header.get('op')
+
+        if op in ('have', 'ack', 'nack') or (op == 'cancel' and transfer_id in self.outgoing):
+            transfer = self.outgoing.get(transfer_id)
+            if transfer:
+                transfer.handle(header)
+            return
+
+        if op == 'offer':
+            try:
+                transfer = IncomingTransfer(header, self.store, reply)
+            except (KeyError, TypeError, TransferError) as e:
+                logger.warning(f"Refusing transfer offer from {peer}: {e}")
+                reply(encode_transfer({'op': 'cancel', 'transfer_id': transfer_id, 'reason': f"Bad offer: {e}"}))
+                return
+            with self.lock:
+                # A re-offer of the same artifact supersedes a transfer that was cut off
+                for stale_id, stale in list(self.incoming.items()):
+                    if stale.manifest_id == transfer.manifest_id:
+                        del self.incoming[stale_id]
+                self.incoming[transfer_id] = transfer
+            reply(encode_transfer(transfer.have_list()))
+            return
+
+        transfer = self.incoming.get(transfer_id)
+        if transfer is None:
+            return
+        if op == 'chunk':
+            transfer.handle_chunk(header, data)
+        elif op == 'done':
+            with self.lock:
+                self.incoming.pop(transfer_id, None)
+            if transfer.complete():
+                self.on_complete(transfer.assemble(self.download_dir), peer)
+            else:
+                self.on_error(f"Transfer of {transfer.filename} ended incomplete", peer)
+        elif op == 'cancel':
+            with self.lock:
+                self.incoming.pop(transfer_id, None)
+            self.on_error(f"Transfer of {transfer.filename} interrupted: {header.get('reason')}", peer)
@@ -0,0 +1,239 @@
+import json
+import mmap
+import struct
+import tempfile
+import threading
+from collections import deque
+from Compression import CompressionStats, compress_payload, decompress_payload, is_compressed
+from Serialization import JSON, decode_message
+
+# Every frame on the wire is a 4 byte big-endian payload length followed by the payload
+HEADER = struct.Struct('!I')
+MAX_FRAME_SIZE = 64 * 1024 * 1024
+RECV_SIZE = 65536
+MAPPED_FRAME_SIZE = 1024 * 1024  # Frames this large are received into a memory-mapped file
+
+class FramingError(Exception):
+    """Raised when the peer sends a frame we refuse to buffer"""
+    pass
+
+def encode_frame(payload):
+    """Prefix a payload with its length"""
+    if isinstance(payload, str):
+        payload = payload.encode('utf-8')
+    if len(payload) > MAX_FRAME_SIZE:
+        raise FramingError(f"Frame of {len(payload)} bytes exceeds limit of {MAX_FRAME_SIZE}")
+    return HEADER.pack(len(payload)) + payload
+
+def encode_json(obj):
+    return encode_frame(json.dumps(obj).encode('utf-8'))
+
+def send_file_frame(sock, prefix, file, offset, count):
+    """Send prefix followed by count bytes of file as one frame.
+
+    The file part goes out with sendfile, straight from the page cache to the socket. Returns
+    the bytes of file sent; fewer than count means the frame is cut short and the stream unusable.
+    """
+    length = len(prefix) + count
+    if length > MAX_FRAME_SIZE:
+        raise FramingError(f"Frame of {length} bytes exceeds limit of {MAX_FRAME_SIZE}")
+    sock.sendall(HEADER.pack(length) + prefix)
+    return sock.sendfile(file, offset, count) if count else 0
+
+class FrameEncoder:
+    """Accumulates frames so many small messages go out in a single sendall"""
+    def __init__(self):
+        self.parts = []
+        self.size = 0
+
+    def add(self, payload):
+        frame = encode_frame(payload)
+        self.parts.append(frame)
+        self.size += len(frame)
+        return self
+
+    def add_json(self, obj):
+        return self.add(json.dumps(obj).encode('utf-8'))
+
+    def getvalue(self):
+        return b"".join(self.parts)
+
+    def flush(self, sock):
+        """Write everything collected so far to sock and reset the encoder"""
+        if not self.parts:
+            return 0
+        data = self.getvalue()
+        sock.sendall(data)
+        self.parts = []
+        self.size = 0
+        return len(data)
+
+    def __len__(self):
+        return len(self.parts)
+
+class MappedFrame(mmap.mmap):
+    """A large received frame living in a pre-sized, already unlinked temporary file.
+
+    Its pages belong to the page cache rather than the heap, so the kernel can write them out
+    under memory pressure and a worker's memory does not grow with payload size. It answers the
+    startswith/index/decode calls frame handlers make on bytes, memoryview(frame) gives
+    consumers the payload without a copy.
+    """
+    @classmethod
+    def allocate(cls, length, directory=None):
+        with tempfile.TemporaryFile(dir=directory) as spill:
+            spill.truncate(length)
+            return cls(spill.fileno(), length)
+
+    def startswith(self, prefix):
+        return self[:len(prefix)] == prefix
+
+    def index(self, sub, start=0):
+        position = self.find(sub, start)
+        if position < 0:
+            raise ValueError("subsection not found")
+        return position
+
+    def decode(self, encoding='utf-8', errors='strict'):
+        return self[:].decode(encoding, errors)
+
+    def __str__(self):
+        return f"<{len(self)} byte payload>"
+
+class FrameBuffer:
+    """Incremental read buffer that turns arbitrary recv chunks into whole frames.
+
+    Frames of MAPPED_FRAME_SIZE or more come back as MappedFrames backed by a file in
+    spill_dir (the system temp directory by default).
+    """
+    def __init__(self, max_frame_size=MAX_FRAME_SIZE, spill_dir=None):
+        self.max_frame_size = max_frame_size
+        self.spill_dir = spill_dir
+        self.buffer = bytearray()
+        self.frame = None  # Preallocated buffer of a large frame still being received
+        self.filled = 0
+
+    def feed(self, data):
+        """Add received bytes and return the list of frames completed by them"""
+        frames = []
+        if self.frame is not None:
+            data = self._fill(data, frames)
+            if self.frame is not None:
+                return frames
+        self.buffer += data
+        offset = 0
+        while len(self.buffer) - offset >= HEADER.size:
+            (length,) = HEADER.unpack_from(self.buffer, offset)
+            if length > self.max_frame_size:
+                raise FramingError(f"Incoming frame of {length} bytes exceeds limit of {self.max_frame_size}")
+            end = offset + HEADER.size + length
+            if len(self.buffer) < end:
+                if length > RECV_SIZE:
+                    # Large frames get a buffer of their final size up front, recv_from fills it in place
+                    self.frame = self._allocate(length)
+                    self.filled = len(self.buffer) - offset - HEADER.size
+                    self.frame[:self.filled] = memoryview(self.buffer)[offset + HEADER.size:]
+                    offset = len(self.buffer)
+                break
+            frames.append(bytes(self.buffer[offset + HEADER.size:end]))
+            offset = end
+        if offset:
+            del self.buffer[:offset]
+        return frames
+
+    def _allocate(self, length):
+        if length >= MAPPED_FRAME_SIZE:
+            return MappedFrame.allocate(length, self.spill_dir)
+        return bytearray(length)
+
+    def _fill(self, data, frames):
+        """Copy data into the pending large frame, returns whatever is left over"""
+        view = memoryview(data)
+        take = min(len(view), len(self.frame) - self.filled)
+        self.frame[self.filled:self.filled + take] = view[:take]
+        self.filled += take
+        if self.filled == len(self.frame):
+            frames.append(self.frame)
+            self.frame = None
+        return view[take:]
+
+    def recv_from(self, sock):
+        """Receive what sock has ready, returns the frames completed or None once it closes.
+
+        While a large frame is pending its bytes go straight into the preallocated buffer with
+        recv_into, so a big chunk is neither regrown nor copied on its way to the caller.
+        Large frames come back as that bytearray or MappedFrame, small ones as bytes.
+        """
+        if self.frame is None:
+            data = sock.recv(RECV_SIZE)
+            return self.feed(data) if data else None
+        received = sock.recv_into(memoryview(self.frame)[self.filled:])
+        if not received:
+            return None
+        self.filled += received
+        if self.filled < len(self.frame):
+            return []
+        frame, self.frame = self.frame, None
+        return [frame]
+
+    def pending(self):
+        """Number of buffered bytes not yet part of a complete frame"""
+        return len(self.buffer) + (self.filled if self.frame is not None else 0)
+
+class FramedConnection:
+    """Socket wrapper speaking the length-prefixed protocol, safe to send on from several threads.
+
+    Once codec is set (after the relay handshake) payloads worth it are sent compressed,
+    compressed frames received are expanded whether or not we compress ourselves.
+    Messages go out in serializer's format and are read back in whichever one they came in.
+    """
+    def __init__(self, sock, max_frame_size=MAX_FRAME_SIZE):
+        self.sock = sock
+        self.read_buffer = FrameBuffer(max_frame_size)
+        self.ready = deque()
+        self.send_lock = threading.Lock()
+        self.read_lock = threading.Lock()
+        self.codec = None
+        self.compression = CompressionStats()
+        self.serializer = JSON
+
+    def send(self, payload):
+        self.send_encoded(encode_frame(compress_payload(payload, self.codec, self.compression)))
+
+    def send_json(self, obj):
+        self.send(self.serializer.dumps(obj))
+
+    def send_encoded(self, frame):
+        """Send a frame that is already length-prefixed, so one encoding can go to many connections"""
+        with self.send_lock:
+            self.sock.sendall(frame)
+
+    def send_batch(self, encoder):
+        """Flush a FrameEncoder in one write"""
+        with self.send_lock:
+            return encoder.flush(self.sock)
+
+    def read_frame(self):
+        """Block until a whole frame is available, returns None once the peer closes"""
+        with self.read_lock:
+            while not self.ready:
+                frames = self.read_buffer.recv_from(self.sock)
+                if frames is None:
+                    return None
+                self.ready.extend(frames)
+            frame = self.ready.popleft()
+        if is_compressed(frame):
+            return decompress_payload(frame, self.compression, self.read_buffer.max_frame_size)
+        return frame
+
+    def read_json(self):
+        frame = self.read_frame()
+        if frame is None:
+            return None
+        return decode_message(frame)
+
+    def settimeout(self, timeout):
+        self.sock.settimeout(timeout)
+
+    def close(self):
+        self.sock.close()
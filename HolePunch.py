@@ -0,0 +1,334 @@
+import json
+import logging
+import queue
+import socket
+import struct
+import threading
+import time
+
+logger = logging.getLogger('hole_punch')
+
+# Every datagram starts with its kind
+DATA, ACK, PROBE, PROBE_ACK, KEEPALIVE, CLOSE, ENDPOINT = range(1, 8)
+DATA_HEADER = struct.Struct('!BI')  # kind, sequence
+ACK_HEADER = struct.Struct('!BII')  # kind, next sequence expected, sequence being acknowledged
+
+MAX_PAYLOAD = 1200  # Small enough to cross almost any path without IP fragmentation
+WINDOW = 256  # Sequence numbers in flight past the oldest unacknowledged datagram
+INITIAL_RTO = 1.0
+MIN_RTO = 0.2
+MAX_RTO = 3.0
+MAX_SENDS = 10  # A datagram sent this often without an ack means the path is gone
+TICK = 0.05  # Retransmission timer resolution
+PROBE_INTERVAL = 0.1
+PUNCH_TIMEOUT = 5
+KEEPALIVE_INTERVAL = 15  # NAT routers forget idle UDP mappings after 30 s or more
+PATH_TIMEOUT = KEEPALIVE_INTERVAL * 3
+REGISTER_TIMEOUT = 2
+
+class PunchedStream:
+    """Reliable, ordered byte stream to one peer over a punched UDP path.
+
+    Stands in for a connected socket: sendall() and close(). Data is cut into numbered
+    datagrams, the receiver acknowledges each one together with the next sequence it expects,
+    and anything unacknowledged for longer than the retransmission timeout (estimated from
+    round trips the way TCP does) is sent again. Datagrams arriving ahead of a gap are held
+    until it fills, so received bytes reach on_data in order, on a thread of their own.
+    """
+    def __init__(self, transport, address):
+        self.transport = transport
+        self.address = address
+        self.next_seq = 0
+        self.unacked = {}  # {seq: [payload, last sent, times sent]} in sequence order
+        self.expected = 0  # Next sequence to hand to on_data
+        self.out_of_order = {}  # {seq: payload} received ahead of a gap
+        self.duplicate_acks = 0
+        self.srtt = None
+        self.rttvar = 0.0
+        self.rto = INITIAL_RTO
+        self.last_sent = self.last_received = time.time()
+        self.closed = False
+        self.lock = threading.Condition()
+        self.inbox = queue.Queue()  # Received data, delivered outside the transport's reader
+
+    def start(self, on_data, on_close):
+        """Hand received bytes to on_data(data), on_close(reason) runs if the path fails"""
+        delivery_thread = threading.Thread(target=self._deliver, args=(on_data, on_close))
+        delivery_thread.daemon = True
+        delivery_thread.start()
+
+    def _deliver(self, on_data, on_close):
+        while True:
+            data, reason = self.inbox.get()
+            if data is None:
+                if reason:
+                    on_close(reason)
+                return
+            try:
+                on_data(data)
+            except Exception as e:
+                logger.error(f"Error handling data from {self.address}: {e}")
+
+    def sendall(self, data):
+        view = memoryview(data)
+        for offset in range(0, len(view), MAX_PAYLOAD):
+            payload = bytes(view[offset:offset + MAX_PAYLOAD])
+            with self.lock:
+                while self.unacked and self.next_seq - next(iter(self.unacked)) >= WINDOW and not self.closed:
+                    self.lock.wait()
+                if self.closed:
+                    raise ConnectionError(f"Punched path to {self.address} closed")
+                seq = self.next_seq
+                self.next_seq += 1
+                self.unacked[seq] = [payload, time.time(), 1]
+            self._send(DATA_HEADER.pack(DATA, seq) + payload)
+
+    def _send(self, datagram):
+        self.last_sent = time.time()
+        self.transport.sendto(datagram, self.address)
+
+    def _on_data(self, seq, payload):
+        delivered = []
+        with self.lock:
+            if seq == self.expected:
+                delivered.append(payload)
+                self.expected += 1
+                while self.expected in self.out_of_order:
+                    delivered.append(self.out_of_order.pop(self.expected))
+                    self.expected += 1
+            elif self.expected < seq < self.expected + WINDOW:
+                self.out_of_order[seq] = payload
+            elif seq >= self.expected + WINDOW:
+                return  # The sender never gets this far ahead, not a datagram of this stream
+            expected = self.expected
+        # Duplicates are acknowledged again too, the first ack may be what got lost
+        self._send(ACK_HEADER.pack(ACK, expected, seq))
+        if delivered:
+            self.inbox.put((b''.join(delivered), None))
+
+    def _on_ack(self, expected, seq):
+        now = time.time()
+        resend = None
+        with self.lock:
+            entry = self.unacked.pop(seq, None)
+            if entry is not None and entry[2] == 1:
+                # Only datagrams sent once give an unambiguous round trip
+                self._sample_rtt(now - entry[1])
+            while self.unacked:
+                oldest = next(iter(self.unacked))
+                if oldest >= expected:
+                    break
+                del self.unacked[oldest]
+            if seq > expected and expected in self.unacked:
+                # The receiver keeps reporting the same gap, resend it without waiting for the timeout
+                self.duplicate_acks += 1
+                if self.duplicate_acks == 3:
+                    entry = self.unacked[expected]
+                    entry[1] = now
+                    entry[2] += 1
+                    resend = DATA_HEADER.pack(DATA, expected) + entry[0]
+            else:
+                self.duplicate_acks = 0
+            self.lock.notify_all()
+        if resend:
+            self._send(resend)
+
+    def _sample_rtt(self, rtt):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        self.rto = min(max(self.srtt + 4 * self.rttvar, MIN_RTO), MAX_RTO)
+
+    def _tick(self, now):
+        """Retransmit what timed out and keep the NAT mapping alive"""
+        resend = []
+        with self.lock:
+            if self.closed:
+                return
+            for seq, entry in self.unacked.items():
+                if now - entry[1] > self.rto:
+                    if entry[2] >= MAX_SENDS:
+                        resend = None
+                        break
+                    if not resend and seq == next(iter(self.unacked)):
+                        # Back off when the oldest datagram times out, not for every straggler
+                        self.rto = min(self.rto * 2, MAX_RTO)
+                    entry[1] = now
+                    entry[2] += 1
+                    resend.append(DATA_HEADER.pack(DATA, seq) + entry[0])
+        if resend is None:
+            self._fail(f"{self.address} stopped acknowledging")
+        elif now - self.last_received > PATH_TIMEOUT:
+            self._fail(f"Nothing heard from {self.address} for {PATH_TIMEOUT}s")
+        elif resend:
+            for datagram in resend:
+                self._send(datagram)
+        elif now - self.last_sent > KEEPALIVE_INTERVAL:
+            self._send(bytes([KEEPALIVE]))
+
+    def _fail(self, reason):
+        if self._shut():
+            logger.info(f"Punched path to {self.address} failed: {reason}")
+            self.inbox.put((None, reason))
+
+    def _shut(self):
+        with self.lock:
+            if self.closed:
+                return False
+            self.closed = True
+            self.lock.notify_all()
+        self.transport._forget(self)
+        return True
+
+    def close(self):
+        if self._shut():
+            self._send(bytes([CLOSE]))
+            self.inbox.put((None, None))
+
+class PunchTransport:
+    """One UDP socket carrying every punched path of a peer.
+
+    The relay learns our public endpoint from register(): it sees the address our datagram
+    arrives from, which is the mapping our NAT created for this socket. To open a path, both
+    peers call punch() at the same time with the endpoint and token the relay gave them.
+    Each side's outbound probes open its own NAT to the other side, so once both have sent,
+    probes get through in both directions and the relay is out of the data path.
+    """
+    def __init__(self, sock=None):
+        if sock is None:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.bind(('', 0))
+        self.sock = sock
+        self.sock.settimeout(1.0)
+        self.streams = {}  # Open paths {address: PunchedStream}
+        self.attempts = {}  # Punches in progress {token: {'event', 'address'}}
+        self.relay_address = None
+        self.endpoint = None  # Our public (ip, port) as the relay last saw it
+        self.registered = threading.Event()
+        self.lock = threading.Lock()
+        self.running = True
+        self.receiver_thread = threading.Thread(target=self._receive_loop)
+        self.receiver_thread.daemon = True
+        self.receiver_thread.start()
+        self.timer_thread = threading.Thread(target=self._timer_loop)
+        self.timer_thread.daemon = True
+        self.timer_thread.start()
+
+    def register(self, relay_address, peer_id, token, timeout=REGISTER_TIMEOUT):
+        """Tell the relay where our datagrams come from, returns our public endpoint or None"""
+        self.relay_address = (socket.gethostbyname(relay_address[0]), relay_address[1])
+        request = bytes([ENDPOINT]) + json.dumps({'peer_id': peer_id, 'token': token}).encode('utf-8')
+        self.registered.clear()
+        deadline = time.time() + timeout
+        while self.running and time.time() < deadline:
+            self.sendto(request, self.relay_address)
+            if self.registered.wait(0.25):
+                return self.endpoint
+        return None
+
+    def punch(self, address, token, timeout=PUNCH_TIMEOUT):
+        """Probe address until the other side's probes get through, returns the stream or None"""
+        address = tuple(address)
+        token = bytes.fromhex(token)
+        attempt = {'event': threading.Event(), 'address': None}
+        with self.lock:
+            self.attempts[token] = attempt
+        probe = bytes([PROBE]) + token
+        deadline = time.time() + timeout
+        try:
+            while self.running and not attempt['event'].is_set() and time.time() < deadline:
+                self.sendto(probe, address)
+                attempt['event'].wait(PROBE_INTERVAL)
+        finally:
+            with self.lock:
+                self.attempts.pop(token, None)
+        if not attempt['event'].is_set():
+            return None
+        # The probe may have come from another port than the relay saw, keep using that one
+        return self.streams.get(attempt['address'])
+
+    def sendto(self, datagram, address):
+        try:
+            self.sock.sendto(datagram, address)
+        except OSError as e:
+            logger.debug(f"Datagram to {address} not sent: {e}")
+
+    def _forget(self, stream):
+        with self.lock:
+            if self.streams.get(stream.address) is stream:
+                del self.streams[stream.address]
+
+    def _receive_loop(self):
+        while self.running:
+            try:
+                data, address = self.sock.recvfrom(65535)
+            except socket.timeout:
+                continue
+            except OSError as e:
+                if self.running:
+                    logger.warning(f"UDP receive failed: {e}")
+                    time.sleep(0.1)
+                continue
+            if not data:
+                continue
+            try:
+                self._handle_datagram(data, address)
+            except Exception as e:
+                logger.warning(f"Bad datagram from {address}: {e}")
+
+    def _handle_datagram(self, data, address):
+        kind = data[0]
+        if kind == ENDPOINT:
+            if address == self.relay_address:
+                self.endpoint = tuple(json.loads(data[1:].decode('utf-8'))['endpoint'])
+                self.registered.set()
+            return
+        if kind in (PROBE, PROBE_ACK):
+            token = data[1:]
+            with self.lock:
+                attempt = self.attempts.get(token)
+                stream = self.streams.get(address)
+                if attempt is None and stream is None:
+                    return  # Not a punch we are part of
+                if stream is None:
+                    # Created before punch() returns, so data sent right after the probe is kept
+                    stream = self.streams[address] = PunchedStream(self, address)
+                if attempt is not None:
+                    attempt['address'] = address
+                    attempt['event'].set()
+            stream.last_received = time.time()
+            if kind == PROBE:
+                # Answered even after our own punch finished, in case our earlier answer was lost
+                stream._send(bytes([PROBE_ACK]) + token)
+            return
+        stream = self.streams.get(address)
+        if stream is None:
+            return
+        stream.last_received = time.time()
+        if kind == DATA:
+            seq, = struct.unpack_from('!I', data, 1)
+            stream._on_data(seq, data[DATA_HEADER.size:])
+        elif kind == ACK:
+            _, expected, seq = ACK_HEADER.unpack_from(data)
+            stream._on_ack(expected, seq)
+        elif kind == CLOSE:
+            stream._fail(f"{address} closed the path")
+
+    def _timer_loop(self):
+        while self.running:
+            time.sleep(TICK)
+            now = time.time()
+            for stream in list(self.streams.values()):
+                stream._tick(now)
+
+    def close(self):
+        self.running = False
+        for stream in list(self.streams.values()):
+            stream.close()
+        try:
+            self.sock.close()
+        except:
+            pass
@@ -1,13 +1,17 @@
 from P2PPlatform import Network
 from P2PPlatform import Peer
+from Framing import MappedFrame
+from ExecutionPool import ExecutionPool
+import os
 import socket
-import subprocess
 
 class Interface(object):
 	def __init__(self, tagDict, network = None):
 		self.network = network
 		self.tagDict = tagDict
 		self.receivingCode = False
+		#received programs run here, one process per core, without blocking the prompt
+		self.pool = ExecutionPool()
 		
 	def run(self):
 		self.network.alerters.append(self.netMessage)
@@ -16,7 +20,7 @@ class Interface(object):
 			self.connector()
 		command = None
 		while command != "/exit":
-			command = input("Please type your message, or enter a command, '/connect', '/approve', '/name', '/addPort', '/exit', '/sendCode' , '/receiveCode' then hit enter:  \n")
+			command = input("Please type your message, or enter a command, '/connect', '/approve', '/name', '/addPort', '/exit', '/sendCode' , '/shareCode', '/receiveCode' then hit enter:  \n")
 			if command == "/connect":
 				self.connector()
 			elif command == "/approve":
@@ -27,6 +31,8 @@ class Interface(object):
 				self.addPort()
 			elif command == "/sendCode":
 				self.parseAndSend()
+			elif command == "/shareCode":
+				self.parseAndShare()
 			elif command == "/receiveCode":
 				self.receivingCode = True
 			else:
@@ -36,8 +42,12 @@ class Interface(object):
 
 	def parseAndSend(self):
 		fileName = input("Please enter the filename to send: ")
-		toSendFile = self.programParser(fileName)
-		self.network.sender("<code> " + toSendFile)
+		self.network.send_file(fileName)
+		
+	#lets peers fetch the file from each other instead of all from us
+	def parseAndShare(self):
+		fileName = input("Please enter the filename to share: ")
+		self.network.share_file(fileName)
 		
 	def programParser(self, filename):
 		with open(filename, 'r') as openFile:
@@ -50,28 +60,54 @@ class Interface(object):
 			print("Code received from " + peer)
 		fileName = input("Please enter name of the file to be created for the code: ")
 		self.programCreater(fileName,code)
+		self.runReceived(fileName)
+	#same as receiveCode for a file that was streamed to disk by the network	
+	def receiveFile(self, peer, path):
+		self.receivingCode = False
+		if peer != None:
+			print("File received from " + peer)
+		fileName = input("Please enter name of the file to be created for the code (Enter to keep " + path + "): ")
+		if fileName != "":
+			os.replace(path, fileName)
+			path = fileName
+		self.runReceived(path)
+	def runReceived(self, fileName):
 		run = input("Run the file? y/n")
 		if run == "y" or run == "Y" or run == "Yes":
-			try:
-				result = self.runProgram(fileName)
-				print(result)
-				sendYN = input("Send the result? y/n")
-				if sendYN == "y" or sendYN == "Y" or sendYN == "Yes":
-					self.network.sender(result)
-			except subprocess.CalledProcessError as e:
-				error_message = f"Error executing code: {e}"
-				print(error_message)
-				sendYN = input("Send the error message? y/n")
-				if sendYN == "y" or sendYN == "Y" or sendYN == "Yes":
-					self.network.sender(error_message)
+			sendYN = input("Send the result when it finishes? y/n")
+			send = sendYN == "y" or sendYN == "Y" or sendYN == "Yes"
+			future = self.runProgram(fileName)
+			future.add_done_callback(lambda done: self.programFinished(fileName, done, send))
+	#called from the pool once a program started by runReceived exits
+	def programFinished(self, fileName, future, send):
+		try:
+			result = future.result()
+		except Exception as e:
+			result = None
+			message = f"Error executing code: {e}"
+		if result is not None:
+			output = (result.stdout + result.stderr).decode('utf-8', errors='replace')
+			if result.ok:
+				message = output
+			else:
+				message = f"Error executing code: {result.error or 'exit status ' + str(result.returncode)}\n{output}"
+		print(f"{fileName} finished:\n{message}")
+		if send:
+			self.network.sender(message)
 	def programCreater(self, filename, code):
+		#large programs arrive as a view of a mapped frame and are written out as they are
+		if not isinstance(code, str):
+			with open(filename, 'wb') as openFile:
+				openFile.write(code)
+			return
 		with open(filename, 'w') as openFile:
 			openFile.write(code)		
 		
-	#runs a python program
+	#runs a python program in the pool, printing its output as it arrives, returns a future
 	def runProgram(self, fileName):
-		process = subprocess.check_output(["python3", fileName], stderr=subprocess.STDOUT, universal_newlines=True)
-		return process		
+		name = os.path.basename(fileName)
+		printer = lambda stream, data: print(f"[{name}] " + data.decode('utf-8', errors='replace'), end="")
+		return self.pool.submit(["python3", fileName], printer)
 	
 	def getOwnIP(self):
 		"""see http://stackoverflow.com/questions/166506 for details. """
@@ -121,6 +157,10 @@ class Interface(object):
 		message = message.contents
 		if type(message) is str and message[:6] == "<code>" and self.receivingCode:
 			self.receiveCode(peer,message[6:])
+		elif type(message) is str and message[:6] == "<file>" and self.receivingCode:
+			self.receiveFile(peer,message[7:])
+		elif isinstance(message, MappedFrame) and message.startswith(b"<code>") and self.receivingCode:
+			self.receiveCode(peer,memoryview(message)[6:])
 		if peer is not None:
 			print("From {0!s}: {1!s}".format(peer,message))
 		else:
@@ -0,0 +1,131 @@
+import functools
+import math
+import threading
+import time
+from collections import deque
+
+PHI_THRESHOLD = 8  # Suspect a peer once a live one would be this late with probability 10^-8
+MIN_STD = 0.5  # Even a perfectly punctual peer gets this much leeway per standard deviation
+ACCEPTABLE_PAUSE = 2.0  # Scheduling and network hiccups any peer may have
+LATENESS_WINDOW = 100  # Heartbeats the lateness estimate is taken over
+
+def phi(elapsed, mean, std):
+    """-log10 of the chance that a live peer is still silent after elapsed, for normal gaps.
+
+    Uses the logistic approximation of the normal tail that Akka's phi accrual detector uses,
+    which stays finite far out where the exact tail underflows.
+    """
+    y = max(min((elapsed - mean) / std, 10.0), -10.0)
+    e = math.exp(-y * (1.5976 + 0.070566 * y * y))
+    if elapsed > mean:
+        return -math.log10(e / (1.0 + e))
+    return -math.log10(1.0 - 1.0 / (1.0 + e))
+
+@functools.lru_cache()
+def threshold_sigmas(threshold):
+    """Standard deviations past the mean at which phi reaches threshold"""
+    low, high = 0.0, 10.0
+    for _ in range(50):
+        middle = (low + high) / 2
+        if phi(middle, 0.0, 1.0) < threshold:
+            low = middle
+        else:
+            high = middle
+    return high
+
+class PhiAccrualDetector:
+    """How suspicious a peer's silence is, learned from how late its heartbeats have been.
+
+    A peer promises some sign of life at least every interval seconds, any frame will do.
+    Lateness is how far past that promise each heartbeat arrived, and phi is computed over a
+    normal fit of recent lateness, so a punctual peer is suspected soon after it misses one
+    and one on a jittery path gets proportionally more slack.
+    """
+    def __init__(self, interval, threshold=PHI_THRESHOLD, window=LATENESS_WINDOW):
+        self.interval = interval
+        self.sigmas = threshold_sigmas(threshold)
+        self.samples = deque(maxlen=window)
+        self.total = 0.0
+        self.squares = 0.0
+        # Until heartbeats have been measured, allow them to be up to a quarter interval late
+        self.mean = 0.0
+        self.std = interval / 4
+
+    def heartbeat(self, gap):
+        """Record a heartbeat that arrived gap seconds after the previous sign of life"""
+        lateness = max(gap - self.interval, 0.0)
+        if len(self.samples) == self.samples.maxlen:
+            oldest = self.samples[0]
+            self.total -= oldest
+            self.squares -= oldest * oldest
+        self.samples.append(lateness)
+        self.total += lateness
+        self.squares += lateness * lateness
+        self.mean = self.total / len(self.samples)
+        self.std = math.sqrt(max(self.squares / len(self.samples) - self.mean * self.mean, 0.0))
+
+    def phi(self, elapsed):
+        """Suspicion after elapsed seconds of silence"""
+        return phi(elapsed, self.interval + ACCEPTABLE_PAUSE + self.mean, max(self.std, MIN_STD))
+
+    def timeout(self):
+        """Silence after which phi passes the threshold"""
+        return self.interval + ACCEPTABLE_PAUSE + self.mean + self.sigmas * max(self.std, MIN_STD)
+
+class LivenessTracker:
+    """Expiry deadlines on a hashed timer wheel, so liveness costs nothing per healthy peer.
+
+    The wheel has one slot per tick covering a whole timeout. touch() moves a key to the slot
+    of its new deadline, expired() empties the slots the clock has passed since the last call.
+    A key sits in exactly one slot, so touch() is O(1) and expired() only looks at keys that
+    are due, however many peers there are. Call expired() at least once per tick and keys
+    expire within a tick of their deadline. timeout is also the longest deadline touch() sets.
+    """
+    def __init__(self, timeout, tick=1.0, clock=time.monotonic):
+        self.timeout = timeout
+        self.tick = tick
+        self.clock = clock
+        self.slots = [set() for _ in range(int(math.ceil(timeout / tick)) + 2)]
+        self.deadlines = {}  # {key: deadline tick}, the slot is the tick modulo the wheel size
+        self.last_tick = int(clock() // tick)  # Last tick whose slot has been emptied
+        self.lock = threading.Lock()
+
+    def touch(self, key, timeout=None):
+        """Push key's deadline to timeout (at most the tracker's) from now"""
+        timeout = self.timeout if timeout is None else min(timeout, self.timeout)
+        deadline = int(math.ceil((self.clock() + timeout) / self.tick))
+        with self.lock:
+            previous = self.deadlines.get(key)
+            self.deadlines[key] = deadline
+            if previous is not None:
+                if previous % len(self.slots) == deadline % len(self.slots):
+                    return
+                self.slots[previous % len(self.slots)].discard(key)
+            self.slots[deadline % len(self.slots)].add(key)
+
+    def forget(self, key):
+        with self.lock:
+            deadline = self.deadlines.pop(key, None)
+            if deadline is not None:
+                self.slots[deadline % len(self.slots)].discard(key)
+
+    def expired(self):
+        """Keys whose deadline passed since the last call, they are no longer tracked"""
+        now_tick = int(self.clock() // self.tick)
+        expired = []
+        with self.lock:
+            # After a long stall every slot is overdue, but each only needs emptying once
+            first = max(self.last_tick + 1, now_tick - len(self.slots) + 1)
+            for tick in range(first, now_tick + 1):
+                slot = self.slots[tick % len(self.slots)]
+                # A touch made while expired() was running late can share the slot a round ahead
+                overdue = [key for key in slot if self.deadlines[key] <= tick]
+                for key in overdue:
+                    slot.discard(key)
+                    del self.deadlines[key]
+                expired.extend(overdue)
+            self.last_tick = max(self.last_tick, now_tick)
+        return expired
+
+    def __len__(self):
+        return len(self.deadlines)
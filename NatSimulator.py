@@ -0,0 +1,141 @@
+# NatSimulator.py
+import argparse
+import logging
+import random
+import socket
+import sys
+import threading
+import time
+
+class SimulatedNat:
+    """Stands in for a peer's UDP socket behind a port-restricted cone NAT.
+
+    Outbound datagrams all leave from one public port whatever their destination, inbound ones
+    are dropped unless the inside already sent to that exact address and port. That filtering
+    is what keeps a peer unreachable until hole punching opens it. loss drops that fraction of
+    datagrams in each direction, so the punched path has to retransmit.
+    """
+    def __init__(self, host='127.0.0.1', loss=0.0):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind((host, 0))
+        self.loss = loss
+        self.allowed = set()  # Addresses the inside has sent to
+        self.filtered = 0  # Unsolicited datagrams dropped
+        self.lost = 0
+
+    def sendto(self, data, address):
+        self.allowed.add(tuple(address))
+        if random.random() < self.loss:
+            self.lost += 1
+            return len(data)
+        return self.sock.sendto(data, address)
+
+    def recvfrom(self, size):
+        while True:
+            data, address = self.sock.recvfrom(size)
+            if address not in self.allowed:
+                self.filtered += 1
+                continue
+            if random.random() < self.loss:
+                self.lost += 1
+                continue
+            return data, address
+
+    def settimeout(self, timeout):
+        self.sock.settimeout(timeout)
+
+    def getsockname(self):
+        return self.sock.getsockname()
+
+    def close(self):
+        self.sock.close()
+
+def free_port(host):
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind((host, 0))
+        return sock.getsockname()[1]
+
+def wait_for(condition, timeout):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if condition():
+            return True
+        time.sleep(0.05)
+    return False
+
+def main():
+    parser = argparse.ArgumentParser(description='Hole punching between two peers behind simulated NATs')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--loss', type=float, default=0.05, help='Fraction of datagrams each NAT drops')
+    parser.add_argument('--messages', type=int, default=500, help='Messages sent over the punched path')
+    parser.add_argument('--payload', type=int, default=1024 * 1024, help='Size of the final large message in bytes')
+    args = parser.parse_args()
+
+    from RelayServer import RelayServer
+    from CloudP2PPlatform import CloudNetwork
+    logging.getLogger().setLevel(logging.WARNING)
+
+    relay_port = free_port(args.host)
+    relay = RelayServer(args.host, relay_port)
+    threading.Thread(target=relay.start, daemon=True).start()
+
+    nats = [SimulatedNat(args.host, args.loss), SimulatedNat(args.host, args.loss)]
+    a, b = [CloudNetwork(args.host, free_port(args.host), args.host, relay_port, udp_socket=nat) for nat in nats]
+    received = []
+    # Large messages arrive as mapped frames rather than strings
+    contents = lambda message: message.contents if isinstance(message.contents, str) else bytes(memoryview(message.contents)).decode()
+    b.alerters.append(lambda message, peer: received.append(contents(message)) if peer else None)
+    failures = []
+    try:
+        if not wait_for(lambda: a.udp.endpoint and b.udp.endpoint and b.peer_id in a.relay_peers, 10):
+            failures.append("peers never registered their UDP endpoints with the relay")
+            return failures
+        print(f"public endpoints: a={a.udp.endpoint} b={b.udp.endpoint}")
+
+        # Without punching, b's NAT drops whatever a sends it
+        filtered = nats[1].filtered
+        a.udp.sendto(b"unsolicited", b.udp.endpoint)
+        if not wait_for(lambda: nats[1].filtered > filtered, 2):
+            failures.append("b's NAT let an unsolicited datagram through")
+
+        # The NAT drops inbound TCP as well, so aim the direct attempt at a closed port
+        peer = a.relay_peers[b.peer_id]
+        peer.port = free_port(args.host)
+        started = time.time()
+        if not a.connect_to_cloud_peer(b.peer_id):
+            failures.append("hole punching failed")
+            return failures
+        print(f"punched through in {time.time() - started:.2f}s, relay_only={peer.relay_only}")
+
+        if not wait_for(lambda: a.peer_id in b.relay_peers and b.relay_peers[a.peer_id].connection, 5):
+            failures.append("b never attached the punched path")
+            return failures
+        b.approve(b.relay_peers[a.peer_id])
+
+        started = time.time()
+        for number in range(args.messages):
+            a.sender(f"msg-{number}")
+        a.sender("x" * args.payload)
+        expected = [f"msg-{number}" for number in range(args.messages)] + ["x" * args.payload]
+        if not wait_for(lambda: len(received) >= len(expected), 60):
+            failures.append(f"only {len(received)} of {len(expected)} messages arrived")
+        elif received[:len(expected)] != expected:
+            failures.append("messages arrived out of order or corrupted")
+        elapsed = time.time() - started
+        stream = peer.connection
+        print(f"{len(received)} messages, {args.messages * 8 + args.payload} bytes in {elapsed:.2f}s "
+              f"(rto {stream.rto:.3f}s) with {nats[0].lost + nats[1].lost} datagrams lost, "
+              f"{nats[0].filtered + nats[1].filtered} filtered by the NATs")
+    finally:
+        for network in (a, b):
+            network.shutdown()
+        relay.shutdown()
+    return failures
+
+if __name__ == "__main__":
+    failures = main()
+    for failure in failures:
+        print(f"FAILED: {failure}")
+    if not failures:
+        print("OK")
+    sys.exit(1 if failures else 0)
@@ -1,6 +1,18 @@
+import selectors
 import socket
 import threading
 import time
+from Framing import FrameBuffer, FrameEncoder, MappedFrame, encode_frame, send_file_frame
+from FileTransfer import TransferManager, is_transfer_frame
+from Swarm import SwarmManager, is_swarm_frame
+from TaskScheduler import TaskManager, is_task_frame
+from Aggregation import Aggregator
+from Compression import CompressionStats, OFFER_TAG, compress_payload, decompress_payload, decode_offer, encode_offer, is_compressed
+from SendQueue import BLOCK, DROP, QueueFull, SendQueue
+
+#link-level frames answered by the network itself, never passed to alerters
+PING_FRAME = b"<ping>"
+PONG_FRAME = b"<pong>"
 
 class Message:
     def __init__(self, contents):
@@ -12,6 +24,12 @@ class Peer:
         self.port = port
         self.connection = connection
         self.name = None
+        self.read_buffer = FrameBuffer()
+        self.last_seen = time.time()
+        self.last_ping = 0
+        self.codec = None  #compression both ends support, from the peer's codec offer
+        self.compression = CompressionStats()
+        self.dropping = False  #its send queue is full and broadcasts are being dropped
     
     def __str__(self):
         if self.name:
@@ -19,13 +37,33 @@ class Peer:
         return f"{self.ip}:{self.port}"
 
 class Network:
-    def __init__(self, ip, port):
+    def __init__(self, ip, port, send_policy=BLOCK):
         self.ip = ip
         self.port = port
         self.peerList = []
         self.unconfirmedList = []
         self.alerters = []
         self.running = True
+        #every connection gets a bounded queue and a writer thread, send_policy says what
+        #happens to messages for a peer whose queue is full, file transfers always block and
+        #replies sent while handling a received frame never do
+        self.send_policy = send_policy
+        self.outboxes = {}  #{connection: SendQueue}
+        self.outbox_lock = threading.Lock()
+        self.dispatching = threading.local()  #set while a reader thread hands a frame to the managers
+        self.refused = set()  #keys of unapproved peers already told their tagged frames are ignored
+        self.transfers = TransferManager(self._transfer_complete, self._transfer_failed)
+        self.swarm = SwarmManager(self.transfers.store, self._send_to_key, self._reachable_keys,
+                                  self._transfer_complete, self._transfer_failed)
+        self.tasks = TaskManager(self._send_to_key, self._task_finished, self._task_event)
+        self.aggregator = Aggregator(self.tasks)
+        #readiness-driven receive: peer sockets are registered with the selector as they
+        #connect and unregistered when they drop, the wakeup pair interrupts a blocking select
+        self.selector = selectors.DefaultSelector()
+        self._wakeup_reader, self._wakeup_writer = socket.socketpair()
+        self._wakeup_reader.setblocking(False)
+        self._wakeup_writer.setblocking(False)
+        self.selector.register(self._wakeup_reader, selectors.EVENT_READ, None)
         self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.server_socket.bind((ip, port))
@@ -43,7 +81,10 @@ class Network:
             client_socket.connect((ip, port))
             peer = Peer(ip, port, client_socket)
             self.peerList.append(peer)
+            self._register_peer(peer)
+            self._offer_codecs(peer)
             self._alert(Message(f"Connected to {peer}"))
+            self.resume_transfers(peer)
             return True
         except Exception as e:
             self._alert(Message(f"Failed to connect to {ip}:{port}: {e}"))
@@ -52,25 +93,234 @@ class Network:
     def sender(self, message):
         if not message:
             return
-        message_obj = Message(message)
+        self._broadcast([message])
+    
+    def send_many(self, messages):
+        """Send several messages to every peer, batched into one write per peer"""
+        messages = [message for message in messages if message]
+        if messages:
+            self._broadcast(messages)
+    
+    def _broadcast(self, messages):
+        #peers sharing a codec share one encoding, compression runs once per codec
+        encoded = {}
         for peer in self.peerList:
             try:
                 if peer.connection:
-                    peer.connection.sendall(message.encode())
+                    codec = peer.codec.name if peer.codec else None
+                    data = encoded.get(codec)
+                    if data is None:
+                        encoder = FrameEncoder()
+                        for message in messages:
+                            encoder.add(compress_payload(message, peer.codec, peer.compression))
+                        data = encoded[codec] = encoder.getvalue()
+                    self._send_to_peer(peer, data)
+                    peer.dropping = False
+            except QueueFull as e:
+                #one alert per run of drops, the queue's counters have the rest
+                if not peer.dropping:
+                    peer.dropping = True
+                    self._alert(Message(f"Failed to send message to {peer}: {e}"))
             except Exception as e:
                 self._alert(Message(f"Failed to send message to {peer}: {e}"))
     
+    def _send_to_peer(self, peer, data, policy=None, headroom=False):
+        #queued for the connection's writer, a peer that stops reading only holds up its own queue
+        if not self._outbox(peer).put(data, policy, headroom):
+            raise QueueFull(f"Send queue to {peer} is full, message dropped")
+    
+    def _outbox(self, peer):
+        """The send queue of peer's current connection, started on first use"""
+        connection = peer.connection
+        if not connection:
+            raise ConnectionError(f"Not connected to {peer}")
+        with self.outbox_lock:
+            outbox = self.outboxes.get(connection)
+            if outbox is None:
+                outbox = self.outboxes[connection] = SendQueue(
+                    connection.sendall, lambda error: self._send_failed(connection, error), self.send_policy)
+        return outbox
+    
+    def _close_outbox(self, connection):
+        with self.outbox_lock:
+            outbox = self.outboxes.pop(connection, None)
+        if outbox is not None:
+            outbox.close()
+    
+    def _send_failed(self, connection, error):
+        #the writer gave up on the connection, drop whichever peer it belongs to by now
+        self._close_outbox(connection)
+        for peer in list(self.peerList) + list(self.unconfirmedList):
+            if peer.connection is connection:
+                self._drop_peer(peer, f"Lost connection with {peer}: {error}")
+                return
+    
+    def send_queue_stats(self):
+        """Depth, bytes, drops and time spent blocked for each connected peer's send queue"""
+        stats = {}
+        for peer in list(self.peerList):
+            outbox = self.outboxes.get(peer.connection) if peer.connection else None
+            if outbox is not None:
+                stats[str(peer)] = outbox.as_dict()
+        return stats
+    
+    def send_file(self, path):
+        """Stream a file to every connected peer in chunks"""
+        transfers = []
+        for peer in list(self.peerList):
+            if peer.connection:
+                send = lambda frame, peer=peer: self._send_to_peer(peer, encode_frame(frame), BLOCK)
+                sendfile = lambda prefix, *source, peer=peer: self._sendfile_to_peer(peer, prefix, *source)
+                transfers.append(self.transfers.send_file(path, send, str(peer), self._transfer_key(peer),
+                                                          sendfile=sendfile))
+        return transfers
+    
+    def resume_transfers(self, peer):
+        """Restart file sends to this peer that a dropped connection interrupted"""
+        send = lambda frame: self._send_to_peer(peer, encode_frame(frame), BLOCK)
+        sendfile = lambda prefix, *source: self._sendfile_to_peer(peer, prefix, *source)
+        return self.transfers.resume(self._transfer_key(peer), send, str(peer), sendfile)
+    
+    def _sendfile_to_peer(self, peer, prefix, path, offset, count):
+        """Send prefix plus a range of a file as one frame, zero-copy on a plain socket"""
+        with open(path, 'rb') as source:
+            connection = peer.connection
+            if not isinstance(connection, socket.socket):
+                #punched UDP paths and the like only take bytes
+                source.seek(offset)
+                return self._send_to_peer(peer, encode_frame(prefix + source.read(count)), BLOCK)
+            #written by the connection's writer so it cannot overtake frames queued before it
+            sent = self._outbox(peer).run(lambda: send_file_frame(connection, prefix, source, offset, count), count)
+        if sent != count:
+            #the frame went out short, nothing after it would parse on the other side
+            self._drop_peer(peer, f"Lost connection with {peer}: file changed while sending")
+            raise ConnectionError(f"{path} changed while sending")
+    
+    def share_file(self, path):
+        """Announce a file to the swarm, peers fetch its chunks from whoever already has them"""
+        return self.swarm.share(path)
+    
+    def _reachable_keys(self):
+        """Keys of the approved peers tagged frames can be sent to"""
+        return [self._transfer_key(peer) for peer in list(self.peerList) if peer.connection]
+    
+    def _send_to_key(self, peer_key, frame):
+        #unconfirmed peers included so replies reach whoever started a transfer with us
+        for peer in list(self.peerList) + list(self.unconfirmedList):
+            if peer.connection and self._transfer_key(peer) == peer_key:
+                self._send_to_peer(peer, encode_frame(frame), *self._send_mode())
+                return
+        raise ConnectionError(f"No connection to {peer_key}")
+    
+    def _send_mode(self):
+        """Policy and headroom for a send, a reader thread must not wait on any one peer"""
+        #waiting here would stop every peer's frames being read, so a reply to a peer that is
+        #not reading drops once the headroom past its queue's bounds is used up too
+        if getattr(self.dispatching, 'active', False):
+            return DROP, True
+        return BLOCK, False
+    
+    def _handle_tagged_frame(self, frame, peer_key, peer=None, approved=False):
+        """Route a transfer, swarm or task frame, returns False for plain messages.
+
+        Transfers write files, swarm requests read chunks and task assignments run code, so
+        these frames are only taken from approved peers and dropped for anyone else, apart
+        from acks for files we chose to send to a peer.
+        """
+        if not (is_transfer_frame(frame) or is_swarm_frame(frame) or is_task_frame(frame)):
+            return False
+        self.dispatching.active = True
+        try:
+            reply = lambda data: self._send_to_key(peer_key, data)
+            if not approved and not (is_transfer_frame(frame) and self.transfers.is_reply(frame)):
+                self._refuse_frame(frame, peer_key, peer)
+                if is_transfer_frame(frame):
+                    self.transfers.refuse(frame, reply)
+            elif is_transfer_frame(frame):
+                self.transfers.handle_frame(frame, reply, peer)
+            elif is_swarm_frame(frame):
+                self.swarm.handle_frame(frame, peer_key, peer)
+            else:
+                self.tasks.handle_frame(frame, peer_key, peer)
+        except Exception as e:
+            print(f"Error handling frame from {peer}: {e}")
+        finally:
+            self.dispatching.active = False
+        return True
+    
+    def _refuse_frame(self, frame, peer_key, peer):
+        #one alert per peer, the frames themselves are dropped
+        if peer_key not in self.refused:
+            self.refused.add(peer_key)
+            self._alert(Message(f"Ignoring file, swarm and task frames from {peer} until it is approved"))
+    
+    def _handle_control_frame(self, frame, peer):
+        """Answer link-level frames, returns False for anything else"""
+        if frame.startswith(OFFER_TAG):
+            try:
+                peer.codec = decode_offer(frame)
+            except Exception as e:
+                print(f"Bad codec offer from {peer}: {e}")
+            return True
+        if frame == PING_FRAME:
+            try:
+                self._send_to_peer(peer, encode_frame(PONG_FRAME), DROP, True)
+            except Exception as e:
+                print(f"Error answering ping from {peer}: {e}")
+            return True
+        return frame == PONG_FRAME
+    
+    def _offer_codecs(self, peer):
+        """Tell a new connection which codecs we decode, it compresses what it sends us from then on"""
+        try:
+            self._send_to_peer(peer, encode_frame(encode_offer()))
+        except Exception as e:
+            print(f"Error offering codecs to {peer}: {e}")
+    
+    def compression_stats(self):
+        """Compression ratio and CPU time per connected peer"""
+        return {str(peer): dict(peer.compression.as_dict(), codec=peer.codec.name if peer.codec else None)
+                for peer in list(self.peerList) if peer.connection}
+    
+    def ping(self, peer):
+        """Ask a peer for a pong, any frame back refreshes its last_seen"""
+        try:
+            self._send_to_peer(peer, encode_frame(PING_FRAME))
+        except Exception as e:
+            self._drop_peer(peer, f"Lost connection with {peer}: {e}")
+    
+    def _transfer_key(self, peer):
+        #identifies a peer across reconnects, so interrupted sends can be picked up again
+        return getattr(peer, 'peer_id', None) or f"{peer.ip}:{peer.port}"
+    
+    def _transfer_complete(self, path, peer):
+        self._alert(Message("<file> " + path), peer)
+    
+    def _transfer_failed(self, reason, peer):
+        self._alert(Message(reason), peer)
+    
+    def _task_finished(self, task):
+        self._alert(Message(f"<task> {task.name} {task.status} on {task.worker} after {task.attempts} attempt(s)"))
+    
+    def _task_event(self, message):
+        self._alert(Message(message))
+    
     def approve(self, peer):
         if peer in self.unconfirmedList:
             self.unconfirmedList.remove(peer)
             self.peerList.append(peer)
+            self.refused.discard(self._transfer_key(peer))
+            self._register_peer(peer)
             self._alert(Message(f"Peer {peer} approved"))
     
     def shutdown(self):
         self.running = False
+        self._wakeup()
         #closing all connections
-        for peer in self.peerList:
+        for peer in self.peerList + self.unconfirmedList:
+            self._unregister_peer(peer)
             if peer.connection:
+                self._close_outbox(peer.connection)
                 try:
                     peer.connection.close()
                 except:
@@ -95,48 +345,130 @@ class Network:
                 client_socket, (client_ip, client_port) = self.server_socket.accept()
                 peer = Peer(client_ip, client_port, client_socket)
                 self.unconfirmedList.append(peer)
+                self._register_peer(peer)
+                self._offer_codecs(peer)
                 self._alert(Message(f"New connection from {peer}"))
             except Exception as e:
                 if self.running:  #only print error if we're still supposed to be running
                     print(f"Error accepting connection: {e}")
             time.sleep(0.1)
     
+    def _register_peer(self, peer):
+        """Start watching a peer's socket for incoming data"""
+        #connections without a file descriptor (punched UDP paths) deliver their own data
+        if not peer.connection or not hasattr(peer.connection, 'fileno'):
+            return
+        try:
+            self.selector.register(peer.connection, selectors.EVENT_READ, peer)
+        except KeyError:
+            #already registered, just make sure it points at this peer
+            self.selector.modify(peer.connection, selectors.EVENT_READ, peer)
+        except (ValueError, OSError) as e:
+            print(f"Error registering {peer}: {e}")
+            return
+        self._wakeup()
+    
+    def _unregister_peer(self, peer):
+        """Stop watching a peer's socket"""
+        if not peer.connection:
+            return
+        try:
+            self.selector.unregister(peer.connection)
+        except (KeyError, ValueError, OSError):
+            pass
+    
+    def _wakeup(self):
+        try:
+            self._wakeup_writer.send(b"\0")
+        except (BlockingIOError, OSError):
+            pass
+    
+    def _drop_peer(self, peer, reason):
+        """Close a peer connection and forget about it"""
+        self._unregister_peer(peer)
+        self.swarm.peer_lost(self._transfer_key(peer))
+        self.tasks.peer_lost(self._transfer_key(peer))
+        try:
+            if peer.connection:
+                self._close_outbox(peer.connection)
+                peer.connection.close()
+        except:
+            pass
+        peer.connection = None
+        if peer in self.peerList:
+            self.peerList.remove(peer)
+        if peer in self.unconfirmedList:
+            self.unconfirmedList.remove(peer)
+        self._alert(Message(reason))
+    
     def _receive_messages(self):
-        while self.running:
-            all_peers = self.peerList + self.unconfirmedList
-            for peer in all_peers:
-                if peer.connection:
-                    try:
-                        peer.connection.setblocking(0)
+        try:
+            while self.running:
+                try:
+                    events = self.selector.select(timeout=1.0)
+                except OSError as e:
+                    if self.running:
+                        print(f"Error waiting for peers: {e}")
+                    continue
+                for key, mask in events:
+                    if key.fileobj is self._wakeup_reader:
                         try:
-                            data = peer.connection.recv(4096)
-                            if data:
-                                message = Message(data.decode())
-                                self._alert(message, str(peer))
-                            else:
-                                peer.connection.close()
-                                peer.connection = None
-                                if peer in self.peerList:
-                                    self.peerList.remove(peer)
-                                if peer in self.unconfirmedList:
-                                    self.unconfirmedList.remove(peer)
-                                self._alert(Message(f"Connection closed with {peer}"))
-                        except BlockingIOError:
+                            while self._wakeup_reader.recv(4096):
+                                pass
+                        except (BlockingIOError, OSError):
                             pass
-                        finally:
-                            if peer.connection:
-                                peer.connection.setblocking(1)
+                        continue
+                    try:
+                        self._read_from_peer(key.data)
                     except Exception as e:
-                        print(f"Error receiving from {peer}: {e}")
-                        try:
-                            if peer.connection:
-                                peer.connection.close()
-                                peer.connection = None
-                        except:
-                            pass
-                        if peer in self.peerList:
-                            self.peerList.remove(peer)
-                        if peer in self.unconfirmedList:
-                            self.unconfirmedList.remove(peer)
-                        self._alert(Message(f"Lost connection with {peer}: {e}"))
-            time.sleep(0.1)
\ No newline at end of file
+                        #whatever one peer sent, the loop keeps serving the others
+                        print(f"Error handling data from {key.data}: {e}")
+                        self._drop_peer(key.data, f"Lost connection with {key.data}: {e}")
+        finally:
+            try:
+                self.selector.close()
+            except:
+                pass
+            for sock in (self._wakeup_reader, self._wakeup_writer):
+                try:
+                    sock.close()
+                except:
+                    pass
+    
+    def _read_from_peer(self, peer):
+        if not peer.connection:
+            return
+        try:
+            frames = peer.read_buffer.recv_from(peer.connection)
+        except (BlockingIOError, InterruptedError):
+            return
+        except Exception as e:
+            print(f"Error receiving from {peer}: {e}")
+            self._drop_peer(peer, f"Lost connection with {peer}: {e}")
+            return
+        if frames is None:
+            self._drop_peer(peer, f"Connection closed with {peer}")
+            return
+        self._handle_frames(peer, frames)
+    
+    def _handle_frames(self, peer, frames):
+        peer.last_seen = time.time()
+        for frame in frames:
+            if is_compressed(frame):
+                try:
+                    frame = decompress_payload(frame, peer.compression)
+                except Exception as e:
+                    print(f"Error decompressing frame from {peer}: {e}")
+                    continue
+            self._handle_frame(peer, frame)
+    
+    def _handle_frame(self, peer, frame):
+        """Dispatch one decompressed frame"""
+        if self._handle_control_frame(frame, peer):
+            return
+        if self._handle_tagged_frame(frame, self._transfer_key(peer), str(peer), peer in self.peerList):
+            return
+        #large payloads reach alerters as the mapped frame itself, never decoded into a string
+        message = Message(frame if isinstance(frame, MappedFrame) else frame.decode(errors='replace'))
+        self._alert(message, str(peer))
+
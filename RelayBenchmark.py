@@ -0,0 +1,141 @@
+# RelayBenchmark.py
+import argparse
+import asyncio
+import json
+import logging
+import multiprocessing
+import time
+from Framing import FrameBuffer, encode_json
+
+def run_server(kind, host, port, workers):
+    """Server process entry point"""
+    if kind == 'threaded':
+        from RelayServer import RelayServer
+        server = lambda: RelayServer(host, port)
+    elif kind == 'async':
+        from AsyncRelayServer import AsyncRelayServer
+        server = lambda: AsyncRelayServer(host, port)
+    else:
+        from ShardedRelayServer import ShardedRelayServer
+        server = lambda: ShardedRelayServer(host, port, workers)
+    logging.getLogger().setLevel(logging.WARNING)
+    server().start()
+
+class BenchClient:
+    """Minimal load-generating relay client"""
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.read_buffer = FrameBuffer()
+        self.pending = []
+        self.peer_id = None
+
+    async def read_json(self):
+        while not self.pending:
+            data = await self.reader.read(65536)
+            if not data:
+                raise ConnectionError("Relay closed the connection")
+            self.pending.extend(self.read_buffer.feed(data))
+        return json.loads(self.pending.pop(0).decode('utf-8'))
+
+    async def register(self):
+        self.writer.write(encode_json({'command': 'register', 'ip': '127.0.0.1', 'port': 0}))
+        response = await self.read_json()
+        self.peer_id = response['peer_id']
+
+async def connect_clients(host, port, count, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one():
+        async with semaphore:
+            reader, writer = await asyncio.open_connection(host, port)
+            client = BenchClient(reader, writer)
+            await client.register()
+            return client
+
+    start = time.perf_counter()
+    results = await asyncio.gather(*(one() for _ in range(count)), return_exceptions=True)
+    elapsed = time.perf_counter() - start
+    # A server with a short accept backlog resets some connections, count them instead of aborting
+    clients = [r for r in results if isinstance(r, BenchClient)]
+    return clients, len(results) - len(clients), elapsed
+
+async def relay_load(clients, pairs, messages, payload_size):
+    """Each sender pipelines messages to its receiver, timed until every receiver saw all of them"""
+    payload = 'x' * payload_size
+
+    async def send(sender, target):
+        for _ in range(messages):
+            sender.writer.write(encode_json({
+                'command': 'relay_message',
+                'peer_id': sender.peer_id,
+                'target_id': target.peer_id,
+                'content': payload
+            }))
+            await sender.writer.drain()
+        for _ in range(messages):
+            await sender.read_json()
+
+    received = [0] * pairs
+
+    async def receive(index, receiver):
+        while received[index] < messages:
+            message = await receiver.read_json()
+            if message.get('type') == 'relayed':
+                received[index] += 1
+
+    tasks = []
+    for i in range(pairs):
+        sender, receiver = clients[2 * i], clients[2 * i + 1]
+        tasks.append(send(sender, receiver))
+        tasks.append(receive(i, receiver))
+    start = time.perf_counter()
+    # Peers the server dropped along the way just stop counting
+    await asyncio.gather(*tasks, return_exceptions=True)
+    return sum(received), time.perf_counter() - start
+
+async def bench(host, port, args):
+    clients, failed, connect_time = await connect_clients(host, port, args.clients, args.concurrency)
+    pairs = min(args.pairs, len(clients) // 2)
+    relayed, relay_time = await relay_load(clients, pairs, args.messages, args.payload)
+    for client in clients:
+        client.writer.close()
+    return {
+        'connections': len(clients),
+        'failed': failed,
+        'connect_rate': len(clients) / connect_time,
+        'relayed': relayed,
+        'relay_rate': relayed / relay_time
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='Relay server load benchmark')
+    parser.add_argument('--servers', nargs='+', default=['threaded', 'async'], choices=['threaded', 'async', 'sharded'])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=23456)
+    parser.add_argument('--clients', type=int, default=200, help='Concurrent registered peers')
+    parser.add_argument('--concurrency', type=int, default=10, help='Connection attempts in flight')
+    parser.add_argument('--pairs', type=int, default=50, help='Sender/receiver pairs relaying traffic')
+    parser.add_argument('--messages', type=int, default=200, help='Messages per sender')
+    parser.add_argument('--payload', type=int, default=256, help='Payload size in bytes')
+    parser.add_argument('--workers', type=int, default=None, help='Worker processes for the sharded server')
+    args = parser.parse_args()
+
+    results = {}
+    for offset, kind in enumerate(args.servers):
+        port = args.port + offset
+        server = multiprocessing.Process(target=run_server, args=(kind, args.host, port, args.workers))
+        server.start()
+        time.sleep(1.0)
+        try:
+            results[kind] = asyncio.run(bench(args.host, port, args))
+        finally:
+            server.terminate()
+            server.join()
+
+    print(f"{'server':<10} {'peers':>8} {'failed':>7} {'conn/s':>10} {'relayed':>9} {'msg/s':>10}")
+    for kind, r in results.items():
+        print(f"{kind:<10} {r['connections']:>8} {r['failed']:>7} {r['connect_rate']:>10.0f} {r['relayed']:>9} {r['relay_rate']:>10.0f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+import itertools
+import logging
+import socket
+import threading
+import time
+from concurrent.futures import Future
+from Serialization import ACK_REQUESTED, decode_message, decode_routed, encode_routed, is_routed
+
+logger = logging.getLogger('relay_client')
+
+REQUEST_TIMEOUT = 10
+
+class RelayClient:
+    """Multiplexes commands over one relay connection.
+
+    Every request carries a request_id that the relay echoes in its reply, so any number of
+    requests can be in flight at once. run() is the only reader of the connection: replies
+    resolve the matching future, routed frames go to on_routed(sender_id, payload) and
+    everything else (relayed messages, membership pushes) to on_message(message).
+    """
+    def __init__(self, connection, on_message, on_routed=None):
+        self.connection = connection
+        self.on_message = on_message
+        self.on_routed = on_routed
+        self.pending = {}  # {request_id: Future}
+        self.request_ids = itertools.count(1)
+        self.lock = threading.Lock()
+        self.closed = False
+        self.last_sent = time.time()  # Anything we send proves to the relay that we are alive
+
+    def request_async(self, message):
+        """Send a command without waiting, returns a Future resolving to the relay's reply"""
+        return self._request(lambda request_id: self.connection.send_json(dict(message, request_id=request_id)))
+
+    def route_async(self, target_ids, payload):
+        """Relay payload through the fast path, returns a Future resolving to the relay's ack"""
+        return self._request(lambda request_id: self.connection.send(
+            encode_routed(target_ids, payload, request_id, ACK_REQUESTED)))
+
+    def route(self, target_ids, payload):
+        """Relay payload through the fast path without asking for an ack"""
+        self.connection.send(encode_routed(target_ids, payload))
+        self.last_sent = time.time()
+
+    def _request(self, send):
+        future = Future()
+        with self.lock:
+            if self.closed:
+                future.set_exception(ConnectionError("Relay connection closed"))
+                return future
+            request_id = next(self.request_ids)
+            self.pending[request_id] = future
+        try:
+            send(request_id)
+            self.last_sent = time.time()
+        except Exception as e:
+            with self.lock:
+                self.pending.pop(request_id, None)
+            future.set_exception(e)
+        return future
+
+    def request(self, message, timeout=REQUEST_TIMEOUT):
+        """Send a command and block until its reply arrives"""
+        return self.request_async(message).result(timeout)
+
+    def send(self, message):
+        """Send a command that gets no reply, like disconnect"""
+        self.connection.send_json(message)
+        self.last_sent = time.time()
+
+    def run(self):
+        """Read and dispatch until the connection closes"""
+        try:
+            while True:
+                try:
+                    frame = self.connection.read_frame()
+                except socket.timeout:
+                    continue
+                if frame is None:
+                    break
+                if is_routed(frame):
+                    self.dispatch_routed(frame)
+                else:
+                    self.dispatch(decode_message(frame))
+        except Exception as e:
+            if not self.closed:
+                logger.warning(f"Relay connection failed: {e}")
+        finally:
+            self._fail_pending()
+
+    def dispatch(self, message):
+        request_id = message.get('request_id')
+        if request_id is not None:
+            with self.lock:
+                future = self.pending.pop(request_id, None)
+            if future is not None:
+                future.set_result(message)
+            return
+        try:
+            self.on_message(message)
+        except Exception as e:
+            logger.error(f"Error handling relay message: {e}")
+
+    def dispatch_routed(self, frame):
+        try:
+            _, _, sender_ids, payload = decode_routed(frame)
+            self.on_routed(sender_ids[0], payload)
+        except Exception as e:
+            logger.error(f"Error handling routed frame: {e}")
+
+    def _fail_pending(self):
+        with self.lock:
+            self.closed = True
+            pending, self.pending = self.pending, {}
+        for future in pending.values():
+            future.set_exception(ConnectionError("Relay connection closed"))
+
+    def close(self):
+        self.closed = True
+        try:
+            self.connection.close()
+        except Exception:
+            pass
@@ -1,24 +1,626 @@
 import socket
 import threading
 import json
+import math
 import time
 import uuid
 import logging
+from collections import deque
+from Framing import FramedConnection, FramingError, encode_frame
+from Compression import compress_payload, negotiate
+from Serialization import ACK_REQUESTED, decode_message, decode_routed, encode_routed, is_routed, negotiate_serializer
+from CapabilityIndex import CapabilityIndex, parse_capabilities
+from Liveness import LivenessTracker, PhiAccrualDetector
+from TrafficControl import BYTE_RATE, MESSAGE_RATE, FairQueue, SenderLimits, TrafficStats
+from HolePunch import ENDPOINT
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger('relay_server')
 
-class RelayServer:
+MEMBERSHIP_LOG_SIZE = 10000  # Changes kept for delta get_peers, older clients get a full snapshot
+PEER_TIMEOUT = 120  # Longest a silent peer is kept, its failure detector usually gives up sooner
+LIVENESS_TICK = 1  # Expired peers are dropped at most this long after their deadline
+DEFAULT_HEARTBEAT_INTERVAL = 30  # Assumed for clients that don't say how often they check in
+MIN_HEARTBEAT_INTERVAL = 1  # Promised intervals are clamped to these bounds
+MAX_HEARTBEAT_INTERVAL = 60
+RESUME_WINDOW = 60  # How long a peer whose connection dropped can come back under the same id
+HELD_MESSAGES = 1000  # Relayed messages kept for a dropped peer until it resumes, oldest go first
+UNBOUND_COMMANDS = {'register', 'stats'}  # Commands a connection may send before it is a registered peer
+
+def parse_interval(interval):
+    """Heartbeat interval a peer promised, clamped to the bounds, ValueError if it is not a positive number"""
+    if isinstance(interval, bool) or not isinstance(interval, (int, float)):
+        raise ValueError("interval must be a number")
+    if not math.isfinite(interval) or interval <= 0:
+        raise ValueError("interval must be positive and finite")
+    return min(max(interval, MIN_HEARTBEAT_INTERVAL), MAX_HEARTBEAT_INTERVAL)
+
+class RelayRegistry:
+    """Peer registry and command handling shared by the relay server front ends.
+
+    Front ends own the sockets; they hand every decoded command to _handle_command, and
+    every routed frame to _handle_routed, together with a connection object exposing
+    send_json(), send_encoded() and close(), and the serializer, codec and compression
+    stats send_json() encodes with. Relayed frames go through send_relayed(sender_id, frame),
+    which queues them fairly across senders and returns False when the sender's queue is
+    full, and throttle(seconds) stops reading from a sender over its rate limits.
+    """
+    def __init__(self):
+        self.peers = {}  # Dictionary to store registered peers {peer_id: {ip, port, last_active, capabilities}}
+        self.connections = {}  # Active connections {peer_id: connection}
+        self.capabilities = CapabilityIndex()  # Peers by cores and load, for find_peers
+        self.liveness = LivenessTracker(PEER_TIMEOUT, LIVENESS_TICK)  # Deadlines of the peers we expire
+        self.detectors = {}  # Failure detectors setting those deadlines {peer_id: PhiAccrualDetector}
+        # Membership is versioned so get_peers can answer with what changed since a client's version.
+        # The epoch changes with every registry, versions from another server instance never match.
+        self.epoch = uuid.uuid4().hex
+        self.version = 0
+        self.membership_log = deque(maxlen=MEMBERSHIP_LOG_SIZE)  # (version, peer_id, added)
+        self.membership_lock = threading.Lock()
+        self.subscribers = {}  # Peers pushed membership changes {peer_id: connection}
+        self.held = {}  # Messages for dropped peers, delivered if they resume {peer_id: deque}
+        self.message_rate = MESSAGE_RATE  # What each sender may relay, for peers registering from now on
+        self.byte_rate = BYTE_RATE
+        self.limits = {}  # {peer_id: SenderLimits}
+        self.traffic = TrafficStats()  # Throttled and dropped relay traffic
+        self.running = True
+        self.commands = {
+            'register': self._cmd_register,
+            'heartbeat': self._cmd_heartbeat,
+            'get_peers': self._cmd_get_peers,
+            'find_peers': self._cmd_find_peers,
+            'subscribe': self._cmd_subscribe,
+            'relay_message': self._cmd_relay_message,
+            'multicast': self._cmd_multicast,
+            'punch': self._cmd_punch,
+            'stats': self._cmd_stats
+        }
+    
+    def _new_peer_id(self):
+        return str(uuid.uuid4())
+    
+    def _handle_command(self, message, connection, peer_id):
+        """Process one command, returns the peer id bound to the connection and whether to keep it open"""
+        command = message.get('command')
+        if command == 'disconnect':
+            # Only ever the peer this connection registered as, whatever id the message names
+            if peer_id in self.peers and message.get('peer_id', peer_id) == peer_id:
+                logger.info(f"Peer {peer_id} disconnecting")
+                self._remove_peer(peer_id)
+            return peer_id, False
+        if peer_id in self.peers and command != 'heartbeat':
+            self._touch(peer_id)  # Any traffic proves the peer is alive, heartbeats are only for idle ones
+        
+        handler = self.commands.get(command)
+        if handler is None:
+            self._reply(connection, message, {'status': 'error', 'message': 'Unknown command'})
+            return peer_id, True
+        if command not in UNBOUND_COMMANDS:
+            # Commands act as the peer bound to the connection, the id a message claims is only checked
+            if peer_id not in self.peers:
+                self._reply(connection, message, {'status': 'error', 'message': 'Peer not registered'})
+                return peer_id, True
+            if message.get('peer_id', peer_id) != peer_id:
+                self._reply(connection, message, {'status': 'error', 'message': 'Peer id does not match the connection'})
+                return peer_id, True
+        return handler(message, connection, peer_id), True
+    
+    def _reply(self, connection, message, response):
+        """Answer a command, echoing its request_id so a pipelining client can match the reply"""
+        if 'request_id' in message:
+            response['request_id'] = message['request_id']
+        connection.send_json(response)
+    
+    def _cmd_register(self, message, connection, peer_id):
+        """Register a new peer, or take back a dropped one presenting its resume token"""
+        try:
+            parse_capabilities(message.get('capabilities', {}))
+        except ValueError as e:
+            # Refused before anything is stored, so no half-registered peer is left behind
+            self._reply(connection, message, {'status': 'error', 'message': f"Bad capabilities: {e}"})
+            return peer_id
+        try:
+            interval = parse_interval(message.get('interval', DEFAULT_HEARTBEAT_INTERVAL))
+        except ValueError as e:
+            self._reply(connection, message, {'status': 'error', 'message': f"Bad interval: {e}"})
+            return peer_id
+        resume = message.get('resume') or {}
+        if resume and not self._owns(resume.get('peer_id')):
+            response = {'status': 'error', 'message': 'Peer belongs to another worker', 'retry': True}
+            self._reply(connection, message, response)
+            return peer_id
+        if self._resumable(resume.get('peer_id'), resume.get('token')):
+            peer_id = resume['peer_id']
+            info = self.peers[peer_id]
+            info['ip'] = message.get('ip')
+            info['port'] = message.get('port')
+            self._update_capabilities(peer_id, message.get('capabilities', {}))
+            stale = self.connections.get(peer_id)
+            self.connections[peer_id] = connection
+            if stale is not None and stale is not connection:
+                # A half-open connection the peer already gave up on
+                try:
+                    stale.close()
+                except:
+                    pass
+            logger.info(f"Peer {peer_id} resumed its session")
+        else:
+            peer_id = self._new_peer_id()
+            self._add_peer(peer_id, {
+                'ip': message.get('ip'),
+                'port': message.get('port'),
+                'last_active': time.time(),
+                'capabilities': message.get('capabilities', {}),
+                'udp_token': uuid.uuid4().hex,  # Proves a UDP endpoint registration comes from this peer
+                'resume_token': uuid.uuid4().hex  # Lets the peer reclaim this id after a dropped connection
+            })
+            self.connections[peer_id] = connection
+            logger.info(f"Registered peer {peer_id} at {message.get('ip')}:{message.get('port')}")
+        if peer_id not in self.limits:
+            self.limits[peer_id] = SenderLimits(self.message_rate, self.byte_rate)
+        detector = self.detectors[peer_id] = PhiAccrualDetector(interval)
+        self.liveness.touch(peer_id, detector.timeout())
+        
+        codec = negotiate(message.get('codecs'))
+        serializer = negotiate_serializer(message.get('serializers'))
+        response = {
+            'status': 'success',
+            'peer_id': peer_id,
+            'udp_token': self.peers[peer_id]['udp_token'],
+            'resume_token': self.peers[peer_id]['resume_token'],
+            'codec': codec.name if codec else None,
+            'serializer': serializer.name  # Also tells the client we take routed frames
+        }
+        self._reply(connection, message, response)
+        # Everything after the reply may be compressed and in the negotiated format
+        connection.codec = codec
+        connection.serializer = serializer
+        held = self.held.pop(peer_id, None)
+        if held:
+            logger.info(f"Delivering {len(held)} messages held for {peer_id}")
+            for held_message in held:
+                self._deliver([peer_id], held_message)
+        return peer_id
+    
+    def _owns(self, peer_id):
+        """Whether a session for peer_id can be resumed on this server"""
+        return True
+    
+    def _resumable(self, peer_id, token):
+        info = self.peers.get(peer_id)
+        return info is not None and token is not None and info.get('resume_token') == token
+    
+    def _cmd_heartbeat(self, message, connection, peer_id):
+        try:
+            if 'interval' in message:
+                parse_interval(message['interval'])
+        except ValueError as e:
+            self._reply(connection, message, {'status': 'error', 'message': f"Bad interval: {e}"})
+            return peer_id
+        self._touch(peer_id, message)
+        response = {'status': 'success'}
+        if 'capabilities' in message:
+            try:
+                self._update_capabilities(peer_id, message['capabilities'])
+            except ValueError as e:
+                response = {'status': 'error', 'message': f"Bad capabilities: {e}"}
+        self._reply(connection, message, response)
+        return peer_id
+    
+    def _cmd_get_peers(self, message, connection, peer_id):
+        """Full peer list, or only the peers added and removed since the client's version"""
+        response = self._membership_delta(message.get('epoch'), message.get('since'), peer_id)
+        if response is None:
+            with self.membership_lock:
+                version = self.version
+                peer_list = [self._peer_entry(pid) for pid in list(self.peers) if pid != peer_id]
+            response = {
+                'status': 'success',
+                'epoch': self.epoch,
+                'version': version,
+                'full': True,
+                'peers': peer_list
+            }
+        self._reply(connection, message, response)
+        return peer_id
+    
+    def _membership_delta(self, epoch, since, peer_id):
+        """Changes after version since, None when they are no longer in the log"""
+        if epoch != self.epoch or since is None:
+            return None
+        with self.membership_lock:
+            oldest = self.membership_log[0][0] if self.membership_log else self.version + 1
+            if since < oldest - 1 or since > self.version:
+                return None
+            latest = {}
+            for version, pid, added in reversed(self.membership_log):
+                if version <= since:
+                    break
+                latest.setdefault(pid, added)
+            added = [self._peer_entry(pid) for pid, was_added in latest.items()
+                     if was_added and pid in self.peers and pid != peer_id]
+            removed = [pid for pid, was_added in latest.items() if not was_added]
+            version = self.version
+        return {
+            'status': 'success',
+            'epoch': self.epoch,
+            'version': version,
+            'full': False,
+            'added': added,
+            'removed': removed
+        }
+    
+    def _peer_entry(self, peer_id):
+        info = self.peers[peer_id]
+        return {'peer_id': peer_id, 'ip': info['ip'], 'port': info['port']}
+    
+    def _cmd_subscribe(self, message, connection, peer_id):
+        """Push membership changes to this peer as they happen"""
+        self.subscribers[peer_id] = connection
+        self._reply(connection, message, {'status': 'success', 'epoch': self.epoch, 'version': self.version})
+        return peer_id
+    
+    def _cmd_find_peers(self, message, connection, peer_id):
+        """The least-loaded peers meeting the requested cores, memory and runtime"""
+        matches = self.capabilities.least_loaded(
+            int(message.get('count', 1)),
+            int(message.get('min_cores', 1)),
+            message.get('min_memory_mb'),
+            message.get('runtime'),
+            exclude=peer_id
+        )
+        response = {
+            'status': 'success',
+            'peers': [
+                {
+                    'peer_id': pid,
+                    'ip': self.peers[pid]['ip'],
+                    'port': self.peers[pid]['port'],
+                    'capabilities': capabilities
+                }
+                for pid, capabilities in matches
+            ]
+        }
+        self._reply(connection, message, response)
+        return peer_id
+    
+    def _cmd_relay_message(self, message, connection, peer_id):
+        target_id = message.get('target_id')
+        content = message.get('content')
+        
+        if target_id in self.connections or target_id in self.held:
+            if not self._admit(peer_id, connection, 1, self._content_size(content)):
+                response = {'status': 'error', 'message': 'Rate limited'}
+            elif self._deliver([target_id], self._relayed(peer_id, content))[0]:
+                response = {'status': 'success'}
+            else:
+                response = {'status': 'error', 'message': f'Failed to relay to {target_id}'}
+        else:
+            response = {'status': 'error', 'message': 'Invalid peer IDs'}
+        if message.get('ack', True):
+            self._reply(connection, message, response)
+        return peer_id
+    
+    def _cmd_multicast(self, message, connection, peer_id):
+        """Relay one payload to many peers, the content is uploaded and encoded once"""
+        target_ids = message.get('target_ids', [])
+        content = message.get('content')
+        # Every copy the relay sends counts against the sender's limits
+        if not self._admit(peer_id, connection, len(target_ids), self._content_size(content) * len(target_ids)):
+            response = {'status': 'error', 'message': 'Rate limited'}
+        else:
+            delivered, failed = self._route(target_ids, self._relayed(peer_id, content))
+            # One ack covers every target
+            response = {'status': 'success', 'delivered': delivered, 'failed': failed}
+        if message.get('ack', True):
+            self._reply(connection, message, response)
+        return peer_id
+    
+    def _cmd_punch(self, message, connection, peer_id):
+        """Introduce two peers' public UDP endpoints so they can punch a direct path"""
+        sender_id = peer_id
+        target_id = message.get('target_id')
+        sender = self.peers.get(sender_id)
+        target = self.peers.get(target_id)
+        
+        if sender is None or target is None:
+            response = {'status': 'error', 'message': 'Invalid peer IDs'}
+        elif not sender.get('udp') or not target.get('udp'):
+            response = {'status': 'error', 'message': 'No UDP endpoint registered'}
+        else:
+            # Both sides start probing as soon as they hear from us, the token pairs their probes
+            token = uuid.uuid4().hex
+            introduction = {
+                'type': 'punch',
+                'peer_id': sender_id,
+                'ip': sender['ip'],
+                'port': sender['port'],
+                'endpoint': sender['udp'],
+                'token': token
+            }
+            if self._push(target_id, introduction):
+                response = {'status': 'success', 'endpoint': target['udp'], 'token': token}
+            else:
+                response = {'status': 'error', 'message': 'Target unreachable'}
+        self._reply(connection, message, response)
+        return peer_id
+    
+    def _handle_routed(self, frame, connection, peer_id):
+        """Relay fast path: swap the target ids for the sender's and pass the payload on undecoded"""
+        flags, request_id, target_ids, payload = decode_routed(frame)
+        if peer_id in self.peers:
+            self._touch(peer_id)
+            if not self._admit(peer_id, connection, len(target_ids), len(payload) * len(target_ids)):
+                response = {'status': 'error', 'message': 'Rate limited'}
+            else:
+                delivered, failed = self._route(target_ids, encode_routed([peer_id], payload))
+                response = {'status': 'success', 'delivered': delivered, 'failed': failed}
+        else:
+            response = {'status': 'error', 'message': 'Peer not registered'}
+        if flags & ACK_REQUESTED:
+            self._reply(connection, {'request_id': request_id}, response)
+    
+    def _handle_datagram(self, data, address):
+        """Record the public UDP endpoint a peer's datagram came from, returns the reply or None"""
+        if not data or data[0] != ENDPOINT:
+            return None
+        try:
+            message = json.loads(data[1:].decode('utf-8'))
+        except (ValueError, UnicodeDecodeError):
+            return None
+        info = self.peers.get(message.get('peer_id'))
+        if info is None or message.get('token') != info.get('udp_token'):
+            return None
+        info['udp'] = list(address)
+        return bytes([ENDPOINT]) + json.dumps({'endpoint': list(address)}).encode('utf-8')
+    
+    def _push(self, peer_id, message):
+        """Send an unsolicited message to a connected peer, returns whether it went out"""
+        connection = self.connections.get(peer_id)
+        if connection is None:
+            return False
+        try:
+            connection.send_json(message)
+            return True
+        except Exception as e:
+            logger.warning(f"Failed to push to {peer_id}: {e}")
+            return False
+    
+    def _cmd_stats(self, message, connection, peer_id):
+        """Relay traffic held back by the rate limits and fair queues"""
+        self._reply(connection, message, {'status': 'success', 'traffic': self.traffic.as_dict()})
+        return peer_id
+    
+    def _admit(self, sender_id, connection, messages, size):
+        """Charge relayed traffic to its sender's limits, returns False if it has to be dropped.
+
+        A sender over its limits, but by less than MAX_THROTTLE worth of traffic, is throttled
+        instead: its connection is not read from again until it is back within them.
+        """
+        limits = self.limits.get(sender_id)
+        if limits is None:
+            return True
+        wait = limits.take(messages, size)
+        if wait is None:
+            self.traffic.rate_dropped(sender_id, size)
+            return False
+        if wait > 0:
+            self.traffic.throttled(sender_id, wait)
+            connection.throttle(wait)
+        return True
+    
+    def _content_size(self, content):
+        if isinstance(content, (str, bytes)):
+            return len(content)
+        return len(json.dumps(content))
+    
+    def _relayed(self, sender_id, content):
+        return {
+            'type': 'relayed',
+            'sender_id': sender_id,
+            'sender_ip': self.peers[sender_id]['ip'],
+            'sender_port': self.peers[sender_id]['port'],
+            'content': content
+        }
+    
+    def _route(self, target_ids, message):
+        """Deliver to the targets wherever they are connected, returns (delivered count, failed ids)"""
+        return self._deliver(target_ids, message)
+    
+    def _deliver(self, target_ids, message):
+        """Send one message to each target connected here, returns (delivered count, failed ids).
+
+        message is a dict, or a routed frame sent as it is. It is encoded and compressed once
+        per serializer and codec among the targets.
+        """
+        frames = {}  # {(serializer name, codec name): frame}
+        delivered = 0
+        failed = []
+        sender_id = message.get('sender_id') if isinstance(message, dict) else decode_routed(message)[2][0]
+        for target_id in target_ids:
+            target = self.connections.get(target_id)
+            if target is None:
+                held = self.held.get(target_id)
+                if held is not None:
+                    held.append(message)  # Counts as delivered, the peer gets it when it resumes
+                    delivered += 1
+                else:
+                    failed.append(target_id)
+                continue
+            key = (target.serializer.name, target.codec.name if target.codec else None)
+            frame = frames.get(key)
+            if frame is None:
+                payload = message if isinstance(message, bytes) else target.serializer.dumps(message)
+                frame = frames[key] = encode_frame(compress_payload(payload, target.codec, target.compression))
+            try:
+                if target.send_relayed(sender_id, frame):
+                    delivered += 1
+                else:
+                    self.traffic.queue_dropped(sender_id, len(frame))
+                    failed.append(target_id)
+            except Exception as e:
+                logger.warning(f"Failed to relay to {target_id}: {e}")
+                failed.append(target_id)
+        return delivered, failed
+    
+    def _touch(self, peer_id, heartbeat=None):
+        """Note that a peer is alive, pushing back its expiry. heartbeat is the message when it is one"""
+        info = self.peers[peer_id]
+        now = time.time()
+        detector = self.detectors.get(peer_id)
+        if heartbeat is None:
+            if now - info['last_active'] < LIVENESS_TICK / 2:
+                return  # Deadlines only have tick resolution, spare the wheel on busy links
+        elif detector is not None:
+            # The gap it arrived after is measured against the interval promised before it
+            detector.heartbeat(now - info['last_active'])
+            if 'interval' in heartbeat:
+                detector.interval = parse_interval(heartbeat['interval'])
+        info['last_active'] = now
+        self.liveness.touch(peer_id, detector.timeout() if detector is not None else None)
+    
+    def _add_peer(self, peer_id, info):
+        # Indexed first, capabilities it cannot take raise before the peer is stored
+        self.capabilities.update(peer_id, info.get('capabilities', {}))
+        self.peers[peer_id] = info
+        self._record_change(peer_id, True)
+    
+    def _update_capabilities(self, peer_id, capabilities):
+        self.capabilities.update(peer_id, capabilities)
+        self.peers[peer_id]['capabilities'] = capabilities
+    
+    def _forget_peer(self, peer_id):
+        self.subscribers.pop(peer_id, None)
+        self.held.pop(peer_id, None)
+        self.limits.pop(peer_id, None)
+        self.traffic.forget(peer_id)
+        self.liveness.forget(peer_id)
+        self.detectors.pop(peer_id, None)
+        if self.peers.pop(peer_id, None) is not None:
+            self.capabilities.remove(peer_id)
+            self._record_change(peer_id, False)
+    
+    def _record_change(self, peer_id, added):
+        """Log a membership change under a new version and push it to subscribers"""
+        with self.membership_lock:
+            self.version += 1
+            self.membership_log.append((self.version, peer_id, added))
+            update = {
+                'type': 'membership',
+                'epoch': self.epoch,
+                'base': self.version - 1,
+                'version': self.version,
+                'added': [self._peer_entry(peer_id)] if added else [],
+                'removed': [] if added else [peer_id]
+            }
+        for subscriber_id, connection in list(self.subscribers.items()):
+            if subscriber_id == peer_id:
+                continue
+            try:
+                connection.send_json(update)
+            except Exception as e:
+                logger.warning(f"Failed to push membership change to {subscriber_id}: {e}")
+    
+    def _remove_peer(self, peer_id):
+        """Remove a peer from the registry"""
+        self._forget_peer(peer_id)
+        connection = self.connections.pop(peer_id, None)
+        if connection is not None:
+            try:
+                connection.close()
+            except:
+                pass
+    
+    def _connection_lost(self, peer_id, connection):
+        """A peer's connection dropped without a disconnect, keep it registered for RESUME_WINDOW"""
+        if peer_id is None or self.connections.get(peer_id) is not connection:
+            return  # Never registered, already removed, or resumed on a newer connection
+        self.connections.pop(peer_id, None)
+        self.subscribers.pop(peer_id, None)
+        if peer_id in self.peers:
+            logger.info(f"Lost connection to peer {peer_id}, holding its session for {RESUME_WINDOW}s")
+            self.held[peer_id] = deque(maxlen=HELD_MESSAGES)
+            self.liveness.touch(peer_id, RESUME_WINDOW)
+    
+    def _expire_inactive_peers(self):
+        """Drop the peers whose liveness deadline passed, call at least every LIVENESS_TICK"""
+        for peer_id in self.liveness.expired():
+            info = self.peers.get(peer_id)
+            if info is not None:
+                silence = time.time() - info['last_active']
+                detector = self.detectors.get(peer_id)
+                suspicion = f", phi {detector.phi(silence):.1f}" if detector is not None else ""
+                logger.info(f"Removing inactive peer {peer_id}, silent for {silence:.0f}s{suspicion}")
+                self._remove_peer(peer_id)
+
+class RelayConnection(FramedConnection):
+    """A client connection of the threaded relay.
+
+    Relayed frames for the client wait in a FairQueue and are written by a thread of its own,
+    so a sender's thread never blocks on a slow target and senders sharing a target take turns.
+    """
+    def __init__(self, sock):
+        super().__init__(sock)
+        self.outbox = FairQueue()
+        self.outbox_ready = threading.Condition()
+        self.writer_thread = None
+        self.closed = False
+    
+    def send_relayed(self, sender_id, frame):
+        with self.outbox_ready:
+            if self.closed:
+                raise ConnectionError("Connection closed")
+            if not self.outbox.put(sender_id, frame):
+                return False
+            if self.writer_thread is None:
+                self.writer_thread = threading.Thread(target=self._write_relayed)
+                self.writer_thread.daemon = True
+                self.writer_thread.start()
+            self.outbox_ready.notify()
+        return True
+    
+    def _write_relayed(self):
+        while True:
+            with self.outbox_ready:
+                frame = self.outbox.get()
+                while frame is None and not self.closed:
+                    self.outbox_ready.wait()
+                    frame = self.outbox.get()
+                if self.closed:
+                    return
+            try:
+                self.send_encoded(frame)
+            except Exception as e:
+                logger.warning(f"Failed to write relayed frame: {e}")
+                self.close()  # The client's reader thread notices and cleans up
+                return
+    
+    def throttle(self, seconds):
+        # Commands are handled on the sender's own thread, so this only holds up the sender
+        time.sleep(seconds)
+    
+    def close(self):
+        with self.outbox_ready:
+            self.closed = True
+            self.outbox_ready.notify_all()
+        super().close()
+
+class RelayServer(RelayRegistry):
+    """Relay front end running one thread per client"""
     def __init__(self, host='0.0.0.0', port=12345):
+        super().__init__()
         self.host = host
         self.port = port
-        self.peers = {}  # Dictionary to store registered peers {peer_id: {ip, port, last_active}}
-        self.connections = {}  # Active connections {peer_id: connection}
-        self.running = True
         self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.server_socket.bind((self.host, self.port))
         self.server_socket.listen(10)
+        # Hole punching endpoint discovery, on the same port number as the TCP listener
+        self.udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.udp_socket.bind((self.host, self.port))
+        self.udp_thread = threading.Thread(target=self._serve_datagrams)
+        self.udp_thread.daemon = True
+        self.udp_thread.start()
         self.cleanup_thread = threading.Thread(target=self._cleanup_inactive_peers)
         self.cleanup_thread.daemon = True
         self.cleanup_thread.start()
@@ -49,108 +651,37 @@ class RelayServer:
     def _handle_client(self, client_socket, address):
         """Handle client connection and messages"""
         peer_id = None
+        connection = RelayConnection(client_socket)
         try:
             logger.info(f"New connection from {address}")
             client_socket.settimeout(60)
             
             while self.running:
                 try:
-                    data = client_socket.recv(4096)
-                    if not data:
+                    frame = connection.read_frame()
+                    if frame is None:
                         break
+                    if is_routed(frame):
+                        self._handle_routed(frame, connection, peer_id)
+                        continue
                     
-                    message = json.loads(data.decode('utf-8'))
-                    command = message.get('command')
-                    
-                    if command == 'register':
-                        peer_id = str(uuid.uuid4())
-                        self.peers[peer_id] = {
-                            'ip': message.get('ip'),
-                            'port': message.get('port'),
-                            'last_active': time.time()
-                        }
-                        self.connections[peer_id] = client_socket
-                        
-                        response = {
-                            'status': 'success',
-                            'peer_id': peer_id
-                        }
-                        client_socket.sendall(json.dumps(response).encode('utf-8'))
-                        logger.info(f"Registered peer {peer_id} at {message.get('ip')}:{message.get('port')}")
-                    
-                    elif command == 'heartbeat':
-                        peer_id = message.get('peer_id')
-                        if peer_id in self.peers:
-                            self.peers[peer_id]['last_active'] = time.time()
-                            response = {'status': 'success'}
-                        else:
-                            response = {'status': 'error', 'message': 'Peer not registered'}
-                        client_socket.sendall(json.dumps(response).encode('utf-8'))
-                    
-                    elif command == 'get_peers':
-                        peer_id = message.get('peer_id')
-                        if peer_id in self.peers:
-                            self.peers[peer_id]['last_active'] = time.time()
-                            
-                            peer_list = []
-                            for pid, info in self.peers.items():
-                                if pid != peer_id:
-                                    peer_list.append({
-                                        'peer_id': pid,
-                                        'ip': info['ip'],
-                                        'port': info['port']
-                                    })
-                            
-                            response = {
-                                'status': 'success',
-                                'peers': peer_list
-                            }
-                        else:
-                            response = {'status': 'error', 'message': 'Peer not registered'}
-                        client_socket.sendall(json.dumps(response).encode('utf-8'))
-                    
-                    elif command == 'relay_message':
-                        sender_id = message.get('peer_id')
-                        target_id = message.get('target_id')
-                        content = message.get('content')
-                        
-                        if sender_id in self.peers and target_id in self.connections:
-                            relay_message = {
-                                'type': 'relayed',
-                                'sender_id': sender_id,
-                                'sender_ip': self.peers[sender_id]['ip'],
-                                'sender_port': self.peers[sender_id]['port'],
-                                'content': content
-                            }
-                            try:
-                                self.connections[target_id].sendall(json.dumps(relay_message).encode('utf-8'))
-                                response = {'status': 'success'}
-                            except Exception as e:
-                                response = {'status': 'error', 'message': f'Failed to relay: {str(e)}'}
-                        else:
-                            response = {'status': 'error', 'message': 'Invalid peer IDs'}
-                        client_socket.sendall(json.dumps(response).encode('utf-8'))
-                    
-                    elif command == 'disconnect':
-                        peer_id = message.get('peer_id')
-                        if peer_id in self.peers:
-                            logger.info(f"Peer {peer_id} disconnecting")
-                            self._remove_peer(peer_id)
+                    message = decode_message(frame)
+                    peer_id, keep_open = self._handle_command(message, connection, peer_id)
+                    if not keep_open:
                         break
-                    
-                    else:
-                        response = {'status': 'error', 'message': 'Unknown command'}
-                        client_socket.sendall(json.dumps(response).encode('utf-8'))
                 
                 except socket.timeout:
-                    if peer_id and peer_id in self.peers:
-                        if time.time() - self.peers[peer_id]['last_active'] > 60:
-                            break
-                    else:
+                    # Registered peers may go quiet for a while, the liveness tracker decides when they are gone
+                    if not (peer_id and peer_id in self.peers):
                         break
                         
-                except json.JSONDecodeError:
-                    logger.warning(f"Invalid JSON from {address}")
+                except ValueError:
+                    # Framing keeps the stream in sync, so one bad frame doesn't cost the connection
+                    logger.warning(f"Invalid message from {address}")
+                    connection.send_json({'status': 'error', 'message': 'Invalid message'})
+                
+                except FramingError as e:
+                    logger.warning(f"Framing error from {address}: {e}")
                     break
                     
                 except Exception as e:
@@ -158,47 +689,37 @@ class RelayServer:
                     break
         
         finally:
-            if peer_id and peer_id in self.peers:
-                self._remove_peer(peer_id)
+            self._connection_lost(peer_id, connection)
             try:
-                client_socket.close()
+                connection.close()
             except:
                 pass
     
-    def _remove_peer(self, peer_id):
-        """Remove a peer from the registry"""
-        if peer_id in self.peers:
-            del self.peers[peer_id]
-        if peer_id in self.connections:
+    def _serve_datagrams(self):
+        while self.running:
             try:
-                self.connections[peer_id].close()
-            except:
-                pass
-            del self.connections[peer_id]
+                data, address = self.udp_socket.recvfrom(2048)
+                reply = self._handle_datagram(data, address)
+                if reply:
+                    self.udp_socket.sendto(reply, address)
+            except Exception as e:
+                if self.running:
+                    logger.error(f"Error handling datagram: {e}")
     
     def _cleanup_inactive_peers(self):
         while self.running:
-            current_time = time.time()
-            to_remove = []
-            
-            for peer_id, info in self.peers.items():
-                if current_time - info['last_active'] > 120:
-                    to_remove.append(peer_id)
-            
-            for peer_id in to_remove:
-                logger.info(f"Removing inactive peer {peer_id}")
-                self._remove_peer(peer_id)
-                
-            time.sleep(30)
+            self._expire_inactive_peers()
+            time.sleep(LIVENESS_TICK)
     
     def shutdown(self):
         self.running = False
         for peer_id in list(self.connections.keys()):
             self._remove_peer(peer_id)
-        try:
-            self.server_socket.close()
-        except:
-            pass
+        for sock in (self.server_socket, self.udp_socket):
+            try:
+                sock.close()
+            except:
+                pass
         
         logger.info("Relay server shut down")
 
@@ -0,0 +1,190 @@
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+
+# What put() does when a queue is full
+DROP = 'drop'  # Discard the new frame, the connection stays up
+BLOCK = 'block'  # Wait for room while the peer keeps reading, drop once it stalled for block_timeout
+DISCONNECT = 'disconnect'  # Give up on a consumer that cannot keep up and close the connection
+POLICIES = (DROP, BLOCK, DISCONNECT)
+
+SEND_QUEUE_FRAMES = 1024
+SEND_QUEUE_BYTES = 4 * 1024 * 1024  # Room for a file transfer's whole window of chunks
+BLOCK_TIMEOUT = 10
+WRITE_BATCH = 256 * 1024  # Small frames are joined into writes of about this size, large ones cut into them
+HEADROOM = 0.25  # Extra room, as a share of the bounds, for frames queued with headroom=True
+
+class QueueFull(ConnectionError):
+    pass
+
+class SendQueue:
+    """Frames waiting to go out on one connection, written by a thread of its own.
+
+    put() returns as soon as the frame is queued, so a peer that stops reading only ever
+    stalls its own writer. The queue takes frames while it is under its frame and byte bounds,
+    so it overshoots by at most one frame however large. What happens to a frame arriving at a
+    full queue is the policy: DROP it, BLOCK the sender for as long as the peer keeps reading,
+    or DISCONNECT the peer. A blocked sender gives up once nothing was written for block_timeout,
+    so a peer that stalled completely costs it that long once and drops from then on.
+    Frames put with headroom may use some room past the bounds, so replies still get queued
+    behind bulk sends that keep the queue full.
+    write(data) does the actual sending, on_error(exception) is called once if it fails or
+    the peer is disconnected for overflowing, and the queue closes.
+    """
+    def __init__(self, write, on_error, policy=DROP, max_frames=SEND_QUEUE_FRAMES,
+                 max_bytes=SEND_QUEUE_BYTES, block_timeout=BLOCK_TIMEOUT):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown send queue policy: {policy}")
+        self.write = write
+        self.on_error = on_error
+        self.policy = policy
+        self.max_frames = max_frames
+        self.max_bytes = max_bytes
+        self.block_timeout = block_timeout
+        self.items = deque()  # (data or a (function, Future) tuple, size)
+        self.depth = 0  # Frames queued or being written
+        self.bytes = 0
+        self.high_water = 0  # Most bytes ever waiting at once
+        self.sent = 0
+        self.sent_bytes = 0
+        self.dropped = 0
+        self.dropped_bytes = 0
+        self.blocked = 0  # Sends that had to wait for room
+        self.blocked_time = 0.0
+        self.last_progress = time.time()  # Last time the writer got bytes out, or the queue filled up from empty
+        self.error = None
+        self.closed = False
+        self.condition = threading.Condition()
+        self.writer_thread = threading.Thread(target=self._writer)
+        self.writer_thread.daemon = True
+        self.writer_thread.start()
+
+    def put(self, data, policy=None, headroom=False):
+        """Queue data to be written, returns False if it was dropped"""
+        return self._put(data, len(data), policy or self.policy, headroom)
+
+    def run(self, function, size=0, policy=BLOCK):
+        """Call function() on the writer, after everything queued before it, and return its result.
+
+        For sends that write to the connection themselves, like sendfile, which would otherwise
+        overtake frames still in the queue.
+        """
+        future = Future()
+        if not self._put((function, future), size, policy):
+            raise QueueFull("Send queue full")
+        return future.result()
+
+    def _put(self, item, size, policy, headroom=False):
+        overflow = None
+        with self.condition:
+            if self.closed:
+                raise ConnectionError(self.error or "Send queue closed")
+            if not self._fits(headroom) and policy == BLOCK:
+                started = time.time()
+                self.blocked += 1
+                while not self.closed and not self._fits(headroom):
+                    remaining = self.last_progress + self.block_timeout - time.time()
+                    if remaining <= 0:
+                        break
+                    self.condition.wait(remaining)
+                self.blocked_time += time.time() - started
+                if self.closed:
+                    raise ConnectionError(self.error or "Send queue closed")
+            if not self._fits(headroom):
+                self.dropped += 1
+                self.dropped_bytes += size
+                if policy != DISCONNECT:
+                    return False
+                overflow = QueueFull(f"Send queue full with {self.depth} frames, {self.bytes} bytes")
+            else:
+                if self.depth == 0:
+                    self.last_progress = time.time()  # Time spent idle is not a stall
+                self.items.append((item, size))
+                self.depth += 1
+                self.bytes += size
+                self.high_water = max(self.high_water, self.bytes)
+                self.condition.notify_all()
+                return True
+        self._fail(overflow)
+        raise overflow
+
+    def _fits(self, headroom=False):
+        scale = 1 + HEADROOM if headroom else 1
+        return self.depth < self.max_frames * scale and self.bytes < self.max_bytes * scale
+
+    def _writer(self):
+        while True:
+            with self.condition:
+                while not self.items and not self.closed:
+                    self.condition.wait()
+                if self.closed:
+                    return
+                batch = [self.items.popleft()]
+                if not isinstance(batch[0][0], tuple):
+                    # Small frames queued behind each other go out in a single write
+                    size = batch[0][1]
+                    while self.items and not isinstance(self.items[0][0], tuple) and size + self.items[0][1] <= WRITE_BATCH:
+                        batch.append(self.items.popleft())
+                        size += batch[-1][1]
+            try:
+                if not isinstance(batch[0][0], tuple):
+                    data = memoryview(batch[0][0] if len(batch) == 1 else b''.join(data for data, _ in batch))
+                    for offset in range(0, len(data), WRITE_BATCH):
+                        self.write(data[offset:offset + WRITE_BATCH])
+                        self.last_progress = time.time()
+                else:
+                    (function, future), _ = batch[0]
+                    try:
+                        future.set_result(function())
+                        self.last_progress = time.time()
+                    except Exception as e:
+                        future.set_exception(e)
+                        raise
+            except Exception as e:
+                self._fail(e)
+                return
+            with self.condition:
+                self.depth -= len(batch)
+                self.bytes -= sum(size for _, size in batch)
+                self.sent += len(batch)
+                self.sent_bytes += sum(size for _, size in batch)
+                self.condition.notify_all()
+
+    def _fail(self, error):
+        with self.condition:
+            if self.closed:
+                return
+            self.error = str(error)
+        self.close()
+        try:
+            self.on_error(error)
+        except Exception as e:
+            print(f"Error handling send failure: {e}")
+
+    def close(self):
+        """Stop the writer, whatever is still queued is discarded"""
+        with self.condition:
+            if self.closed:
+                return
+            self.closed = True
+            pending = [item for item, _ in self.items if isinstance(item, tuple)]
+            self.items.clear()
+            self.condition.notify_all()
+        for _, future in pending:
+            future.set_exception(ConnectionError(self.error or "Send queue closed"))
+
+    def as_dict(self):
+        with self.condition:
+            return {
+                'policy': self.policy,
+                'depth': self.depth,
+                'bytes': self.bytes,
+                'high_water': self.high_water,
+                'sent': self.sent,
+                'sent_bytes': self.sent_bytes,
+                'dropped': self.dropped,
+                'dropped_bytes': self.dropped_bytes,
+                'blocked': self.blocked,
+                'blocked_time': self.blocked_time
+            }
@@ -0,0 +1,83 @@
+import json
+import struct
+
+try:
+    import msgpack
+except ImportError:  # Optional, json is always there
+    msgpack = None
+
+# Relay fast path: a routing header the relay rewrites, followed by a payload it never decodes.
+# From a client the peer ids are the targets, from the relay the single id is the sender.
+ROUTED_TAG = b"<routed>"
+ROUTE_HEADER = struct.Struct('!BIH')  # flags, request_id, peer id count
+PEER_ID_SIZE = 16  # Peer ids are uuids, sent as their raw bytes
+ACK_REQUESTED = 1  # Flag asking the relay for a reply carrying request_id
+
+class Serializer:
+    def __init__(self, name, dumps, loads):
+        self.name = name
+        self.dumps = dumps  # dumps(obj) -> bytes
+        self.loads = loads
+
+def _json_loads(data):
+    return json.loads(data.decode('utf-8'))
+
+SERIALIZERS = {'json': Serializer('json', lambda obj: json.dumps(obj).encode('utf-8'), _json_loads)}
+if msgpack is not None:
+    SERIALIZERS['msgpack'] = Serializer('msgpack', lambda obj: msgpack.packb(obj, use_bin_type=True),
+                                        lambda data: msgpack.unpackb(data, raw=False))
+JSON = SERIALIZERS['json']
+PREFERENCE = ('msgpack', 'json')  # Both ends pick the first one they share, like codecs
+
+def available_serializers():
+    return [name for name in PREFERENCE if name in SERIALIZERS]
+
+def negotiate_serializer(offered):
+    """The serializer to use with a peer offering these names, json when there is nothing better"""
+    for name in PREFERENCE:
+        if name in SERIALIZERS and name in (offered or ()):
+            return SERIALIZERS[name]
+    return JSON
+
+def decode_message(frame):
+    """Decode a control message in whichever format it was sent.
+
+    Messages are always maps, so a json one starts with '{' and a msgpack one never does.
+    """
+    if frame[:1] == b'{':
+        return _json_loads(frame)
+    if msgpack is None:
+        raise ValueError("Binary message received but msgpack is not installed")
+    return SERIALIZERS['msgpack'].loads(frame)
+
+def is_routed(frame):
+    return frame.startswith(ROUTED_TAG)
+
+def _peer_id_bytes(peer_id):
+    # Cheaper than going through uuid.UUID, which shows up in the per-message cost
+    raw = bytes.fromhex(peer_id.replace('-', ''))
+    if len(raw) != PEER_ID_SIZE:
+        raise ValueError(f"Not a peer id: {peer_id}")
+    return raw
+
+def _peer_id_str(raw):
+    digits = raw.hex()
+    return f"{digits[:8]}-{digits[8:12]}-{digits[12:16]}-{digits[16:20]}-{digits[20:]}"
+
+def encode_routed(peer_ids, payload, request_id=0, flags=0):
+    header = ROUTE_HEADER.pack(flags, request_id, len(peer_ids))
+    ids = b''.join(_peer_id_bytes(peer_id) for peer_id in peer_ids)
+    return b''.join((ROUTED_TAG, header, ids, payload))
+
+def decode_routed(frame):
+    """Split a routed frame into (flags, request_id, peer ids, payload view)"""
+    view = memoryview(frame)
+    offset = len(ROUTED_TAG) + ROUTE_HEADER.size
+    if offset > len(view):
+        raise ValueError("Routed frame shorter than its header")
+    flags, request_id, count = ROUTE_HEADER.unpack_from(view, len(ROUTED_TAG))
+    end = offset + count * PEER_ID_SIZE
+    if end > len(view):
+        raise ValueError("Routed frame shorter than its header")
+    peer_ids = [_peer_id_str(view[start:start + PEER_ID_SIZE]) for start in range(offset, end, PEER_ID_SIZE)]
+    return flags, request_id, peer_ids, view[end:]
@@ -0,0 +1,91 @@
+# SerializationBenchmark.py
+import argparse
+import logging
+import time
+from Compression import CompressionStats
+from Framing import encode_frame
+from RelayServer import RelayRegistry
+from Serialization import SERIALIZERS, decode_message, decode_routed, encode_routed
+
+class NullConnection:
+    """Relay-side connection that counts frames instead of writing them anywhere"""
+    def __init__(self):
+        self.codec = None
+        self.compression = CompressionStats()
+        self.serializer = SERIALIZERS['json']
+        self.last_frame = None
+
+    def send_json(self, obj):
+        self.send_encoded(encode_frame(self.serializer.dumps(obj)))
+
+    def send_encoded(self, frame):
+        self.last_frame = frame
+
+    def send_relayed(self, sender_id, frame):
+        self.last_frame = frame
+        return True
+
+    def throttle(self, seconds):
+        pass
+
+    def close(self):
+        pass
+
+def register(registry, serializer):
+    registry.message_rate = registry.byte_rate = 1e12  # Count the rate limiter's cost, never its drops
+    connection = NullConnection()
+    peer_id = registry._handle_command({'command': 'register', 'ip': '127.0.0.1', 'port': 0,
+                                        'serializers': [serializer]}, connection, None)[0]
+    return peer_id, connection
+
+def cpu_per_message(function, count):
+    """Mean CPU time of function() in microseconds"""
+    started = time.process_time()
+    for _ in range(count):
+        function()
+    return (time.process_time() - started) / count * 1e6
+
+def bench_envelope(name, content, count):
+    """relay_message command: the relay decodes the envelope and re-encodes the content"""
+    registry = RelayRegistry()
+    sender_id, sender = register(registry, name)
+    target_id, target = register(registry, name)
+    serializer = SERIALIZERS[name]
+    message = {'command': 'relay_message', 'peer_id': sender_id, 'target_id': target_id,
+               'content': content, 'ack': False}
+    frame = serializer.dumps(message)
+    client = cpu_per_message(lambda: serializer.dumps(message), count)
+    relay = cpu_per_message(lambda: registry._handle_command(decode_message(frame), sender, sender_id), count)
+    delivered = target.last_frame[4:]
+    receiver = cpu_per_message(lambda: decode_message(delivered)['content'], count)
+    return client, relay, receiver, len(frame)
+
+def bench_routed(content, count):
+    """Fast path: the relay rewrites the routing header and never touches the payload"""
+    registry = RelayRegistry()
+    sender_id, sender = register(registry, 'json')
+    target_id, target = register(registry, 'json')
+    frame = encode_routed([target_id], content.encode('utf-8'))
+    client = cpu_per_message(lambda: encode_routed([target_id], content.encode('utf-8')), count)
+    relay = cpu_per_message(lambda: registry._handle_routed(frame, sender, sender_id), count)
+    delivered = target.last_frame[4:]
+    receiver = cpu_per_message(lambda: bytes(decode_routed(delivered)[3]).decode('utf-8'), count)
+    return client, relay, receiver, len(frame)
+
+def main():
+    parser = argparse.ArgumentParser(description='Per-message CPU cost of relay message encodings')
+    parser.add_argument('--messages', type=int, default=20000, help='Messages timed per measurement')
+    parser.add_argument('--payload', type=int, nargs='+', default=[64, 1024, 16384], help='Payload sizes in bytes')
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.WARNING)
+
+    print(f"{'path':<10} {'payload':>8} {'client us':>10} {'relay us':>9} {'receiver us':>12} {'wire bytes':>11}")
+    for size in args.payload:
+        content = 'x' * size
+        results = [(name, bench_envelope(name, content, args.messages)) for name in SERIALIZERS]
+        results.append(('routed', bench_routed(content, args.messages)))
+        for name, (client, relay, receiver, wire) in results:
+            print(f"{name:<10} {size:>8} {client:>10.2f} {relay:>9.2f} {receiver:>12.2f} {wire:>11}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,305 @@
+# ShardedRelayServer.py
+import argparse
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import shutil
+import signal
+import sys
+import tempfile
+import uuid
+from AsyncRelayServer import AsyncRelayServer
+from Framing import FrameBuffer, FramingError, encode_frame, encode_json
+from Serialization import decode_routed, encode_routed, is_routed
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger('sharded_relay_server')
+
+def shard_of(peer_id, shard_count):
+    """Shard owning a peer, derived from the peer id alone so every worker agrees.
+
+    None for anything that is not a peer id, clients send target ids of their own choosing.
+    """
+    try:
+        return uuid.UUID(peer_id).int % shard_count
+    except (TypeError, ValueError, AttributeError):
+        return None
+
+class ShardLinkProtocol(asyncio.Protocol):
+    """Inbound link from another worker carrying membership updates and forwarded relays.
+
+    Forwarded routed frames travel wrapped in another routed frame listing the targets.
+    """
+    def __init__(self, worker):
+        self.worker = worker
+        self.read_buffer = FrameBuffer()
+        self.shard = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        try:
+            frames = self.read_buffer.feed(data)
+        except FramingError as e:
+            logger.error(f"Shard link framing error: {e}")
+            self.transport.close()
+            return
+        for frame in frames:
+            if is_routed(frame):
+                _, _, target_ids, routed = decode_routed(frame)
+                self.worker._deliver(target_ids, bytes(routed))
+                continue
+            op = json.loads(frame.decode('utf-8'))
+            if op.get('op') == 'sync':
+                self.shard = op.get('shard')
+            self.worker._handle_link_op(op)
+
+    def connection_lost(self, exc):
+        if self.shard is not None:
+            self.worker._drop_shard(self.shard)
+
+class ShardWorker(AsyncRelayServer):
+    """One relay process. Owns the peers whose id hashes to its index and a replica of everyone else's"""
+    def __init__(self, index, shard_count, host, port, control_dir):
+        super().__init__(host, port, reuse_port=True)
+        self.index = index
+        self.shard_count = shard_count
+        self.control_dir = control_dir
+        self.links = {}  # Outbound links to the other workers {shard: StreamWriter}
+
+    def _link_path(self, shard):
+        return os.path.join(self.control_dir, f"shard-{shard}.sock")
+
+    def _is_local(self, peer_id):
+        return shard_of(peer_id, self.shard_count) == self.index
+
+    def _new_peer_id(self):
+        # Keep drawing until the id lands on this shard, takes shard_count draws on average
+        while True:
+            peer_id = str(uuid.uuid4())
+            if self._is_local(peer_id):
+                return peer_id
+
+    def _local_peers(self):
+        return {pid: info for pid, info in self.peers.items() if self._is_local(pid)}
+
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        link_server = await self.loop.create_unix_server(
+            lambda: ShardLinkProtocol(self),
+            self._link_path(self.index)
+        )
+        link_tasks = [
+            asyncio.ensure_future(self._maintain_link(shard))
+            for shard in range(self.shard_count) if shard != self.index
+        ]
+        try:
+            await super().serve()
+        finally:
+            for task in link_tasks:
+                task.cancel()
+            link_server.close()
+
+    async def _maintain_link(self, shard):
+        """Keep an outbound link to another worker open, announcing our peers each time it comes up"""
+        delay = 0.05
+        while self.running:
+            try:
+                reader, writer = await asyncio.open_unix_connection(self._link_path(shard))
+            except (FileNotFoundError, ConnectionRefusedError):
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 2.0)
+                continue
+            delay = 0.05
+            self.links[shard] = writer
+            writer.write(encode_json({'op': 'sync', 'shard': self.index, 'peers': self._local_peers()}))
+            logger.info(f"Shard {self.index} linked to shard {shard}")
+            # The link is write-only, reading just tells us when the other side went away
+            await reader.read()
+            self.links.pop(shard, None)
+            writer.close()
+            logger.warning(f"Shard {self.index} lost link to shard {shard}")
+
+    def _broadcast_link_op(self, op):
+        frame = encode_json(op)
+        for writer in self.links.values():
+            writer.write(frame)
+
+    def _handle_link_op(self, op):
+        kind = op.get('op')
+        if kind == 'sync':
+            self._drop_shard(op['shard'])
+            for peer_id, info in op.get('peers', {}).items():
+                self._add_peer(peer_id, info)
+        elif kind == 'peer_added':
+            self._add_peer(op['peer_id'], op['info'])
+        elif kind == 'peer_updated':
+            if op['peer_id'] in self.peers:
+                self._update_capabilities(op['peer_id'], op['capabilities'])
+        elif kind == 'udp_endpoint':
+            if op['peer_id'] in self.peers:
+                self.peers[op['peer_id']]['udp'] = op['endpoint']
+        elif kind == 'peer_removed':
+            self._forget_peer(op['peer_id'])
+        elif kind == 'relay':
+            self._deliver([op['target_id']], op['message'])  # Held if the target is between connections
+        elif kind == 'multicast':
+            self._deliver(op['target_ids'], op['message'])
+
+    def _drop_shard(self, shard):
+        for peer_id in [pid for pid in self.peers if shard_of(pid, self.shard_count) == shard]:
+            self._forget_peer(peer_id)
+
+    def _cmd_register(self, message, connection, peer_id):
+        resumed = (message.get('resume') or {}).get('peer_id')
+        known = resumed in self.peers
+        peer_id = super()._cmd_register(message, connection, peer_id)
+        if peer_id is None or peer_id not in self.peers:
+            return peer_id
+        if known and peer_id == resumed:
+            # The other workers still have it, only what it told us on the way back in may differ
+            self._broadcast_link_op({'op': 'peer_updated', 'peer_id': peer_id,
+                                     'capabilities': self.peers[peer_id]['capabilities']})
+        else:
+            self._broadcast_link_op({'op': 'peer_added', 'peer_id': peer_id, 'info': self.peers[peer_id]})
+        return peer_id
+    
+    def _owns(self, peer_id):
+        # Any worker can hand out a new id, only the one owning an existing id can resume it
+        return peer_id not in self.peers or self._is_local(peer_id)
+
+    def _cmd_heartbeat(self, message, connection, peer_id):
+        peer_id = super()._cmd_heartbeat(message, connection, peer_id)
+        if peer_id in self.peers and 'capabilities' in message:
+            # What the index took, capabilities it refused were never stored
+            self._broadcast_link_op({'op': 'peer_updated', 'peer_id': peer_id,
+                                     'capabilities': self.peers[peer_id]['capabilities']})
+        return peer_id
+    
+    def _handle_datagram(self, data, address):
+        # SO_REUSEPORT spreads datagrams by source address, so this may not be the peer's owner
+        reply = super()._handle_datagram(data, address)
+        if reply:
+            peer_id = json.loads(data[1:].decode('utf-8'))['peer_id']
+            self._broadcast_link_op({'op': 'udp_endpoint', 'peer_id': peer_id, 'endpoint': list(address)})
+        return reply
+
+    def _push(self, peer_id, message):
+        if peer_id not in self.peers or self._is_local(peer_id):
+            return super()._push(peer_id, message)
+        link = self.links.get(shard_of(peer_id, self.shard_count))
+        if link is None:
+            return False
+        link.write(encode_json({'op': 'relay', 'target_id': peer_id, 'message': message}))
+        return True
+    
+    def _cmd_relay_message(self, message, connection, peer_id):
+        target_id = message.get('target_id')
+        if target_id not in self.peers or self._is_local(target_id):
+            return super()._cmd_relay_message(message, connection, peer_id)
+
+        owner = shard_of(target_id, self.shard_count)
+        link = self.links.get(owner)
+        if link is None:
+            response = {'status': 'error', 'message': f'Shard {owner} unavailable'}
+        elif not self._admit(peer_id, connection, 1, self._content_size(message.get('content'))):
+            response = {'status': 'error', 'message': 'Rate limited'}
+        else:
+            relay_message = self._relayed(peer_id, message.get('content'))
+            link.write(encode_json({'op': 'relay', 'target_id': target_id, 'message': relay_message}))
+            response = {'status': 'success'}
+        if message.get('ack', True):
+            self._reply(connection, message, response)
+        return peer_id
+    
+    def _route(self, target_ids, message):
+        # Deliver our own targets, then one link message per shard for the rest
+        by_shard = {}
+        unknown = []
+        for target_id in target_ids:
+            if target_id in self.peers:
+                by_shard.setdefault(shard_of(target_id, self.shard_count), []).append(target_id)
+            else:
+                unknown.append(target_id)
+        delivered, failed = self._deliver(by_shard.pop(self.index, []), message)
+        failed.extend(unknown)
+        for shard, shard_targets in by_shard.items():
+            link = self.links.get(shard)
+            if link is None:
+                failed.extend(shard_targets)
+                continue
+            if isinstance(message, bytes):
+                link.write(encode_frame(encode_routed(shard_targets, message)))
+            else:
+                link.write(encode_json({'op': 'multicast', 'target_ids': shard_targets, 'message': message}))
+            delivered += len(shard_targets)  # Handed to the owning shard, which drops targets that are gone
+        return delivered, failed
+
+    def _remove_peer(self, peer_id):
+        local = peer_id in self.peers and self._is_local(peer_id)
+        super()._remove_peer(peer_id)
+        if local:
+            self._broadcast_link_op({'op': 'peer_removed', 'peer_id': peer_id})
+
+    def _touch(self, peer_id, heartbeat=None):
+        # Replicas of remote peers are never tracked here, their owner expires them
+        if self._is_local(peer_id):
+            super()._touch(peer_id, heartbeat)
+
+def run_worker(index, shard_count, host, port, control_dir):
+    """Worker process entry point"""
+    ShardWorker(index, shard_count, host, port, control_dir).start()
+
+class ShardedRelayServer:
+    """Runs N relay workers accepting on one port through SO_REUSEPORT"""
+    def __init__(self, host='0.0.0.0', port=12345, workers=None):
+        self.host = host
+        self.port = port
+        self.workers = workers or os.cpu_count() or 1
+        self.processes = []
+        self.control_dir = None
+
+    def start(self):
+        """Spawn the workers and wait for them"""
+        self.control_dir = tempfile.mkdtemp(prefix='relay-shards-')
+        # Turn SIGTERM into a normal exit so the workers get torn down with us
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        for index in range(self.workers):
+            process = multiprocessing.Process(
+                target=run_worker,
+                args=(index, self.workers, self.host, self.port, self.control_dir)
+            )
+            process.daemon = True
+            process.start()
+            self.processes.append(process)
+        logger.info(f"Sharded relay server started on {self.host}:{self.port} with {self.workers} workers")
+        try:
+            for process in self.processes:
+                process.join()
+        except KeyboardInterrupt:
+            logger.info("Server shutdown initiated")
+        finally:
+            self.shutdown()
+
+    def shutdown(self):
+        for process in self.processes:
+            if process.is_alive():
+                process.terminate()
+        for process in self.processes:
+            process.join()
+        self.processes = []
+        if self.control_dir:
+            shutil.rmtree(self.control_dir, ignore_errors=True)
+            self.control_dir = None
+        logger.info("Sharded relay server shut down")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Sharded relay server')
+    parser.add_argument('--host', type=str, default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=12345)
+    parser.add_argument('--workers', type=int, default=None, help='Worker processes (default: one per core)')
+    args = parser.parse_args()
+    ShardedRelayServer(args.host, args.port, args.workers).start()
@@ -0,0 +1,323 @@
+import logging
+import random
+import threading
+import time
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+from ChunkStore import is_digest, manifest_id as compute_manifest_id
+from FileTransfer import encode_transfer, decode_transfer, unique_path
+
+logger = logging.getLogger('swarm')
+
+SWARM_TAG = b"<swarm>"
+MAX_PARALLEL = 16  # Chunk requests in flight per download
+PER_PEER_REQUESTS = 4  # Requests in flight to any one holder
+CANDIDATE_WINDOW = 64  # Pending chunks considered per scheduling pass for rarest-first
+REQUEST_TIMEOUT = 30
+UPLOAD_WORKERS = 4
+
+def encode_swarm(header, data=b""):
+    return encode_transfer(header, data, SWARM_TAG)
+
+def is_swarm_frame(frame):
+    return frame.startswith(SWARM_TAG)
+
+def valid_manifest(manifest_id, manifest):
+    """Whether an announced manifest is well formed and really has the id it was announced under"""
+    try:
+        chunks = manifest['chunks']
+        if not isinstance(manifest['filename'], str) or not isinstance(chunks, list) or not chunks:
+            return False
+        return all(is_digest(digest) for digest in chunks) and compute_manifest_id(manifest) == manifest_id
+    except (KeyError, TypeError, ValueError):
+        return False
+
+class SwarmDownload:
+    """Fetch state for one artifact: who holds which chunks and what is in flight"""
+    def __init__(self, manifest_id, manifest, store):
+        self.manifest_id = manifest_id
+        self.manifest = manifest
+        self.missing = set(store.missing(manifest))
+        # Visit chunks in random order so peers downloading together end up with different pieces
+        pending = list(self.missing)
+        random.shuffle(pending)
+        self.pending = deque(pending)
+        self.holders = {}  # Partial holders {peer_key: set(indexes)}
+        self.seeds = set()  # Peers holding the whole artifact
+        self.stripe = None  # (position, count) slice of chunks the seed asked us to take from it
+        self.in_flight = {}  # {index: (peer_key, requested_at)}
+        self.received_from = Counter()
+
+    def assigned(self, index):
+        return self.stripe is not None and index % self.stripe[1] == self.stripe[0]
+
+    def availability(self, index):
+        return sum(1 for indexes in self.holders.values() if index in indexes)
+
+    def next_requests(self):
+        """Pick (peer_key, index) pairs to request, rarest chunk first, partial holders before seeds"""
+        load = Counter(peer_key for peer_key, _ in self.in_flight.values())
+        slots = MAX_PARALLEL - len(self.in_flight)
+        if slots <= 0:
+            return []
+
+        candidates = []
+        for _ in range(len(self.pending)):
+            if len(candidates) >= CANDIDATE_WINDOW:
+                break
+            index = self.pending.popleft()
+            if index not in self.missing:
+                continue
+            self.pending.append(index)
+            if index not in self.in_flight:
+                candidates.append(index)
+        candidates.sort(key=self.availability)
+
+        # Seeds only serve our own stripe unless nothing else is moving, so the origin uploads each
+        # chunk about once and the neighbours trade the rest among themselves
+        fallback = not self.in_flight
+        requests = []
+        for index in candidates:
+            if len(requests) >= slots:
+                break
+            pool = [p for p, indexes in self.holders.items() if index in indexes and load[p] < PER_PEER_REQUESTS]
+            if not pool and (fallback or self.assigned(index)):
+                pool = [p for p in self.seeds if load[p] < PER_PEER_REQUESTS]
+            if not pool:
+                continue
+            peer_key = min(pool, key=lambda p: load[p])
+            load[peer_key] += 1
+            self.in_flight[index] = (peer_key, time.time())
+            requests.append((peer_key, index))
+        return requests
+
+    def forget_peer(self, peer_key):
+        self.holders.pop(peer_key, None)
+        self.seeds.discard(peer_key)
+        for index, (holder, _) in list(self.in_flight.items()):
+            if holder == peer_key:
+                del self.in_flight[index]
+
+class SwarmManager:
+    """Distributes artifacts by letting every peer fetch chunks from any neighbour that has them.
+
+    send(peer_key, frame) delivers a frame to one neighbour, neighbours() lists the keys of the
+    peers currently reachable. Chunks are kept in the node's ChunkStore, so a node serves what
+    it has downloaded as soon as it has verified it.
+    """
+    def __init__(self, store, send, neighbours, on_complete, on_error, download_dir='received'):
+        self.store = store
+        self.send = send
+        self.neighbours = neighbours
+        self.on_complete = on_complete
+        self.on_error = on_error
+        self.download_dir = download_dir
+        self.artifacts = {}  # Every manifest we have seen {manifest_id: manifest}
+        self.complete = set()  # Artifacts we seeded or hold every verified chunk of
+        self.downloads = {}  # {manifest_id: SwarmDownload}
+        self.uploaded = Counter()  # Bytes served per artifact
+        self.lock = threading.RLock()
+        self.uploader = ThreadPoolExecutor(max_workers=UPLOAD_WORKERS)
+        self.maintenance_thread = threading.Thread(target=self._maintenance_loop)
+        self.maintenance_thread.daemon = True
+        self.maintenance_thread.start()
+
+    def share(self, path):
+        """Seed a local file and announce its manifest to every neighbour"""
+        manifest = self.store.add_file(path)
+        manifest_id = manifest['manifest_id']
+        with self.lock:
+            self.artifacts[manifest_id] = manifest
+            self.complete.add(manifest_id)
+        neighbours = self.neighbours()
+        for position, peer_key in enumerate(neighbours):
+            announcement = self._announcement(manifest_id)
+            announcement['stripe'] = [position, len(neighbours)]
+            self._send(peer_key, announcement)
+        return manifest
+
+    def _announcement(self, manifest_id):
+        download = self.downloads.get(manifest_id)
+        header = {
+            'op': 'announce',
+            'manifest_id': manifest_id,
+            'manifest': self.artifacts[manifest_id],
+            'complete': download is None
+        }
+        if download is not None:
+            header['indexes'] = [i for i in range(len(download.manifest['chunks'])) if i not in download.missing]
+        return header
+
+    def _send(self, peer_key, header, data=b""):
+        try:
+            self.send(peer_key, encode_swarm(header, data))
+            return True
+        except Exception as e:
+            logger.warning(f"Swarm send to {peer_key} failed: {e}")
+            self.peer_lost(peer_key)
+            return False
+
+    def _broadcast(self, header, exclude=None):
+        for peer_key in self.neighbours():
+            if peer_key != exclude:
+                self._send(peer_key, header)
+
+    def peer_lost(self, peer_key):
+        with self.lock:
+            downloads = list(self.downloads.values())
+            for download in downloads:
+                download.forget_peer(peer_key)
+        for download in downloads:
+            self._schedule(download.manifest_id)
+
+    def handle_frame(self, frame, peer_key, peer=None):
+        header, data = decode_transfer(frame, SWARM_TAG)
+        op = header.get('op')
+        manifest_id = header.get('manifest_id')
+        if op == 'announce':
+            self._on_announce(header, peer_key, peer)
+        elif op == 'have':
+            with self.lock:
+                download = self.downloads.get(manifest_id)
+                if download is None:
+                    return
+                if header.get('complete'):
+                    download.seeds.add(peer_key)
+                else:
+                    download.holders.setdefault(peer_key, set()).update(header.get('indexes', []))
+            self._schedule(manifest_id)
+        elif op == 'request':
+            self.uploader.submit(self._serve, manifest_id, header.get('index'), peer_key)
+        elif op == 'piece':
+            self._on_piece(header, data, peer_key, peer)
+        elif op == 'reject':
+            with self.lock:
+                download = self.downloads.get(manifest_id)
+                if download is None:
+                    return
+                download.in_flight.pop(header.get('index'), None)
+                download.holders.get(peer_key, set()).discard(header.get('index'))
+                download.seeds.discard(peer_key)
+            self._schedule(manifest_id)
+
+    def _on_announce(self, header, peer_key, peer):
+        manifest_id = header.get('manifest_id')
+        # The chunk list names what we store and serve, only take it if it hashes to the id
+        if not valid_manifest(manifest_id, header.get('manifest')):
+            logger.warning(f"Ignoring announcement of a manifest that does not match its id from {peer_key}")
+            return
+        with self.lock:
+            new = manifest_id not in self.artifacts
+            if new:
+                manifest = header['manifest']
+                self.artifacts[manifest_id] = manifest
+                download = SwarmDownload(manifest_id, manifest, self.store)
+                if download.missing:
+                    self.downloads[manifest_id] = download
+                else:
+                    self.complete.add(manifest_id)
+            download = self.downloads.get(manifest_id)
+            if download is not None:
+                stripe = header.get('stripe')
+                if isinstance(stripe, list) and len(stripe) == 2 and all(isinstance(n, int) for n in stripe) and stripe[1] > 0:
+                    download.stripe = tuple(stripe)
+                if header.get('complete'):
+                    download.seeds.add(peer_key)
+                else:
+                    download.holders.setdefault(peer_key, set()).update(header.get('indexes', []))
+            announcement = self._announcement(manifest_id) if new else None
+        if new:
+            # Gossip onwards and tell the announcer what we already hold
+            self._broadcast(announcement, exclude=peer_key)
+            self._send(peer_key, announcement)
+            if download is None:
+                self._finish(manifest_id, self.artifacts[manifest_id], peer)
+        self._schedule(manifest_id)
+
+    def _serve(self, manifest_id, index, peer_key):
+        with self.lock:
+            manifest = self.artifacts.get(manifest_id)
+            download = self.downloads.get(manifest_id)
+            # Only chunks we verified ourselves, of artifacts we seeded or are fetching
+            servable = manifest is not None and isinstance(index, int) and 0 <= index < len(manifest['chunks']) and (
+                manifest_id in self.complete or (download is not None and index not in download.missing))
+        try:
+            if not servable:
+                raise KeyError(index)
+            digest = manifest['chunks'][index]
+            data = self.store.read(digest)
+        except KeyError:
+            self._send(peer_key, {'op': 'reject', 'manifest_id': manifest_id, 'index': index})
+            return
+        if self._send(peer_key, {'op': 'piece', 'manifest_id': manifest_id, 'index': index}, data):
+            with self.lock:
+                self.uploaded[manifest_id] += len(data)
+
+    def _on_piece(self, header, data, peer_key, peer):
+        manifest_id = header.get('manifest_id')
+        index = header.get('index')
+        with self.lock:
+            download = self.downloads.get(manifest_id)
+            if download is None or index not in download.missing:
+                return
+            download.in_flight.pop(index, None)
+        if not self.store.put(download.manifest['chunks'][index], data):
+            logger.warning(f"Bad swarm chunk {index} from {peer_key}, requesting elsewhere")
+            with self.lock:
+                download.holders.get(peer_key, set()).discard(index)
+            self._schedule(manifest_id)
+            return
+        with self.lock:
+            download.missing.discard(index)
+            download.received_from[peer_key] += len(data)
+            done = not download.missing
+            if done:
+                del self.downloads[manifest_id]
+                self.complete.add(manifest_id)
+        if done:
+            self._broadcast({'op': 'have', 'manifest_id': manifest_id, 'complete': True})
+            self._finish(manifest_id, download.manifest, peer)
+        else:
+            self._broadcast({'op': 'have', 'manifest_id': manifest_id, 'indexes': [index]})
+            self._schedule(manifest_id)
+
+    def _finish(self, manifest_id, manifest, peer):
+        try:
+            path = self.store.assemble(manifest, unique_path(self.download_dir, manifest['filename']))
+        except Exception as e:
+            self.on_error(f"Assembling {manifest['filename']} failed: {e}", peer)
+            return
+        self.on_complete(path, peer)
+
+    def _schedule(self, manifest_id):
+        with self.lock:
+            download = self.downloads.get(manifest_id)
+            if download is None:
+                return
+            requests = download.next_requests()
+        for peer_key, index in requests:
+            self._send(peer_key, {'op': 'request', 'manifest_id': manifest_id, 'index': index})
+
+    def _maintenance_loop(self):
+        """Give up on requests that never got an answer and retry them elsewhere"""
+        while True:
+            time.sleep(1)
+            now = time.time()
+            with self.lock:
+                for download in self.downloads.values():
+                    for index, (holder, requested_at) in list(download.in_flight.items()):
+                        if now - requested_at > REQUEST_TIMEOUT:
+                            del download.in_flight[index]
+                manifest_ids = list(self.downloads)
+            for manifest_id in manifest_ids:
+                self._schedule(manifest_id)
+
+    def stats(self, manifest_id):
+        """Bytes uploaded by this node and, while downloading, bytes received per neighbour"""
+        with self.lock:
+            download = self.downloads.get(manifest_id)
+            return {
+                'uploaded': self.uploaded[manifest_id],
+                'missing': len(download.missing) if download else 0,
+                'received_from': dict(download.received_from) if download else {}
+            }
@@ -0,0 +1,420 @@
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+import uuid
+from collections import deque
+from CapabilityIndex import local_capabilities
+from ExecutionPool import ExecutionPool, Limits
+from FileTransfer import encode_transfer, decode_transfer
+from Framing import MappedFrame
+
+logger = logging.getLogger('task_scheduler')
+
+TASK_TAG = b"<task>"
+HEARTBEAT_INTERVAL = 5
+WORKER_TIMEOUT = 3 * HEARTBEAT_INTERVAL  # Missed heartbeats before a worker counts as lost
+LEASE_GRACE = 30  # Seconds a lease outlives the task timeout
+DEFAULT_TIMEOUT = 3600
+DEFAULT_RETRIES = 3
+RESULT_ENV = 'TASK_RESULT_PATH'  # File a task may write a JSON result value to
+
+def encode_task(header, data=b""):
+    return encode_transfer(header, data, TASK_TAG)
+
+def is_task_frame(frame):
+    return frame.startswith(TASK_TAG)
+
+class Task:
+    """A unit of work with its payload, requirements and timing"""
+    def __init__(self, payload, requirements=None, name=None, timeout=DEFAULT_TIMEOUT, max_retries=DEFAULT_RETRIES):
+        self.task_id = uuid.uuid4().hex
+        self.payload = payload
+        self.requirements = requirements or {}
+        self.name = name or self.task_id[:8]
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.status = 'queued'  # queued, running, done, failed
+        self.attempts = 0
+        self.worker = None
+        self.lease_id = None
+        self.lease_expires = None
+        self.returncode = None
+        self.output = bytearray()  # Streamed in by the worker as the task runs
+        self.value = None  # JSON result the task wrote to RESULT_ENV, if any
+        self.error = None
+        self.on_done = None
+        self.submitted_at = time.time()
+        self.first_assigned_at = None
+        self.assigned_at = None
+        self.finished_at = None
+        self.run_time = None
+        self.cpu_time = None
+
+    def cores(self):
+        return max(1, int(self.requirements.get('cores', 1)))
+
+    def metrics(self):
+        return {
+            'task_id': self.task_id,
+            'name': self.name,
+            'status': self.status,
+            'attempts': self.attempts,
+            'worker': self.worker,
+            'queue_wait': (self.first_assigned_at - self.submitted_at) if self.first_assigned_at else None,
+            'run_time': self.run_time,
+            'cpu_time': self.cpu_time,
+            'total_time': (self.finished_at - self.submitted_at) if self.finished_at else None
+        }
+
+class WorkerInfo:
+    """Coordinator-side view of one registered worker"""
+    def __init__(self, peer_key, resources):
+        self.peer_key = peer_key
+        self.resources = resources
+        self.last_seen = time.time()
+        self.running = set()
+
+    def fits(self, task):
+        needed_memory = task.requirements.get('memory_mb')
+        if needed_memory and self.resources.get('memory_mb', 0) < needed_memory:
+            return False
+        runtime = task.requirements.get('runtime')
+        if runtime and runtime not in self.resources.get('runtimes', [runtime]):
+            return False
+        return self.resources.get('cores', 1) >= task.cores()
+
+class TaskManager:
+    """Work queue for submitted tasks plus the worker loop that executes them.
+
+    Any node can submit tasks, it then coordinates them: workers register with it, pull tasks
+    when they have free slots and report results back. Every assignment carries a lease that
+    the worker's heartbeat keeps alive; a lost worker or expired lease puts the task back in
+    the queue until its retries run out.
+    """
+    def __init__(self, send, on_result, on_event, on_output=None):
+        self.send = send
+        self.on_result = on_result
+        self.on_event = on_event
+        self.on_output = on_output
+        self.lock = threading.RLock()
+        # Coordinator state
+        self.tasks = {}
+        self.pending = deque()
+        self.workers = {}
+        # Worker state
+        self.coordinator = None
+        self.slots = 0
+        self.busy = 0
+        self.pull_outstanding = False
+        self.pool = None
+        self.running = {}  # Tasks executing here {task_id: lease_id}
+        self.last_heartbeat = 0
+        self.maintenance_thread = threading.Thread(target=self._maintenance_loop)
+        self.maintenance_thread.daemon = True
+        self.maintenance_thread.start()
+
+    def _send(self, peer_key, header, data=b""):
+        try:
+            self.send(peer_key, encode_task(header, data))
+            return True
+        except Exception as e:
+            logger.warning(f"Task message to {peer_key} failed: {e}")
+            return False
+
+    def handle_frame(self, frame, peer_key, peer=None):
+        header, data = decode_transfer(frame, TASK_TAG)
+        handler = getattr(self, '_on_' + str(header.get('op')), None)
+        if handler is None:
+            logger.warning(f"Unknown task op {header.get('op')} from {peer_key}")
+            return
+        # A mapped frame's payload stays a view, a large script is written out without being copied
+        handler(header, data if isinstance(frame, MappedFrame) else bytes(data), peer_key)
+
+    # Coordinator side
+
+    def submit(self, payload, requirements=None, name=None, timeout=DEFAULT_TIMEOUT, max_retries=DEFAULT_RETRIES, on_done=None):
+        """Queue a task and wake idle workers, on_done(task) runs once it is done or has failed for good"""
+        task = Task(payload, requirements, name, timeout, max_retries)
+        task.on_done = on_done
+        with self.lock:
+            self.tasks[task.task_id] = task
+            self.pending.append(task)
+        self._notify_workers()
+        return task
+
+    def _notify_workers(self):
+        with self.lock:
+            workers = list(self.workers)
+        for peer_key in workers:
+            self._send(peer_key, {'op': 'available'})
+
+    def _on_register(self, header, data, peer_key):
+        with self.lock:
+            worker = self.workers.get(peer_key)
+            if worker is None:
+                worker = self.workers[peer_key] = WorkerInfo(peer_key, header.get('resources', {}))
+            else:
+                worker.resources = header.get('resources', {})
+                worker.last_seen = time.time()
+            has_work = bool(self.pending)
+        self.on_event(f"Worker {peer_key} registered with {worker.resources}")
+        if has_work:
+            self._send(peer_key, {'op': 'available'})
+
+    def _on_pull(self, header, data, peer_key):
+        assignments = []
+        with self.lock:
+            worker = self.workers.get(peer_key)
+            if worker is None:
+                self._send(peer_key, {'op': 'pull_done', 'assigned': 0, 'registered': False})
+                return
+            worker.last_seen = time.time()
+            free = header.get('slots', 1)
+            for task in list(self.pending):
+                if free <= 0:
+                    break
+                if task.cores() > free or not worker.fits(task):
+                    continue
+                self.pending.remove(task)
+                free -= task.cores()
+                now = time.time()
+                task.status = 'running'
+                task.attempts += 1
+                task.worker = peer_key
+                task.lease_id = uuid.uuid4().hex
+                task.lease_expires = now + task.timeout + LEASE_GRACE
+                task.assigned_at = now
+                task.first_assigned_at = task.first_assigned_at or now
+                task.output = bytearray()
+                worker.running.add(task.task_id)
+                assignments.append(task)
+        for task in assignments:
+            header = {
+                'op': 'assign',
+                'task_id': task.task_id,
+                'lease_id': task.lease_id,
+                'name': task.name,
+                'timeout': task.timeout,
+                'requirements': task.requirements
+            }
+            if not self._send(peer_key, header, task.payload):
+                self._requeue(task, "assignment could not be delivered")
+        self._send(peer_key, {'op': 'pull_done', 'assigned': len(assignments)})
+
+    def _on_heartbeat(self, header, data, peer_key):
+        now = time.time()
+        with self.lock:
+            worker = self.workers.get(peer_key)
+            if worker is None:
+                return
+            worker.last_seen = now
+            for task_id in header.get('running', []):
+                task = self.tasks.get(task_id)
+                if task and task.worker == peer_key and task.status == 'running':
+                    task.lease_expires = now + task.timeout + LEASE_GRACE
+
+    def _on_result(self, header, data, peer_key):
+        with self.lock:
+            task = self.tasks.get(header.get('task_id'))
+            worker = self.workers.get(peer_key)
+            if worker:
+                worker.last_seen = time.time()
+                worker.running.discard(header.get('task_id'))
+            # Results from a lease we already gave away are stale
+            if task is None or task.lease_id != header.get('lease_id') or task.status != 'running':
+                return
+            task.returncode = header.get('returncode')
+            task.error = header.get('error')
+            task.run_time = header.get('run_time')
+            task.cpu_time = header.get('cpu_time')
+            task.value = header.get('value')
+            task.finished_at = time.time()
+            task.status = 'done' if task.returncode == 0 and not task.error else 'failed'
+            task.lease_id = None
+        self._finished(task)
+
+    def _finished(self, task):
+        self.on_result(task)
+        if task.on_done is not None:
+            try:
+                task.on_done(task)
+            except Exception as e:
+                logger.error(f"Completion callback for task {task.name} failed: {e}")
+
+    def _on_output(self, header, data, peer_key):
+        with self.lock:
+            task = self.tasks.get(header.get('task_id'))
+            if task is None or task.lease_id != header.get('lease_id'):
+                return
+            task.output += data
+        if self.on_output is not None:
+            self.on_output(task, header.get('stream'), data)
+
+    def _requeue(self, task, reason):
+        with self.lock:
+            worker = self.workers.get(task.worker)
+            if worker:
+                worker.running.discard(task.task_id)
+            task.lease_id = None
+            if task.attempts > task.max_retries:
+                task.status = 'failed'
+                task.error = f"Gave up after {task.attempts} attempts, last: {reason}"
+                task.finished_at = time.time()
+                failed = True
+            else:
+                task.status = 'queued'
+                self.pending.appendleft(task)
+                failed = False
+        if failed:
+            self._finished(task)
+        else:
+            self.on_event(f"Task {task.name} requeued: {reason}")
+            self._notify_workers()
+
+    def peer_lost(self, peer_key):
+        """The network saw this peer disconnect"""
+        self._worker_lost(peer_key, "connection lost")
+        with self.lock:
+            if self.coordinator == peer_key:
+                self.pull_outstanding = False
+
+    def _worker_lost(self, peer_key, reason):
+        with self.lock:
+            worker = self.workers.pop(peer_key, None)
+            if worker is None:
+                return
+            tasks = [self.tasks[task_id] for task_id in worker.running if task_id in self.tasks]
+        self.on_event(f"Worker {peer_key} lost: {reason}")
+        for task in tasks:
+            if task.status == 'running' and task.worker == peer_key:
+                self._requeue(task, f"worker {peer_key} lost")
+
+    def stats(self):
+        """Queue-wide counters and mean timings"""
+        with self.lock:
+            tasks = list(self.tasks.values())
+            workers = len(self.workers)
+        finished = [t for t in tasks if t.status == 'done']
+        counts = {}
+        for task in tasks:
+            counts[task.status] = counts.get(task.status, 0) + 1
+        waits = [t.first_assigned_at - t.submitted_at for t in tasks if t.first_assigned_at]
+        runs = [t.run_time for t in finished if t.run_time is not None]
+        return {
+            'workers': workers,
+            'counts': counts,
+            'mean_queue_wait': sum(waits) / len(waits) if waits else None,
+            'mean_run_time': sum(runs) / len(runs) if runs else None
+        }
+
+    # Worker side
+
+    def start_worker(self, coordinator, slots=None):
+        """Offer this node's cores to a coordinator and start pulling tasks from it"""
+        with self.lock:
+            self.coordinator = coordinator
+            self.slots = slots or os.cpu_count() or 1
+            if self.pool is None or self.pool.workers != self.slots:
+                self.pool = ExecutionPool(self.slots)
+        resources = local_capabilities()
+        resources['slots'] = self.slots
+        self._send(coordinator, {'op': 'register', 'resources': resources})
+        self._pull()
+
+    def stop_worker(self):
+        with self.lock:
+            self.coordinator = None
+
+    def _pull(self):
+        with self.lock:
+            coordinator = self.coordinator
+            free = self.slots - self.busy
+            if coordinator is None or free <= 0 or self.pull_outstanding:
+                return
+            self.pull_outstanding = True
+        if not self._send(coordinator, {'op': 'pull', 'slots': free}):
+            with self.lock:
+                self.pull_outstanding = False
+
+    def _on_available(self, header, data, peer_key):
+        if peer_key == self.coordinator:
+            self._pull()
+
+    def _on_pull_done(self, header, data, peer_key):
+        with self.lock:
+            self.pull_outstanding = False
+            register = header.get('registered') is False
+        if register and peer_key == self.coordinator:
+            self.start_worker(peer_key, self.slots)
+        elif header.get('assigned'):
+            self._pull()
+
+    def _on_assign(self, header, data, peer_key):
+        # The payload gets executed, only the coordinator we chose to work for may send one
+        if peer_key != self.coordinator:
+            logger.warning(f"Ignoring task assignment from {peer_key}, not our coordinator")
+            return
+        cores = max(1, int(header.get('requirements', {}).get('cores', 1)))
+        with self.lock:
+            self.busy += cores
+            self.running[header['task_id']] = header['lease_id']
+        self.pool.executor.submit(self._execute, header, data, peer_key, cores)
+
+    def _execute(self, header, payload, peer_key, cores):
+        """Run a task's script in its own process, streaming output to the coordinator as it appears"""
+        task_id, lease_id = header['task_id'], header['lease_id']
+        result = {'op': 'result', 'task_id': task_id, 'lease_id': lease_id}
+
+        def stream(name, data):
+            self._send(peer_key, {'op': 'output', 'task_id': task_id, 'lease_id': lease_id, 'stream': name}, data)
+
+        limits = Limits.from_requirements(header.get('requirements', {}), header.get('timeout', DEFAULT_TIMEOUT))
+        script = None
+        result_path = os.path.join(tempfile.gettempdir(), f"task-{task_id}-{lease_id}.json")
+        try:
+            with tempfile.NamedTemporaryFile('wb', suffix='.py', delete=False) as script:
+                script.write(payload)
+            execution = self.pool.run(["python3", script.name], stream, limits, env={RESULT_ENV: result_path})
+            result.update({
+                'returncode': execution.returncode,
+                'error': execution.error,
+                'run_time': execution.wall_time,
+                'cpu_time': execution.cpu_time
+            })
+            if os.path.exists(result_path):
+                with open(result_path, 'r') as f:
+                    result['value'] = json.load(f)
+        except Exception as e:
+            result['error'] = str(e)
+        finally:
+            for path in (script.name if script else None, result_path):
+                if path and os.path.exists(path):
+                    os.remove(path)
+        with self.lock:
+            self.busy -= cores
+            self.running.pop(task_id, None)
+        self._send(peer_key, result)
+        self._pull()
+
+    def _maintenance_loop(self):
+        while True:
+            time.sleep(1)
+            now = time.time()
+            with self.lock:
+                lost = [key for key, worker in self.workers.items() if now - worker.last_seen > WORKER_TIMEOUT]
+                expired = [task for task in self.tasks.values()
+                           if task.status == 'running' and task.lease_expires and task.lease_expires < now]
+                coordinator = self.coordinator
+                heartbeat_due = coordinator is not None and now - self.last_heartbeat >= HEARTBEAT_INTERVAL
+                if heartbeat_due:
+                    self.last_heartbeat = now
+                    running = list(self.running)
+            for peer_key in lost:
+                self._worker_lost(peer_key, "heartbeat timed out")
+            for task in expired:
+                self._requeue(task, "lease expired")
+            if heartbeat_due:
+                self._send(coordinator, {'op': 'heartbeat', 'running': running})
@@ -0,0 +1,166 @@
+import threading
+import time
+from collections import OrderedDict, deque
+
+# Per sender limits on what the relay forwards, bursts of BURST_SECONDS worth go through at once
+MESSAGE_RATE = 500  # Messages per second, a multicast counts once per target
+BYTE_RATE = 8 * 1024 * 1024
+BURST_SECONDS = 2
+MAX_THROTTLE = 1.0  # A sender further behind its limits than this has its messages dropped
+
+# Per target queues of relayed frames, one per sender, served by deficit round robin
+QUANTUM = 64 * 1024  # Bytes each sender may have written per round
+SENDER_QUEUE_FRAMES = 256
+SENDER_QUEUE_BYTES = 4 * 1024 * 1024  # Room for a file transfer's whole window of chunks
+
+class TokenBucket:
+    """Allows rate units per second on average, with bursts of up to burst units"""
+    def __init__(self, rate, burst, clock=time.monotonic):
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+        self.tokens = burst
+        self.updated = clock()
+
+    def take(self, amount, max_wait=MAX_THROTTLE):
+        """Spend amount tokens, returns how long the caller should hold off before sending more.
+
+        The balance may go into debt, which later callers wait off. Returns None and spends
+        nothing when paying off the debt would take longer than max_wait. An amount bigger
+        than the burst is only judged on the part a full bucket covers, so it goes through
+        whole once the bucket refills and its sender waits off the rest.
+        """
+        now = self.clock()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if max(min(amount, self.burst) - self.tokens, 0) / self.rate > max_wait:
+            return None
+        wait = max(amount - self.tokens, 0) / self.rate
+        self.tokens -= amount
+        return wait
+
+class SenderLimits:
+    """One sender's message and byte buckets, charged together"""
+    def __init__(self, message_rate=MESSAGE_RATE, byte_rate=BYTE_RATE, burst_seconds=BURST_SECONDS):
+        self.messages = TokenBucket(message_rate, message_rate * burst_seconds)
+        self.bytes = TokenBucket(byte_rate, byte_rate * burst_seconds)
+        self.lock = threading.Lock()
+
+    def take(self, messages, size, max_wait=MAX_THROTTLE):
+        """Charge messages totalling size bytes, returns the wait like TokenBucket.take, or None to drop"""
+        with self.lock:
+            message_wait = self.messages.take(messages, max_wait)
+            if message_wait is None:
+                return None
+            byte_wait = self.bytes.take(size, max_wait)
+            if byte_wait is None:
+                self.messages.tokens += messages  # Nothing goes out, so nothing is spent
+                return None
+            return max(message_wait, byte_wait)
+
+class FairQueue:
+    """Frames for one target from many senders, served by deficit round robin.
+
+    Every sender has its own bounded queue, so one flooding a target only ever fills its own
+    and is the one whose frames get dropped. Senders with frames waiting take turns, each
+    writing up to quantum bytes (plus whatever it saved from turns its next frame did not fit),
+    so a frame from a quiet sender waits for at most one turn of each busy one. Not thread
+    safe, the owner serializes put() and get().
+    """
+    def __init__(self, quantum=QUANTUM, max_frames=SENDER_QUEUE_FRAMES, max_bytes=SENDER_QUEUE_BYTES):
+        self.quantum = quantum
+        self.max_frames = max_frames
+        self.max_bytes = max_bytes
+        self.queues = OrderedDict()  # Senders with frames waiting, in turn order {sender: deque}
+        self.queued_bytes = {}  # {sender: bytes}
+        self.deficits = {}  # {sender: bytes it may still write this turn}
+        self.turn = None  # Sender whose turn it is
+        self.depth = 0
+        self.bytes = 0
+
+    def put(self, sender, frame):
+        """Queue frame behind sender's earlier ones, returns False if sender's queue is full"""
+        queue = self.queues.get(sender)
+        if queue is None:
+            queue = self.queues[sender] = deque()
+            self.queued_bytes[sender] = 0
+        elif len(queue) >= self.max_frames or self.queued_bytes[sender] + len(frame) > self.max_bytes:
+            return False
+        queue.append(frame)
+        self.queued_bytes[sender] += len(frame)
+        self.depth += 1
+        self.bytes += len(frame)
+        return True
+
+    def get(self):
+        """The next frame to write, None when nothing is waiting"""
+        while self.queues:
+            sender, queue = next(iter(self.queues.items()))
+            if self.turn != sender:
+                self.turn = sender
+                self.deficits[sender] = self.deficits.get(sender, 0) + self.quantum
+            frame = queue[0]
+            if len(frame) <= self.deficits[sender]:
+                queue.popleft()
+                self.deficits[sender] -= len(frame)
+                self.queued_bytes[sender] -= len(frame)
+                self.depth -= 1
+                self.bytes -= len(frame)
+                if not queue:
+                    # Leaves the rotation, and saved credit does not carry over to its next burst
+                    del self.queues[sender]
+                    del self.queued_bytes[sender]
+                    del self.deficits[sender]
+                    self.turn = None
+                return frame
+            # Its next frame is bigger than what it has left, the credit waits for its next turn
+            self.queues.move_to_end(sender)
+            self.turn = None
+        return None
+
+    def __len__(self):
+        return self.depth
+
+class TrafficStats:
+    """Relayed traffic the limits held back: throttled senders and dropped messages.
+
+    rate_dropped counts messages refused because their sender was too far over its limits,
+    queue_dropped those refused because the sender's queue at the target was full.
+    """
+    COUNTERS = ('throttled', 'throttle_time', 'rate_dropped', 'rate_dropped_bytes', 'queue_dropped', 'queue_dropped_bytes')
+
+    def __init__(self):
+        self.totals = dict.fromkeys(self.COUNTERS, 0)
+        self.senders = {}  # {sender: counters}, for the senders that hit a limit
+        self.lock = threading.Lock()
+
+    def _add(self, sender, counter, amount):
+        with self.lock:
+            self.totals[counter] += amount
+            counters = self.senders.get(sender)
+            if counters is None:
+                counters = self.senders[sender] = dict.fromkeys(self.COUNTERS, 0)
+            counters[counter] += amount
+
+    def throttled(self, sender, wait):
+        self._add(sender, 'throttled', 1)
+        self._add(sender, 'throttle_time', wait)
+
+    def rate_dropped(self, sender, size):
+        self._add(sender, 'rate_dropped', 1)
+        self._add(sender, 'rate_dropped_bytes', size)
+
+    def queue_dropped(self, sender, size):
+        self._add(sender, 'queue_dropped', 1)
+        self._add(sender, 'queue_dropped_bytes', size)
+
+    def forget(self, sender):
+        with self.lock:
+            self.senders.pop(sender, None)
+
+    def as_dict(self, top=10):
+        """Totals, plus the senders that dropped the most"""
+        with self.lock:
+            worst = sorted(self.senders.items(), key=lambda item: item[1]['rate_dropped'] + item[1]['queue_dropped'],
+                           reverse=True)[:top]
+            return dict(self.totals, senders={sender: dict(counters) for sender, counters in worst})